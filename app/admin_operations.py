@@ -1,40 +1,156 @@
 # admin_operations.py
 
-import os
-import gzip
-import shutil
 import psycopg2
+import psycopg2.extras
 import hashlib
-from database import get_db_connection
+import auth
+import audit
+import compaction
+from database import get_db_connection, get_read_connection, execute_atomic, note_write
+from user_operations import batch_book_ids
+from cache import cached_catalogue_read, bump_catalogue_version
+from pagination import decode_cursor, split_page
 from datetime import datetime
 
+# Rows per page on the admin dashboard, and rows per network fetch when streaming.
+ADMIN_PAGE_SIZE = 50
+STREAM_BATCH_SIZE = 500
+
+# Sortable book columns and the expression each one sorts on.
+# COALESCE keeps books without a category comparable in the keyset predicate.
+BOOK_SORT_COLUMNS = {
+    'id': 'id',
+    'title': 'title',
+    'author': 'author',
+    'category': "COALESCE(category, '')",
+    'status': 'status',
+}
+
+# Deletes a batch of books, keeping those with loan history, in one statement (see delete_books).
+DELETE_BATCH_SQL = """
+    WITH requested AS (SELECT unnest(%(ids)s::int[]) AS id),
+    deleted AS (
+        DELETE FROM books b
+        WHERE b.id IN (SELECT id FROM requested)
+          AND NOT EXISTS (SELECT 1 FROM transactions t WHERE t.book_id = b.id)
+        RETURNING b.id
+    )
+    SELECT r.id, CASE WHEN d.id IS NOT NULL THEN 'deleted'
+                      WHEN b.id IS NOT NULL THEN 'has_loans'
+                      ELSE 'not_found' END
+    FROM requested r
+    LEFT JOIN deleted d ON d.id = r.id
+    LEFT JOIN books b ON b.id = r.id
+"""
+
+# Every borrowing record, newest first (see iter_all_borrowing_records).
+ALL_RECORDS_SQL = """
+    SELECT t.id, t.username, b.title, t.borrow_date, t.due_date, t.return_date
+    FROM transactions t
+    JOIN books b ON t.book_id = b.id
+    ORDER BY t.borrow_date DESC, t.id DESC
+"""
+
 def add_book(title, author, category):
     """Adds a new book to the database."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO books (title, author, category) VALUES (%s, %s, %s)", (title, author, category))
-    conn.commit()
-    cursor.close()
-    conn.close()
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("INSERT INTO books (title, author, category) VALUES (%s, %s, %s)", (title, author, category))
+        conn.commit()
+    bump_catalogue_version()
+    note_write()
 
 def view_all_books():
     """Displays all books in the system."""
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cursor.execute("SELECT id, title, author, category, status FROM books")
-    books = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return books
+    # Cached listings load from the primary, so a lagging replica never caches a stale copy.
+    def load():
+        with get_db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+                cursor.execute("SELECT id, title, author, category, status FROM books")
+                return cursor.fetchall()
+    return cached_catalogue_read("all_books", load)
+
+def _book_ordering(sort, descending):
+    """Returns the whitelisted sort expression and direction for a books listing."""
+    return BOOK_SORT_COLUMNS.get(sort, 'id'), 'DESC' if descending else 'ASC'
+
+def _decode_book_cursor(token, sort):
+    """Validates a books keyset token, returning (sort_value, id) or None."""
+    keyset = decode_cursor(token, 2)
+    if not keyset:
+        return None
+    sort_value, book_id = keyset
+    try:
+        book_id = int(book_id)
+        if BOOK_SORT_COLUMNS.get(sort, 'id') == 'id':
+            sort_value = int(sort_value)
+        elif not isinstance(sort_value, str):
+            return None  # encode_cursor writes text; a list, object or null would not bind as one.
+    except (TypeError, ValueError):
+        return None
+    return sort_value, book_id
+
+def view_books_page(sort='id', descending=False, after=None, limit=ADMIN_PAGE_SIZE):
+    """
+    Returns one page of books ordered by `sort` then id, as (books, next_cursor).
+    `after` is the cursor token returned with the previous page.
+    """
+    cache_key, query, params = books_page_query(sort, descending, after, limit)
+
+    def load():
+        with get_db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+                cursor.execute(query, params)
+                books = cursor.fetchall()
+        return split_page(books, limit, key=lambda row: (row['sort_key'], row['id']))
+
+    return cached_catalogue_read(cache_key, load)
+
+def books_page_query(sort, descending, after, limit):
+    """Returns (cache key, SQL, params) for one page of view_books_page."""
+    expression, direction = _book_ordering(sort, descending)
+    keyset = _decode_book_cursor(after, sort)
+    where = ""
+    params = {'limit': limit + 1}
+    if keyset:
+        comparison = '<' if descending else '>'
+        where = f"WHERE ({expression}, id) {comparison} (%(after_value)s, %(after_id)s)"
+        params['after_value'], params['after_id'] = keyset
+    # The sort expression and direction come from BOOK_SORT_COLUMNS, never from user input.
+    query = f"""
+        SELECT id, title, author, category, status, {expression} AS sort_key
+        FROM books {where}
+        ORDER BY {expression} {direction}, id {direction}
+        LIMIT %(limit)s
+    """
+    return f"books_page:{sort}:{direction}:{keyset}:{limit}", query, params
+
+def _stream_rows(cursor_name, query, params=None):
+    """Yields rows from a server-side cursor, holding at most STREAM_BATCH_SIZE rows in memory."""
+    with get_read_connection() as conn:
+        with conn.cursor(name=cursor_name, cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            cursor.itersize = STREAM_BATCH_SIZE
+            cursor.execute(query, params)
+            for row in cursor:
+                yield row
+
+def iter_all_books(sort='id', descending=False):
+    """Streams every book in the requested order through a server-side cursor."""
+    return _stream_rows("admin_books_stream", _all_books_sql(sort, descending))
+
+def _all_books_sql(sort, descending):
+    expression, direction = _book_ordering(sort, descending)
+    return f"""
+        SELECT id, title, author, category, status FROM books
+        ORDER BY {expression} {direction}, id {direction}
+    """
 
 def get_book_details(book_id):
     """Retrieves the details for a single book by its ID."""
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cursor.execute("SELECT id, title, author, category FROM books WHERE id = %s", (book_id,))
-    book = cursor.fetchone()
-    cursor.close()
-    conn.close()
+    with get_read_connection() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            cursor.execute("SELECT id, title, author, category FROM books WHERE id = %s", (book_id,))
+            book = cursor.fetchone()
     return book
 
 def update_book_field(book_id, field_to_update, new_value):
@@ -44,104 +160,181 @@ def update_book_field(book_id, field_to_update, new_value):
         print("Error: Invalid field specified for update.")
         return False
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    # Use an f-string safely as the field is validated against a whitelist
-    query = f"UPDATE books SET {field_to_update} = %s WHERE id = %s"
-    cursor.execute(query, (new_value, book_id))
-    
-    if cursor.rowcount == 0:
-        cursor.close()
-        conn.close()
-        return False
-        
-    conn.commit()
-    cursor.close()
-    conn.close()
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            # Use an f-string safely as the field is validated against a whitelist
+            query = f"UPDATE books SET {field_to_update} = %s WHERE id = %s"
+            cursor.execute(query, (new_value, book_id))
+
+            if cursor.rowcount == 0:
+                return False
+
+        conn.commit()
+    bump_catalogue_version()
+    note_write()
     return True
 
 def delete_book(book_id):
     """Deletes a book from the database. Returns True on success, False on failure."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM books WHERE id = %s", (book_id,))
-    
-    if cursor.rowcount == 0:
-        cursor.close()
-        conn.close()
-        return False
-        
-    conn.commit()
-    cursor.close()
-    conn.close()
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("DELETE FROM books WHERE id = %s", (book_id,))
+
+            if cursor.rowcount == 0:
+                return False
+
+        conn.commit()
+    bump_catalogue_version()
+    note_write()
     return True
 
+def _update_books_sql(fields):
+    """Returns the batch update statement for `fields`, which must already be whitelisted."""
+    # Column names come from the whitelist in update_books, values are passed as parameters.
+    assignments = ', '.join(f"{field} = %({field})s" for field in fields)
+    return f"""
+        WITH requested AS (SELECT unnest(%(ids)s::int[]) AS id),
+        updated AS (
+            UPDATE books SET {assignments}
+            WHERE id IN (SELECT id FROM requested)
+            RETURNING id
+        )
+        SELECT r.id, CASE WHEN u.id IS NOT NULL THEN 'updated' ELSE 'not_found' END
+        FROM requested r LEFT JOIN updated u ON u.id = r.id
+    """
+
+def update_books(book_ids, changes):
+    """
+    Applies the same field changes (a dict of title, author and/or category) to several
+    books in one statement. Returns {book_id: 'updated' | 'not_found'}.
+    """
+    fields = {field: value for field, value in changes.items() if field in ('title', 'author', 'category')}
+    if not fields or len(fields) != len(changes):
+        print("Error: Invalid field specified for update.")
+        return {}
+    ids = batch_book_ids(book_ids)
+    if not ids:
+        return {}
+    rows = execute_atomic(_update_books_sql(fields), dict(fields, ids=ids))
+    results = dict(rows)
+    if 'updated' in results.values():
+        bump_catalogue_version()
+        note_write()
+    return results
+
+def delete_books(book_ids):
+    """
+    Deletes several books in one statement. Books with loan history are kept.
+    Returns {book_id: 'deleted' | 'has_loans' | 'not_found'}.
+    """
+    ids = batch_book_ids(book_ids)
+    if not ids:
+        return {}
+    rows = execute_atomic(DELETE_BATCH_SQL, {'ids': ids})
+    results = dict(rows)
+    if 'deleted' in results.values():
+        bump_catalogue_version()
+        note_write()
+    return results
+
 def view_all_borrowing_records():
     """Displays all borrowing and returning activities, including due date."""
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cursor.execute("""
-        SELECT t.username, b.title, t.borrow_date, t.due_date, t.return_date
+    with get_read_connection() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            cursor.execute("""
+                SELECT t.username, b.title, t.borrow_date, t.due_date, t.return_date
+                FROM transactions t
+                JOIN books b ON t.book_id = b.id
+                ORDER BY t.borrow_date DESC
+            """)
+            records = cursor.fetchall()
+    return records
+
+def _decode_records_cursor(token):
+    """Validates a transactions keyset token, returning (borrow_date, id) or None."""
+    keyset = decode_cursor(token, 2)
+    if not keyset:
+        return None
+    borrow_date, transaction_id = keyset
+    try:
+        datetime.fromisoformat(borrow_date)
+        return borrow_date, int(transaction_id)
+    except (TypeError, ValueError):
+        return None
+
+def records_page_query(after, limit):
+    """Returns (SQL, params) for one page of view_borrowing_records_page."""
+    keyset = _decode_records_cursor(after)
+    where = ""
+    params = {'limit': limit + 1}
+    if keyset:
+        where = "WHERE (t.borrow_date, t.id) < (%(after_date)s, %(after_id)s)"
+        params['after_date'], params['after_id'] = keyset
+    return f"""
+        SELECT t.id, t.username, b.title, t.borrow_date, t.due_date, t.return_date
         FROM transactions t
         JOIN books b ON t.book_id = b.id
-        ORDER BY t.borrow_date DESC
-    """)
-    records = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return records
-    
+        {where}
+        ORDER BY t.borrow_date DESC, t.id DESC
+        LIMIT %(limit)s
+    """, params
+
+def view_borrowing_records_page(after=None, limit=ADMIN_PAGE_SIZE):
+    """Returns one page of borrowing records, newest first, as (records, next_cursor)."""
+    query, params = records_page_query(after, limit)
+    with get_read_connection() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            cursor.execute(query, params)
+            records = cursor.fetchall()
+    return split_page(records, limit, key=lambda row: (row['borrow_date'], row['id']))
+
+def iter_all_borrowing_records():
+    """Streams every borrowing record, newest first, through a server-side cursor."""
+    return _stream_rows("admin_records_stream", ALL_RECORDS_SQL)
+
 def create_user(username, password, role):
     """Creates a new user or admin with a hashed password, callable only by an admin."""
     if role not in ['user', 'admin']:
         print("Error: Invalid role specified. Must be 'user' or 'admin'.")
         return False
     password_hash = hashlib.sha256(password.encode()).hexdigest()
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("INSERT INTO users (username, password, role) VALUES (%s, %s, %s)",
-                       (username, password_hash, role))
-        conn.commit()
-    except psycopg2.IntegrityError:
-        print("Error: This username is already taken.")
-        conn.rollback()
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            try:
+                cursor.execute("INSERT INTO users (username, password, role) VALUES (%s, %s, %s)",
+                               (username, password_hash, role))
+                conn.commit()
+            except psycopg2.IntegrityError:
+                print("Error: This username is already taken.")
+                conn.rollback()
+                return False
+    return True
+
+def update_user_role(username, role):
+    """Changes a user's role. Returns True on success, False if the role or user is invalid."""
+    if role not in ['user', 'admin']:
+        print("Error: Invalid role specified. Must be 'user' or 'admin'.")
         return False
-    finally:
-        cursor.close()
-        conn.close()
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            # The users trigger notifies every process to drop its cached copy of this user.
+            cursor.execute("UPDATE users SET role = %s WHERE username = %s RETURNING id", (role, username))
+            updated = cursor.fetchone()
+            if not updated:
+                return False
+        conn.commit()
+    auth.invalidate_user(updated[0])
     return True
 
-def disk_usage_alert_system():
-    """Scans for large files, compresses them, and logs the event."""
-    # (No changes to this function as it's file-system based)
-    alerts = []
-    current_directory = os.path.dirname(os.path.abspath(__file__))
-    for filename in os.listdir(current_directory):
-        filepath = os.path.join(current_directory, filename)
-        if os.path.isfile(filepath):
-            file_size_gb = os.path.getsize(filepath) / (1024 * 1024 * 1024)
-            if file_size_gb >= 1:
-                try:
-                    with open(filepath, 'rb') as f_in, gzip.open(f'{filepath}.gz', 'wb') as f_out:
-                        shutil.copyfileobj(f_in, f_out)
-                    os.remove(filepath)
-                    log_message = f"Compressed {filename} due to large size ({file_size_gb:.2f} GB)."
-                    alerts.append(log_message)
-                    log_action("System Alert", log_message)
-                except Exception as e:
-                    error_message = f"Error compressing {filename}: {e}"
-                    alerts.append(error_message)
-                    log_action("System Error", error_message)
-    return alerts
+def disk_usage_alert_system(wait=False):
+    """
+    Starts compressing large files in the background (see compaction.py); progress and
+    results are reported through log_action. With wait=True, blocks and returns the alerts.
+    """
+    job = compaction.start_job(report=log_action)
+    return job.wait() if wait else []
 
 def log_action(action, details):
-    """Logs an action to the logs table."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    cursor.execute("INSERT INTO logs (timestamp, action, details) VALUES (%s, %s, %s)",
-                   (timestamp, action, details))
-    conn.commit()
-    cursor.close()
-    conn.close()
\ No newline at end of file
+    """Logs an action to the logs table. The write is queued and batched by audit.py,
+    so this never waits on the database."""
+    audit.record(action, details)
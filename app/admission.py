@@ -0,0 +1,204 @@
+# admission.py
+"""
+Admission control: turns away excess work before it reaches PostgreSQL.
+
+Login and signup attempts are rate-limited with token buckets per client IP and per
+username, so a credential-stuffing burst is answered 429 without hashing a password or
+opening a connection. Each worker also caps the requests it handles at once (see
+ConcurrencyLimit); requests beyond the cap are answered 503 straight away rather than
+queueing for a pooled connection. Both answers carry Retry-After.
+
+Every decision is counted in lms_admission_decisions_total on /metrics.
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+from cache import InMemoryRedis
+from config import (LOGIN_RATE_PER_IP, LOGIN_BURST_PER_IP, LOGIN_RATE_PER_USER, LOGIN_BURST_PER_USER,
+                    SIGNUP_RATE_PER_IP, SIGNUP_BURST_PER_IP, ADMISSION_REDIS_URL, ADMISSION_MAX_BUCKETS,
+                    ADMISSION_RETRY_AFTER, TRUSTED_PROXY_HOPS)
+
+# Endpoints never shed: probes, metrics and static files do no database work.
+EXEMPT_ENDPOINTS = {'static', 'healthz', 'readyz', 'prometheus_metrics'}
+
+
+# --- BUCKET STORES ---
+
+class LocalBucketStore:
+    """Bucket states in this process, least recently used dropped beyond `maxsize` (a dropped bucket is full)."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    def update(self, key, step, ttl):
+        """Applies `step(state) -> (new state, result)` to a bucket atomically and returns the result."""
+        with self._lock:
+            state, result = step(self._states.get(key))
+            self._states[key] = state
+            self._states.move_to_end(key)
+            while len(self._states) > self.maxsize:
+                self._states.popitem(last=False)
+            return result
+
+    def snapshot(self):
+        with self._lock:
+            return {'backend': 'local', 'buckets': len(self._states)}
+
+
+class RedisBucketStore:
+    """
+    Bucket states on any Redis-compatible client (get, set with ex), shared by every worker.
+    The read and write are separate commands, so attempts racing on one bucket from several
+    workers can each be admitted; the limit holds to within that.
+    """
+
+    def __init__(self, client, prefix='lms:admission:'):
+        self._client = client
+        self._prefix = prefix
+        self.errors = 0
+
+    def update(self, key, step, ttl):
+        try:
+            raw = self._client.get(self._prefix + key)
+            if isinstance(raw, bytes):
+                raw = raw.decode()
+            state = tuple(float(part) for part in raw.split(':')) if raw else None
+            state, result = step(state)
+            self._client.set(self._prefix + key, f"{state[0]}:{state[1]}", ex=ttl)
+            return result
+        except Exception:
+            # An unreachable store must not lock everyone out; admit instead.
+            self.errors += 1
+            return 0.0
+
+    def snapshot(self):
+        return {'backend': 'redis', 'errors': self.errors}
+
+
+def _make_store(redis_url):
+    if not redis_url:
+        return LocalBucketStore(ADMISSION_MAX_BUCKETS)
+    if redis_url == 'memory://':
+        return RedisBucketStore(InMemoryRedis())
+    import redis  # Optional dependency, only needed when ADMISSION_REDIS_URL points at a server.
+    return RedisBucketStore(redis.Redis.from_url(redis_url))
+
+
+# --- RATE LIMITS ---
+
+class TokenBucket:
+    """
+    Allows bursts of up to `burst` attempts per key, refilled at `rate` attempts per second.
+    A bucket's state is (tokens left, when they were counted).
+    """
+
+    def __init__(self, name, store, rate, burst):
+        self.name = name
+        self.store = store
+        self.rate = rate
+        self.burst = burst
+        # An untouched bucket is full again after this long, so its state can expire.
+        self._ttl = max(1, math.ceil(burst / rate))
+
+    def take(self, key):
+        """Takes one token for `key`. Returns 0 if admitted, else the seconds until a token is free."""
+        now = time.time()
+
+        def step(state):
+            tokens, counted_at = state if state else (self.burst, now)
+            tokens = min(self.burst, tokens + max(0.0, now - counted_at) * self.rate)
+            if tokens >= 1:
+                return (tokens - 1, now), 0.0
+            return (tokens, now), (1 - tokens) / self.rate
+
+        wait = self.store.update(f"{self.name}:{key}", step, self._ttl)
+        metrics.observe_admission(self.name, not wait)
+        return wait
+
+
+def _bucket(name, rate, burst):
+    return TokenBucket(name, _store, rate, burst) if rate > 0 and burst > 0 else None
+
+
+_store = _make_store(ADMISSION_REDIS_URL)
+login_per_ip = _bucket('login_ip', LOGIN_RATE_PER_IP, LOGIN_BURST_PER_IP)
+login_per_user = _bucket('login_user', LOGIN_RATE_PER_USER, LOGIN_BURST_PER_USER)
+signup_per_ip = _bucket('signup_ip', SIGNUP_RATE_PER_IP, SIGNUP_BURST_PER_IP)
+
+
+def client_ip(remote_addr, forwarded_for):
+    """
+    Returns the client's address: `remote_addr`, or with TRUSTED_PROXY_HOPS proxies in front,
+    the X-Forwarded-For entry they appended (entries further left are client-supplied).
+    """
+    if TRUSTED_PROXY_HOPS and forwarded_for:
+        hops = [hop.strip() for hop in forwarded_for.split(',') if hop.strip()]
+        if hops:
+            return hops[-min(TRUSTED_PROXY_HOPS, len(hops))]
+    return remote_addr or 'unknown'
+
+
+def _retry_after(wait):
+    # Retry-After is whole seconds; rounding up never invites a retry that is refused again.
+    return math.ceil(wait) if wait else None
+
+
+def check_login(ip, username):
+    """Returns None if a login attempt may go ahead, else the seconds to send in Retry-After."""
+    wait = login_per_ip.take(ip) if login_per_ip is not None else 0.0
+    # An attempt refused per IP does not use up the username's bucket.
+    if not wait and login_per_user is not None and username:
+        wait = login_per_user.take(username.strip().lower())
+    return _retry_after(wait)
+
+
+def check_signup(ip):
+    """Returns None if a signup attempt may go ahead, else the seconds to send in Retry-After."""
+    return _retry_after(signup_per_ip.take(ip)) if signup_per_ip is not None else None
+
+
+# --- CONCURRENCY ---
+
+class ConcurrencyLimit:
+    """
+    Caps the requests a worker handles at once. try_enter() never waits: past the limit the
+    request is refused, and the caller answers 503 with Retry-After ADMISSION_RETRY_AFTER.
+    Thread-safe, and non-blocking so it can be used from the event loop as well.
+    """
+
+    retry_after = ADMISSION_RETRY_AFTER
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self._in_flight = 0
+        self._peak = 0
+        self._lock = threading.Lock()
+
+    def try_enter(self):
+        with self._lock:
+            admitted = self._in_flight < self.limit
+            if admitted:
+                self._in_flight += 1
+                self._peak = max(self._peak, self._in_flight)
+        metrics.observe_admission(self.name, admitted)
+        return admitted
+
+    def leave(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    def snapshot(self):
+        with self._lock:
+            return {'in_flight': self._in_flight, 'peak': self._peak, 'limit': self.limit}
+
+
+def stats():
+    """Bucket store counters, exported as gauges on /metrics."""
+    return _store.snapshot()
@@ -0,0 +1,167 @@
+# api.py
+
+import json
+from functools import wraps
+
+from flask import Blueprint, Response, jsonify, request, session
+
+import auth
+import database
+import user_operations as user_ops
+import admin_operations as admin_ops
+import partitions
+import stats
+import overdue
+from http_cache import conditional_json
+
+# Versioned JSON API next to the HTML routes. It uses the same session login, and every
+# read carries ETag / Last-Modified validators so polling clients get 304 Not Modified
+# without the query behind it being run.
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+
+def _error(status, message):
+    response = jsonify(error=message)
+    response.status_code = status
+    return response
+
+
+def api_login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        user = auth.session_user(session)
+        if user is None:
+            return _error(401, "Login required")
+        # Validators and data come from the same replica, so a 304 is never based on a
+        # newer version than the data a client was sent.
+        with database.consistent_reads():
+            return f(user, *args, **kwargs)
+    return decorated_function
+
+
+def api_admin_required(f):
+    @wraps(f)
+    @api_login_required
+    def decorated_function(user, *args, **kwargs):
+        if user['role'] != 'admin':
+            return _error(403, "Admin role required")
+        return f(user, *args, **kwargs)
+    return decorated_function
+
+
+def _book(row):
+    return {'id': row['id'], 'title': row['title'], 'author': row['author'],
+            'category': row['category'], 'status': row.get('status', 'available')}
+
+
+def _limit(default, maximum=200):
+    return max(1, min(request.args.get('limit', default, type=int), maximum))
+
+
+@api.route("/books")
+@api_login_required
+def search_books(user):
+    """
+    Available books matching ?q= (all of them without it), best matches first, limited to
+    the ?category= ids given, with the number of available books in every category.
+    """
+    query = request.args.get('q') or None
+    categories = user_ops.category_ids(request.args.getlist('category'))
+    limit = _limit(user_ops.SEARCH_PAGE_SIZE)
+    offset = max(0, request.args.get('offset', 0, type=int))
+
+    def build():
+        books = user_ops.search_available_books(query, limit + 1, offset, categories)
+        return {'books': [_book(dict(row)) for row in books[:limit]],
+                'has_more': len(books) > limit,
+                'categories': [dict(facet) for facet in user_ops.category_facets()]}
+
+    return conditional_json(['books'], ('books', query, categories, limit, offset), build)
+
+
+@api.route("/books/<int:book_id>")
+@api_login_required
+def book_details(user, book_id):
+    def build():
+        book = admin_ops.get_book_details(book_id)
+        return {'book': dict(book) if book else None}
+
+    response = conditional_json(['books'], ('book', book_id), build)
+    if response.status_code == 200 and response.get_json()['book'] is None:
+        return _error(404, f"Book {book_id} not found")
+    return response
+
+
+@api.route("/me/history")
+@api_login_required
+def history(user):
+    """One page of the caller's borrowing history, newest first; follow 'next' for older loans."""
+    before = user_ops.decode_history_cursor(request.args.get('before'))
+    limit = _limit(user_ops.HISTORY_PAGE_SIZE)
+
+    def build():
+        rows, next_token = user_ops.view_borrowing_history(user['id'], before, limit)
+        return {'history': [dict(row) for row in rows], 'next': next_token}
+
+    return conditional_json(['transactions', 'books'], ('history', user['id'], before, limit), build)
+
+
+@api.route("/me/history/archived")
+@api_login_required
+def archived_history(user):
+    """
+    The caller's loans from archived partitions (see partitions.py), newest first. Slower than
+    /me/history: archive files are scanned on every request. Follow 'next' for older loans.
+    """
+    before = user_ops.decode_history_cursor(request.args.get('before'))
+    rows, next_token = partitions.archived_history(user['id'], before, _limit(user_ops.HISTORY_PAGE_SIZE))
+    response = Response(json.dumps({'history': rows, 'next': next_token}, default=str),
+                        mimetype='application/json')
+    response.headers['Cache-Control'] = 'private, max-age=300'
+    return response
+
+
+@api.route("/me/fines")
+@api_login_required
+def fines(user):
+    rows = [dict(row) for row in overdue.user_fines(user['id'])]
+    outstanding = sum(row['fine_cents'] for row in rows if row['returned_at'] is None)
+    return Response(json.dumps({'fines': rows, 'outstanding_cents': outstanding}, default=str),
+                    mimetype='application/json')
+
+
+@api.route("/admin/books")
+@api_admin_required
+def admin_books(user):
+    sort = request.args.get('sort', 'id')
+    if sort not in admin_ops.BOOK_SORT_COLUMNS:
+        sort = 'id'
+    descending = request.args.get('order') == 'desc'
+    after = request.args.get('after')
+    limit = _limit(admin_ops.ADMIN_PAGE_SIZE)
+
+    def build():
+        books, next_token = admin_ops.view_books_page(sort, descending, after, limit)
+        return {'books': [_book(row) for row in books], 'next': next_token}
+
+    return conditional_json(['books'], ('admin_books', sort, descending, after, limit), build)
+
+
+@api.route("/admin/transactions")
+@api_admin_required
+def admin_transactions(user):
+    after = request.args.get('after')
+    limit = _limit(admin_ops.ADMIN_PAGE_SIZE)
+
+    def build():
+        records, next_token = admin_ops.view_borrowing_records_page(after, limit)
+        return {'transactions': [dict(row) for row in records], 'next': next_token}
+
+    return conditional_json(['transactions', 'books'], ('admin_transactions', after, limit), build)
+
+
+@api.route("/admin/stats")
+@api_admin_required
+def admin_stats(user):
+    # Overdue counts move with the clock and views refresh on their own, so no validators here.
+    return Response(json.dumps(stats.circulation_summary(), default=str), mimetype='application/json')
@@ -1,53 +1,127 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from flask import (Flask, Response, jsonify, render_template, stream_template, request, redirect, url_for, flash,
+                   session, g, make_response, before_render_template, template_rendered)
 from functools import wraps
 import database
 import auth
 import user_operations as user_ops
 import admin_operations as admin_ops
+import bulk_operations as bulk_ops
+import partitions
+import stats
+import overdue
+import startup
+import cache
+import audit
+import metrics
+import http_cache
+import admission
+import statements
+from api import api
+import click
+import psycopg2
 import time
+from config import SECRET_KEY, ADMISSION_MAX_CONCURRENCY, DB_POOL_MAX
 
 app = Flask(__name__)
-app.secret_key = 'your_super_secret_key_for_dev'
+app.secret_key = SECRET_KEY
+app.register_blueprint(api)
+# Static URLs carry a content hash (see _static_cache_buster), so browsers may keep them for a year.
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = http_cache.STATIC_MAX_AGE
 
-# Ensure DB tables exist when the app module is imported (covers `flask run` and `python app.py`).
-# This runs once at startup unless SKIP_DB_INIT is set.
-import os
-import time
+# Bring the schema up to date once, when this module is imported (see startup.initialize).
+# Under gunicorn, preload_app in gunicorn.conf.py makes that the master process, before
+# any worker forks; set SKIP_DB_INIT to skip it.
+startup.initialize()
+
+# --- INSTRUMENTATION ---
+# Per-request timings and database usage, exposed on /metrics (see metrics.py).
+@app.before_request
+def _start_request_metrics():
+    metrics.start_request()
+
+@app.after_request
+def _record_response_status(response):
+    g.response_status = response.status_code
+    return response
+
+@app.teardown_request
+def _finish_request_metrics(error):
+    # Runs once the response has been sent, so streamed pages are timed in full.
+    status = 500 if error is not None else g.get('response_status', 500)
+    metrics.finish_request(request.endpoint, request.method, status)
+
+@before_render_template.connect_via(app)
+def _start_render_timer(sender, template, context, **extra):
+    g.render_started = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def _record_render_time(sender, template, context, **extra):
+    started = g.pop('render_started', None)
+    if started is not None:
+        metrics.observe_render(template.name, time.perf_counter() - started)
+
+# --- ADMISSION CONTROL ---
+# Requests past this worker's limit are answered 503 at once instead of queueing for a
+# pooled connection; login and signup are also rate-limited (see admission.py).
+request_limit = admission.ConcurrencyLimit('requests', ADMISSION_MAX_CONCURRENCY or DB_POOL_MAX)
+
+def _client_ip():
+    return admission.client_ip(request.remote_addr, request.headers.get('X-Forwarded-For'))
+
+def _retry_later(response, status, retry_after):
+    response = make_response(response, status)
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+@app.before_request
+def _admit_request():
+    if request.endpoint in admission.EXEMPT_ENDPOINTS:
+        return None
+    if not request_limit.try_enter():
+        return _retry_later("The library is busy right now. Please try again shortly.", 503,
+                            request_limit.retry_after)
+    g.admitted = True
 
-# At startup try to create DB tables, retrying until Postgres is available.
-# If SKIP_DB_INIT is set, skip this step (useful for tests or manual migrations).
-def ensure_db_init():
-    if os.getenv('SKIP_DB_INIT'):
-        print("↩️ SKIP_DB_INIT set — skipping DB initialization")
-        return
-
-    max_retries = int(os.getenv('MAX_DB_INIT_RETRIES', '12'))
-    delay = int(os.getenv('DB_INIT_RETRY_DELAY', '5'))
-
-    print(f"🗃️ Ensuring DB tables exist (will retry up to {max_retries} times)...")
-    attempt = 0
-    while attempt < max_retries:
-        attempt += 1
-        try:
-            database.create_tables()
-            print("🟢 DB tables ensured")
-            return
-        except Exception as e:
-            print(f"⚠️ DB init attempt {attempt}/{max_retries} failed: {e}")
-            if attempt >= max_retries:
-                print("❌ Exhausted DB init retries — exiting to let Kubernetes restart the pod")
-                # Exit with non-zero so the pod is marked failed and can be restarted
-                raise
-            time.sleep(delay)
-
-# Run DB init at import time so it runs under both `flask run` and `python app.py`.
-ensure_db_init()
+@app.teardown_request
+def _release_request(error):
+    if g.pop('admitted', False):
+        request_limit.leave()
+
+# --- HTTP CACHING AND COMPRESSION ---
+@app.url_defaults
+def _static_cache_buster(endpoint, values):
+    if endpoint == 'static' and 'filename' in values:
+        version = http_cache.static_version(app.static_folder, values['filename'])
+        if version:
+            values['v'] = version
+
+@app.after_request
+def _compress(response):
+    return http_cache.compress_response(response)
+
+# --- READ ROUTING ---
+# Read-your-writes across workers and pods: the window opened by a borrow or return is kept
+# in the session cookie, so the user's next reads go to the primary wherever they land.
+@app.before_request
+def _restore_read_your_writes():
+    database.pin_reads_until(session.get('primary_reads_until'))
+
+@app.after_request
+def _save_read_your_writes(response):
+    until = database.reads_pinned_until()
+    if until > time.time() and session.get('primary_reads_until') != until:
+        session['primary_reads_until'] = until
+    return response
 
 # --- DECORATORS ---
+def _current_user():
+    """Returns the logged-in user's current record, or None (see auth.session_user)."""
+    return auth.session_user(session)
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
+        if _current_user() is None:
             flash("Please log in to access this page.", "danger")
             return redirect(url_for('welcome'))
         return f(*args, **kwargs)
@@ -56,10 +130,11 @@ def login_required(f):
 def admin_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
+        user = _current_user()
+        if user is None:
             flash("Please log in to access this page.", "danger")
             return redirect(url_for('welcome'))
-        if session.get('role') != 'admin':
+        if user['role'] != 'admin':
             flash("You do not have permission to access this page.", "danger")
             return redirect(url_for('user_dashboard'))
         return f(*args, **kwargs)
@@ -79,18 +154,24 @@ def welcome():
 def login():
     username = request.form.get("username")
     password = request.form.get("password")
-    role = auth.login(username, password)
-    if role:
-        user_id = auth.get_user_id(username)
-        session['user_id'] = user_id
-        session['username'] = username
+    retry_after = admission.check_login(_client_ip(), username)
+    if retry_after:
+        flash(f"Too many login attempts. Please try again in {retry_after} seconds.", "danger")
+        return _retry_later(render_template("welcome.html"), 429, retry_after)
+    user = auth.authenticate(username, password)
+    if user:
+        role = user['role']
+        session['user_id'] = user['id']
+        session['username'] = user['username']
         session['role'] = role
+        audit.record("Login", f"{username} logged in from {_client_ip()}")
         flash(f"Welcome back, {username}!", "success")
         if role == 'admin':
             return redirect(url_for('admin_dashboard'))
         else:
             return redirect(url_for('user_dashboard'))
     else:
+        audit.record("Login Failed", f"Failed login for {username} from {_client_ip()}")
         flash("Invalid credentials. Please try again.", "danger")
         return redirect(url_for('welcome'))
 
@@ -98,6 +179,10 @@ def login():
 def signup():
     username = request.form.get("username")
     password = request.form.get("password")
+    retry_after = admission.check_signup(_client_ip())
+    if retry_after:
+        flash(f"Too many sign-ups from your network. Please try again in {retry_after} seconds.", "danger")
+        return _retry_later(render_template("welcome.html"), 429, retry_after)
     if auth.signup(username, password):
         flash("Account created successfully! Please log in.", "success")
     else:
@@ -116,28 +201,59 @@ def logout():
 def user_dashboard():
     search_query = request.args.get('search', None)
     show_all = request.args.get('show_all', 'false')
-    
-    available_books = []
-    if search_query:
-        available_books = user_ops.search_available_books(search_query)
-    elif show_all == 'true':
-        available_books = user_ops.search_available_books() # No query fetches all
+    books_page = request.args.get('page', 1, type=int)
+    history_before = user_ops.decode_history_cursor(request.args.get('history_before'))
+    categories = user_ops.category_ids(request.args.getlist('category'))
 
-    borrowing_history = user_ops.view_borrowing_history(session['user_id'])
+    # One connection, one round trip for both the book list and the history page.
+    dashboard = user_ops.load_dashboard(session['user_id'],
+                                        query=search_query,
+                                        show_all=(show_all == 'true'),
+                                        books_page=books_page,
+                                        history_before=history_before,
+                                        categories=categories)
     return render_template("user_dashboard.html",
-                           available_books=available_books,
-                           history=borrowing_history,
+                           available_books=dashboard['available_books'],
+                           books_page=books_page,
+                           has_more_books=dashboard['has_more_books'],
+                           category_facets=dashboard['category_facets'],
+                           categories=categories,
+                           history=dashboard['history'],
+                           history_next=dashboard['history_next'],
+                           history_paged=history_before is not None,
+                           show_all=show_all,
                            search_query=search_query) # Pass query back to template
 
 # --- ADMIN DASHBOARD ROUTE ---
 @app.route("/admin")
 @admin_required
 def admin_dashboard():
-    all_books = admin_ops.view_all_books()
-    all_transactions = admin_ops.view_all_borrowing_records()
+    sort = request.args.get('sort', 'id')
+    if sort not in admin_ops.BOOK_SORT_COLUMNS:
+        sort = 'id'
+    order = 'desc' if request.args.get('order') == 'desc' else 'asc'
+
+    if request.args.get('stream') == '1':
+        # Rows are pulled from server-side cursors while the page is being sent,
+        # so worker memory stays bounded however large the tables are.
+        # stream_template renders inside stream_with_context to keep the request context alive.
+        return Response(stream_template("admin_dashboard.html",
+                                        all_books=admin_ops.iter_all_books(sort, order == 'desc'),
+                                        transactions=admin_ops.iter_all_borrowing_records(),
+                                        streaming=True,
+                                        sort=sort,
+                                        order=order))
+
+    all_books, books_next = admin_ops.view_books_page(sort, order == 'desc', request.args.get('books_after'))
+    all_transactions, transactions_next = admin_ops.view_borrowing_records_page(request.args.get('tx_after'))
     return render_template("admin_dashboard.html",
                            all_books=all_books,
-                           transactions=all_transactions)
+                           books_next=books_next,
+                           transactions=all_transactions,
+                           transactions_next=transactions_next,
+                           streaming=False,
+                           sort=sort,
+                           order=order)
 
 # --- ACTION ROUTES (Processing Forms) ---
 
@@ -150,6 +266,7 @@ def borrow():
     try:
         days = int(days_str)
         if user_ops.borrow_book(session['user_id'], session['username'], book_id, days):
+            audit.record("Borrow", f"{session['username']} borrowed book {book_id} for {days} days")
             flash("Book borrowed successfully!", "success")
         else:
             flash("Failed to borrow book. It may be unavailable.", "danger")
@@ -162,11 +279,104 @@ def borrow():
 def return_book():
     book_id = request.form.get("book_id")
     if user_ops.return_book(session['user_id'], book_id):
+        audit.record("Return", f"{session['username']} returned book {book_id}")
         flash("Book returned successfully!", "success")
     else:
         flash("Failed to return book. Check if the ID is correct.", "danger")
     return redirect(url_for('user_dashboard'))
 
+# --- BATCH ROUTES ---
+# Each batch is a single set-based statement, so a whole cart costs one round trip.
+
+def _book_ids_from_form():
+    """Reads book IDs from repeated book_ids fields and/or a comma- or space-separated list."""
+    values = request.form.getlist("book_ids") + request.form.get("book_id_list", "").replace(",", " ").split()
+    return user_ops.batch_book_ids(values)
+
+def _flash_batch(results, success, verb):
+    done = [str(book_id) for book_id, outcome in results.items() if outcome == success]
+    failed = {book_id: outcome for book_id, outcome in results.items() if outcome != success}
+    if done:
+        flash(f"{verb} {len(done)} book{'s' if len(done) != 1 else ''}: {', '.join(done)}.", "success")
+    if failed:
+        details = ', '.join(f"{book_id} ({outcome.replace('_', ' ')})" for book_id, outcome in failed.items())
+        flash(f"Not {verb.lower()}: {details}.", "danger")
+    if not results:
+        flash("Please choose at least one book.", "danger")
+    return done
+
+@app.route("/borrow_batch", methods=["POST"])
+@login_required
+def borrow_batch():
+    try:
+        days = int(request.form.get("days_to_borrow"))
+        results = user_ops.borrow_books(session['user_id'], session['username'], _book_ids_from_form(), days)
+    except (ValueError, TypeError) as e:
+        flash(f"Invalid batch: {e}", "danger")
+        return redirect(url_for('user_dashboard'))
+    done = _flash_batch(results, 'borrowed', "Borrowed")
+    if done:
+        audit.record("Borrow", f"{session['username']} borrowed books {', '.join(done)} for {days} days")
+    return redirect(url_for('user_dashboard'))
+
+@app.route("/return_batch", methods=["POST"])
+@login_required
+def return_batch():
+    try:
+        results = user_ops.return_books(session['user_id'], _book_ids_from_form())
+    except (ValueError, TypeError) as e:
+        flash(f"Invalid batch: {e}", "danger")
+        return redirect(url_for('user_dashboard'))
+    done = _flash_batch(results, 'returned', "Returned")
+    if done:
+        audit.record("Return", f"{session['username']} returned books {', '.join(done)}")
+    return redirect(url_for('user_dashboard'))
+
+@app.route("/admin/checkin_books", methods=["POST"])
+@admin_required
+def checkin_books():
+    try:
+        results = user_ops.return_books(None, _book_ids_from_form())
+    except (ValueError, TypeError) as e:
+        flash(f"Invalid batch: {e}", "danger")
+        return redirect(url_for('admin_dashboard'))
+    done = _flash_batch(results, 'returned', "Checked in")
+    if done:
+        audit.record("Check In", f"{session['username']} checked in books {', '.join(done)}")
+    return redirect(url_for('admin_dashboard'))
+
+@app.route("/admin/update_books", methods=["POST"])
+@admin_required
+def update_books():
+    changes = {field: request.form[field] for field in ('title', 'author', 'category')
+               if request.form.get(field)}
+    if not changes:
+        flash("Enter at least one field to change.", "danger")
+        return redirect(url_for('admin_dashboard'))
+    try:
+        results = admin_ops.update_books(_book_ids_from_form(), changes)
+    except (ValueError, TypeError) as e:
+        flash(f"Invalid batch: {e}", "danger")
+        return redirect(url_for('admin_dashboard'))
+    done = _flash_batch(results, 'updated', "Updated")
+    if done:
+        summary = ', '.join(f"{field} to '{value}'" for field, value in changes.items())
+        audit.record("Update Book", f"{session['username']} set {summary} on books {', '.join(done)}")
+    return redirect(url_for('admin_dashboard'))
+
+@app.route("/admin/delete_books", methods=["POST"])
+@admin_required
+def delete_books():
+    try:
+        results = admin_ops.delete_books(_book_ids_from_form())
+    except (ValueError, TypeError) as e:
+        flash(f"Invalid batch: {e}", "danger")
+        return redirect(url_for('admin_dashboard'))
+    done = _flash_batch(results, 'deleted', "Deleted")
+    if done:
+        audit.record("Delete Book", f"{session['username']} deleted books {', '.join(done)}")
+    return redirect(url_for('admin_dashboard'))
+
 @app.route("/add_book", methods=["POST"])
 @admin_required
 def add_book():
@@ -174,6 +384,7 @@ def add_book():
     author = request.form.get("author")
     category = request.form.get("category")
     admin_ops.add_book(title, author, category)
+    audit.record("Add Book", f"{session['username']} added '{title}' by {author}")
     flash("New book added successfully!", "success")
     return redirect(url_for('admin_dashboard'))
 
@@ -185,6 +396,7 @@ def update_book():
     new_value = request.form.get("new_value")
     # UPDATED to handle failure
     if admin_ops.update_book_field(book_id, field, new_value):
+         audit.record("Update Book", f"{session['username']} set {field} of book {book_id} to '{new_value}'")
          flash(f"Book ID {book_id} was updated successfully!", "success")
     else:
          flash(f"Update failed. Book with ID {book_id} not found.", "danger")
@@ -196,6 +408,7 @@ def delete_book():
     book_id = request.form.get("book_id")
     # UPDATED to handle failure
     if admin_ops.delete_book(book_id):
+        audit.record("Delete Book", f"{session['username']} deleted book {book_id}")
         flash(f"Book ID {book_id} has been deleted.", "success")
     else:
         flash(f"Delete failed. Book with ID {book_id} not found.", "danger")
@@ -209,20 +422,213 @@ def create_user():
     password = request.form.get("password")
     role = request.form.get("role")
     if admin_ops.create_user(username, password, role):
+        audit.record("Create User", f"{session['username']} created {role} account {username}")
         flash(f"Account for {username} created successfully.", "success")
     else:
         flash("Failed to create account. Username may be taken.", "danger")
     return redirect(url_for('admin_dashboard'))
 
-if __name__ == "__main__":
-    # Give PostgreSQL time to start
+@app.route("/update_user_role", methods=["POST"])
+@admin_required
+def update_user_role():
+    username = request.form.get("username")
+    role = request.form.get("role")
+    if admin_ops.update_user_role(username, role):
+        audit.record("Change Role", f"{session['username']} made {username} a{'n' if role == 'admin' else ''} {role}")
+        flash(f"{username} is now a{'n' if role == 'admin' else ''} {role}.", "success")
+    else:
+        flash(f"Role change failed. User {username} not found.", "danger")
+    return redirect(url_for('admin_dashboard'))
 
-    print("⏳ Waiting for database connection...")
-    time.sleep(10)
-    
-    # Create tables
-    print("🗃️ Creating database tables...")
-    database.create_tables()
-    
+@app.route("/admin/stats")
+@admin_required
+def admin_stats():
+    return render_template("admin_stats.html", stats=stats.circulation_summary())
+
+@app.route("/admin/stats/refresh", methods=["POST"])
+@admin_required
+def refresh_stats():
+    timings = stats.refresh_views()
+    flash(f"Statistics refreshed in {sum(timings.values()):.1f}s.", "success")
+    return redirect(url_for('admin_stats'))
+
+@app.route("/admin/cache_stats")
+@admin_required
+def cache_stats():
+    """Hit, miss and eviction counters for this worker's caches, connection pool and hot statements."""
+    return jsonify(catalogue=cache.catalogue_cache.snapshot(),
+                   users=auth.cache_stats(),
+                   audit=audit.stats(),
+                   pool=database.pool_stats(),
+                   replicas=database.replica_stats(),
+                   statements=statements.stats())
+
+# --- PROBES ---
+
+@app.route("/healthz")
+def healthz():
+    """Liveness probe: answers as long as the worker can serve requests."""
+    return jsonify(startup.health())
+
+@app.route("/readyz")
+def readyz():
+    """Readiness probe: 200 once the database answers and the schema is current, 503 otherwise."""
+    ready, detail = startup.readiness()
+    response = jsonify(ready=ready, detail=detail)
+    response.status_code = 200 if ready else 503
+    return response
+
+@app.route("/metrics")
+def prometheus_metrics():
+    """Route, render and per-statement timings plus pool, cache and audit counters, for Prometheus."""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+def metrics_snapshots():
+    """Pool, cache, audit, admission and start-up counters exported as gauges on /metrics."""
+    return {'lms_pool': database.pool_stats(),
+            'lms_catalogue_cache': cache.catalogue_cache.snapshot(),
+            'lms_user_cache': auth.cache_stats(),
+            'lms_audit': audit.stats(),
+            'lms_replicas': database.replica_stats(),
+            'lms_admission': dict(admission.stats(), **request_limit.snapshot()),
+            'lms_startup': startup.timings}
+
+metrics.set_snapshot_source(metrics_snapshots)
+
+# --- BULK CATALOGUE IMPORT / EXPORT ---
+
+def _import_format(filename):
+    """Picks the import format from a file name: JSON Lines for .jsonl/.ndjson, CSV otherwise."""
+    return 'jsonl' if filename.lower().endswith(('.jsonl', '.ndjson')) else 'csv'
+
+@app.route("/admin/import_books", methods=["POST"])
+@admin_required
+def import_books():
+    upload = request.files.get("file")
+    if not upload or not upload.filename:
+        flash("Please choose a CSV or JSON Lines file to import.", "danger")
+        return redirect(url_for('admin_dashboard'))
+    try:
+        result = bulk_ops.import_books(upload.stream, _import_format(upload.filename))
+    except (ValueError, psycopg2.Error) as e:
+        flash(f"Import failed: {e}", "danger")
+        return redirect(url_for('admin_dashboard'))
+    audit.record("Import Books", f"{session['username']} imported {result['imported']} books from {upload.filename}")
+    flash(f"Imported {result['imported']} books ({result['skipped']} duplicates or blank rows skipped).", "success")
+    return redirect(url_for('admin_dashboard'))
+
+@app.route("/admin/export/<name>.csv")
+@admin_required
+def export_csv(name):
+    if name not in bulk_ops.EXPORTS:
+        flash(f"Unknown export: {name}", "danger")
+        return redirect(url_for('admin_dashboard'))
+    return Response(bulk_ops.stream_export(name), mimetype="text/csv",
+                    headers={"Content-Disposition": f"attachment; filename={name}.csv"})
+
+@app.cli.command("import-books")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(["csv", "jsonl"]), default=None,
+              help="Input format (guessed from the file extension by default).")
+def import_books_command(path, fmt):
+    """Bulk-load books from a CSV or JSON Lines file."""
+    with open(path, "rb") as f:
+        result = bulk_ops.import_books(f, fmt or _import_format(path))
+    click.echo(f"Staged {result['staged']} rows, imported {result['imported']}, skipped {result['skipped']}.")
+
+@app.cli.command("export")
+@click.argument("name", type=click.Choice(sorted(bulk_ops.EXPORTS)))
+@click.argument("output", type=click.File("wb"), default="-")
+def export_command(name, output):
+    """Stream the books or transactions table out as CSV (to stdout by default)."""
+    bulk_ops.export_csv(name, output)
+
+@app.cli.command("compact")
+def compact_command():
+    """Compress large, idle files under COMPACTION_ROOT (see compaction.py)."""
+    # Always waits: the job runs on a daemon thread, which would die with this process.
+    for alert in admin_ops.disk_usage_alert_system(wait=True):
+        click.echo(alert)
+
+@app.cli.command("maintain-partitions")
+@click.option("--months-ahead", type=int, default=partitions.TRANSACTIONS_PARTITIONS_AHEAD, show_default=True)
+@click.option("--archive-after-months", type=int, default=partitions.TRANSACTIONS_ARCHIVE_AFTER_MONTHS,
+              show_default=True, help="0 skips archiving.")
+@click.option("--dest", default=partitions.TRANSACTIONS_ARCHIVE_DIR, show_default=True,
+              help="Directory or s3://bucket/prefix URL for archived partitions.")
+def maintain_partitions_command(months_ahead, archive_after_months, dest):
+    """Create upcoming transactions partitions and archive old, fully returned ones."""
+    created, archived = partitions.maintain(months_ahead, archive_after_months, dest)
+    click.echo(f"Created {created} partitions.")
+    for entry in archived:
+        click.echo(f"Archived {entry['partition']} ({entry['rows']} loans) to {entry['path']}.")
+
+@app.cli.command("refresh-stats")
+def refresh_stats_command():
+    """Refresh the circulation statistics materialized views."""
+    for view, seconds in stats.refresh_views().items():
+        click.echo(f"Refreshed {view} in {seconds:.2f}s.")
+
+@app.cli.command("rebuild-stats")
+def rebuild_stats_command():
+    """Recompute the circulation counters and views from the raw tables, then verify them."""
+    stats.rebuild_counters()
+    stats.refresh_views()
+    verify_stats_command.callback()
+
+@app.cli.command("verify-stats")
+def verify_stats_command():
+    """Check the circulation counters against the raw tables; exits 1 on any mismatch."""
+    mismatches = stats.verify_counters()
+    for m in mismatches:
+        click.echo(f"{m['counter']} [{m['category']}]: counter says {m['actual']}, tables say {m['expected']}")
+    if mismatches:
+        raise SystemExit(1)
+    click.echo("Circulation counters match the tables.")
+
+@app.cli.command("overdue-worker")
+@click.option("--once", is_flag=True, help="Run a single scan and exit.")
+@click.option("--interval", type=float, default=overdue.OVERDUE_SCAN_INTERVAL, show_default=True,
+              help="Seconds between scans.")
+@click.option("--notify", default=overdue.OVERDUE_NOTIFY, show_default=True,
+              help='"log", "file:/path", "smtp://host:port" or "none".')
+def overdue_worker_command(once, interval, notify):
+    """Flag overdue loans, accrue fines and send notices (see overdue.py)."""
+    overdue.run_worker(interval, overdue.make_sink(notify), once)
+
+@app.cli.command("explain-statements")
+@click.option("--generic", is_flag=True, help="Show the generic plans prepared statements settle on.")
+@click.option("--allow-seq-scan", multiple=True, metavar="TABLE",
+              help="A table the plans may read with a sequential scan (repeatable).")
+def explain_statements_command(generic, allow_seq_scan):
+    """EXPLAIN every hot statement (see statements.py); exits 1 on errors or unexpected sequential scans."""
+    failures = 0
+    # A dedicated connection, so the statements prepared for EXPLAIN never reach the pool.
+    conn = database.connect()
+    try:
+        with conn.cursor() as cursor:
+            for statement in statements.load_all().values():
+                click.echo(f"--- {statement.name}")
+                try:
+                    plan, seq_scans = statements.explain(cursor, statement, generic)
+                except psycopg2.Error as e:
+                    conn.rollback()
+                    failures += 1
+                    click.echo(f"❌ {str(e).strip()}")
+                    continue
+                conn.rollback()
+                click.echo(plan)
+                unexpected = [table for table in seq_scans if table not in allow_seq_scan]
+                if unexpected:
+                    failures += 1
+                    click.echo(f"❌ Sequential scan on {', '.join(unexpected)}")
+    finally:
+        conn.close()
+    if failures:
+        raise SystemExit(1)
+    click.echo(f"Explained {len(statements.STATEMENTS)} statements.")
+
+if __name__ == "__main__":
+    # The schema was brought up to date when this module was imported.
     print("🚀 Starting Flask application...")
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    app.run(debug=True, host='0.0.0.0', port=5000)
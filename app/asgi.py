@@ -0,0 +1,496 @@
+# asgi.py
+"""
+Async serving mode: an ASGI entry point backed by asyncpg, served with
+`gunicorn --config gunicorn_asgi.conf.py asgi:app` (see gunicorn_asgi.conf.py).
+
+Login, the user dashboard, borrowing and returning, and the admin dashboard and book and
+user management are async views here; while one of them waits on PostgreSQL the worker
+serves other requests, so a slow query no longer holds up every user of the process.
+Everything else (statistics, import and export, the JSON API, probes and metrics) is
+dispatched to the sync Flask app in app.py on a small thread pool. Both apps share the
+templates, the session cookie and the caches, so the site behaves the same either way.
+"""
+
+import asyncio
+import time
+from functools import wraps
+
+import asyncpg
+from a2wsgi import WSGIMiddleware
+from quart import (Quart, Response, abort, flash, g, make_response, redirect, render_template, request, session,
+                   stream_template, url_for)
+from quart.wrappers.response import DataBody
+from werkzeug.exceptions import HTTPException
+
+import app as sync_app
+import async_database as adb
+import async_operations as async_ops
+import admin_operations as admin_ops
+import user_operations as user_ops
+import audit
+import database
+import http_cache
+import admission
+import metrics
+import startup
+from config import SECRET_KEY, ASYNC_SYNC_THREADS, ADMISSION_MAX_CONCURRENCY, ASYNC_POOL_MAX
+
+web = Quart(__name__)
+web.secret_key = SECRET_KEY
+web.config['SEND_FILE_MAX_AGE_DEFAULT'] = http_cache.STATIC_MAX_AGE
+
+@web.before_serving
+async def _open_pool():
+    # Opened before the first request, as startup.after_fork does for the sync pool.
+    try:
+        await adb.open_pool()
+    except (OSError, asyncio.TimeoutError, asyncpg.PostgresError) as e:
+        print(f"⚠️ Could not open the async connection pool: {e}")
+
+@web.after_serving
+async def _close_pool():
+    await adb.close_pool()
+
+# --- INSTRUMENTATION ---
+@web.before_request
+async def _start_request_metrics():
+    metrics.start_request()
+
+@web.after_request
+async def _record_response_status(response):
+    g.response_status = response.status_code
+    return response
+
+@web.teardown_request
+async def _finish_request_metrics(error):
+    status = 500 if error is not None else g.get('response_status', 500)
+    metrics.finish_request(request.endpoint, request.method, status)
+
+# --- ADMISSION CONTROL ---
+# Async views draw on the asyncpg pool, so they get their own limit; requests dispatched to
+# the sync app pass through app.py's (see admission.py).
+request_limit = admission.ConcurrencyLimit('async_requests', ADMISSION_MAX_CONCURRENCY or ASYNC_POOL_MAX)
+
+def _client_ip():
+    return admission.client_ip(request.remote_addr, request.headers.get('X-Forwarded-For'))
+
+async def _retry_later(response, status, retry_after):
+    response = await make_response(response, status)
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+@web.before_request
+async def _admit_request():
+    if request.endpoint in admission.EXEMPT_ENDPOINTS:
+        return None
+    if not request_limit.try_enter():
+        return await _retry_later("The library is busy right now. Please try again shortly.", 503,
+                                  request_limit.retry_after)
+    g.admitted = True
+
+@web.teardown_request
+async def _release_request(error):
+    if g.pop('admitted', False):
+        request_limit.leave()
+
+# --- HTTP CACHING AND COMPRESSION ---
+@web.url_defaults
+def _static_cache_buster(endpoint, values):
+    if endpoint == 'static' and 'filename' in values:
+        version = http_cache.static_version(web.static_folder, values['filename'])
+        if version:
+            values['v'] = version
+
+@web.after_request
+async def _compress(response):
+    # The async counterpart of http_cache.compress_response.
+    # Only in-memory bodies are compressed; files and streamed pages are sent as they are.
+    if (not isinstance(response.response, DataBody) or response.status_code < 200 or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in http_cache.COMPRESSIBLE_TYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = http_cache.preferred_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+    body = await response.get_data()
+    if len(body) < http_cache.COMPRESS_MIN_SIZE:
+        return response
+    response.set_data(http_cache.encode_body(body, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+# --- READ ROUTING ---
+# Writes made here keep the user's reads on the primary in routes served by the sync app.
+@web.before_request
+async def _restore_read_your_writes():
+    database.pin_reads_until(session.get('primary_reads_until'))
+
+@web.after_request
+async def _save_read_your_writes(response):
+    until = database.reads_pinned_until()
+    if until > time.time() and session.get('primary_reads_until') != until:
+        session['primary_reads_until'] = until
+    return response
+
+# --- DECORATORS ---
+def login_required(f):
+    @wraps(f)
+    async def decorated_function(*args, **kwargs):
+        if await async_ops.session_user(session) is None:
+            await flash("Please log in to access this page.", "danger")
+            return redirect(url_for('welcome'))
+        return await f(*args, **kwargs)
+    return decorated_function
+
+def admin_required(f):
+    @wraps(f)
+    async def decorated_function(*args, **kwargs):
+        user = await async_ops.session_user(session)
+        if user is None:
+            await flash("Please log in to access this page.", "danger")
+            return redirect(url_for('welcome'))
+        if user['role'] != 'admin':
+            await flash("You do not have permission to access this page.", "danger")
+            return redirect(url_for('user_dashboard'))
+        return await f(*args, **kwargs)
+    return decorated_function
+
+# --- AUTHENTICATION ROUTES ---
+@web.route("/")
+async def welcome():
+    if 'user_id' in session:
+        if session.get('role') == 'admin':
+            return redirect(url_for('admin_dashboard'))
+        return redirect(url_for('user_dashboard'))
+    return await render_template("welcome.html")
+
+@web.route("/login", methods=["POST"])
+async def login():
+    form = await request.form
+    username = form.get("username")
+    password = form.get("password")
+    # The rate-limit buckets may live in Redis (ADMISSION_REDIS_URL): keep the call off the event loop.
+    retry_after = await asyncio.to_thread(admission.check_login, _client_ip(), username)
+    if retry_after:
+        await flash(f"Too many login attempts. Please try again in {retry_after} seconds.", "danger")
+        return await _retry_later(await render_template("welcome.html"), 429, retry_after)
+    user = await async_ops.authenticate(username, password)
+    if user:
+        session['user_id'] = user['id']
+        session['username'] = user['username']
+        session['role'] = user['role']
+        audit.record("Login", f"{username} logged in from {_client_ip()}")
+        await flash(f"Welcome back, {username}!", "success")
+        return redirect(url_for('admin_dashboard' if user['role'] == 'admin' else 'user_dashboard'))
+    audit.record("Login Failed", f"Failed login for {username} from {_client_ip()}")
+    await flash("Invalid credentials. Please try again.", "danger")
+    return redirect(url_for('welcome'))
+
+@web.route("/signup", methods=["POST"])
+async def signup():
+    form = await request.form
+    retry_after = await asyncio.to_thread(admission.check_signup, _client_ip())
+    if retry_after:
+        await flash(f"Too many sign-ups from your network. Please try again in {retry_after} seconds.", "danger")
+        return await _retry_later(await render_template("welcome.html"), 429, retry_after)
+    if await async_ops.signup(form.get("username"), form.get("password")):
+        await flash("Account created successfully! Please log in.", "success")
+    else:
+        await flash("Username already exists. Please choose another.", "danger")
+    return redirect(url_for('welcome'))
+
+@web.route("/logout")
+async def logout():
+    session.clear()
+    await flash("You have been successfully logged out.", "info")
+    return redirect(url_for('welcome'))
+
+# --- USER DASHBOARD ---
+@web.route("/dashboard")
+@login_required
+async def user_dashboard():
+    search_query = request.args.get('search', None)
+    show_all = request.args.get('show_all', 'false')
+    books_page = request.args.get('page', 1, type=int)
+    history_before = user_ops.decode_history_cursor(request.args.get('history_before'))
+    categories = user_ops.category_ids(request.args.getlist('category'))
+    dashboard = await async_ops.load_dashboard(session['user_id'],
+                                               query=search_query,
+                                               show_all=(show_all == 'true'),
+                                               books_page=books_page,
+                                               history_before=history_before,
+                                               categories=categories)
+    return await render_template("user_dashboard.html",
+                                 available_books=dashboard['available_books'],
+                                 books_page=books_page,
+                                 has_more_books=dashboard['has_more_books'],
+                                 category_facets=dashboard['category_facets'],
+                                 categories=categories,
+                                 history=dashboard['history'],
+                                 history_next=dashboard['history_next'],
+                                 history_paged=history_before is not None,
+                                 show_all=show_all,
+                                 search_query=search_query)
+
+# --- ADMIN DASHBOARD ---
+@web.route("/admin")
+@admin_required
+async def admin_dashboard():
+    sort = request.args.get('sort', 'id')
+    if sort not in admin_ops.BOOK_SORT_COLUMNS:
+        sort = 'id'
+    order = 'desc' if request.args.get('order') == 'desc' else 'asc'
+
+    if request.args.get('stream') == '1':
+        # Rows come from server-side cursors while the page is being sent.
+        return Response(await stream_template("admin_dashboard.html",
+                                              all_books=async_ops.iter_all_books(sort, order == 'desc'),
+                                              transactions=async_ops.iter_all_borrowing_records(),
+                                              streaming=True,
+                                              sort=sort,
+                                              order=order))
+
+    all_books, books_next = await async_ops.view_books_page(sort, order == 'desc', request.args.get('books_after'))
+    all_transactions, transactions_next = await async_ops.view_borrowing_records_page(request.args.get('tx_after'))
+    return await render_template("admin_dashboard.html",
+                                 all_books=all_books,
+                                 books_next=books_next,
+                                 transactions=all_transactions,
+                                 transactions_next=transactions_next,
+                                 streaming=False,
+                                 sort=sort,
+                                 order=order)
+
+# --- ACTION ROUTES ---
+@web.route("/borrow", methods=["POST"])
+@login_required
+async def borrow():
+    form = await request.form
+    try:
+        book_id = int(form.get("book_id"))
+    except (ValueError, TypeError):
+        await flash("Invalid book ID.", "danger")
+        return redirect(url_for('user_dashboard'))
+    try:
+        days = int(form.get("days_to_borrow"))
+    except (ValueError, TypeError):
+        await flash("Invalid number of days.", "danger")
+        return redirect(url_for('user_dashboard'))
+    if await async_ops.borrow_book(session['user_id'], session['username'], book_id, days):
+        audit.record("Borrow", f"{session['username']} borrowed book {book_id} for {days} days")
+        await flash("Book borrowed successfully!", "success")
+    else:
+        await flash("Failed to borrow book. It may be unavailable.", "danger")
+    return redirect(url_for('user_dashboard'))
+
+@web.route("/return", methods=["POST"])
+@login_required
+async def return_book():
+    book_id = (await request.form).get("book_id")
+    if await async_ops.return_book(session['user_id'], book_id):
+        audit.record("Return", f"{session['username']} returned book {book_id}")
+        await flash("Book returned successfully!", "success")
+    else:
+        await flash("Failed to return book. Check if the ID is correct.", "danger")
+    return redirect(url_for('user_dashboard'))
+
+# --- BATCH ROUTES ---
+def _book_ids_from_form(form):
+    values = form.getlist("book_ids") + form.get("book_id_list", "").replace(",", " ").split()
+    return user_ops.batch_book_ids(values)
+
+async def _flash_batch(results, success, verb):
+    done = [str(book_id) for book_id, outcome in results.items() if outcome == success]
+    failed = {book_id: outcome for book_id, outcome in results.items() if outcome != success}
+    if done:
+        await flash(f"{verb} {len(done)} book{'s' if len(done) != 1 else ''}: {', '.join(done)}.", "success")
+    if failed:
+        details = ', '.join(f"{book_id} ({outcome.replace('_', ' ')})" for book_id, outcome in failed.items())
+        await flash(f"Not {verb.lower()}: {details}.", "danger")
+    if not results:
+        await flash("Please choose at least one book.", "danger")
+    return done
+
+@web.route("/borrow_batch", methods=["POST"])
+@login_required
+async def borrow_batch():
+    form = await request.form
+    try:
+        days = int(form.get("days_to_borrow"))
+        results = await async_ops.borrow_books(session['user_id'], session['username'],
+                                               _book_ids_from_form(form), days)
+    except (ValueError, TypeError) as e:
+        await flash(f"Invalid batch: {e}", "danger")
+        return redirect(url_for('user_dashboard'))
+    done = await _flash_batch(results, 'borrowed', "Borrowed")
+    if done:
+        audit.record("Borrow", f"{session['username']} borrowed books {', '.join(done)} for {days} days")
+    return redirect(url_for('user_dashboard'))
+
+@web.route("/return_batch", methods=["POST"])
+@login_required
+async def return_batch():
+    try:
+        results = await async_ops.return_books(session['user_id'], _book_ids_from_form(await request.form))
+    except (ValueError, TypeError) as e:
+        await flash(f"Invalid batch: {e}", "danger")
+        return redirect(url_for('user_dashboard'))
+    done = await _flash_batch(results, 'returned', "Returned")
+    if done:
+        audit.record("Return", f"{session['username']} returned books {', '.join(done)}")
+    return redirect(url_for('user_dashboard'))
+
+@web.route("/admin/checkin_books", methods=["POST"])
+@admin_required
+async def checkin_books():
+    try:
+        results = await async_ops.return_books(None, _book_ids_from_form(await request.form))
+    except (ValueError, TypeError) as e:
+        await flash(f"Invalid batch: {e}", "danger")
+        return redirect(url_for('admin_dashboard'))
+    done = await _flash_batch(results, 'returned', "Checked in")
+    if done:
+        audit.record("Check In", f"{session['username']} checked in books {', '.join(done)}")
+    return redirect(url_for('admin_dashboard'))
+
+@web.route("/admin/update_books", methods=["POST"])
+@admin_required
+async def update_books():
+    form = await request.form
+    changes = {field: form[field] for field in ('title', 'author', 'category') if form.get(field)}
+    if not changes:
+        await flash("Enter at least one field to change.", "danger")
+        return redirect(url_for('admin_dashboard'))
+    try:
+        results = await async_ops.update_books(_book_ids_from_form(form), changes)
+    except (ValueError, TypeError) as e:
+        await flash(f"Invalid batch: {e}", "danger")
+        return redirect(url_for('admin_dashboard'))
+    done = await _flash_batch(results, 'updated', "Updated")
+    if done:
+        summary = ', '.join(f"{field} to '{value}'" for field, value in changes.items())
+        audit.record("Update Book", f"{session['username']} set {summary} on books {', '.join(done)}")
+    return redirect(url_for('admin_dashboard'))
+
+@web.route("/admin/delete_books", methods=["POST"])
+@admin_required
+async def delete_books():
+    try:
+        results = await async_ops.delete_books(_book_ids_from_form(await request.form))
+    except (ValueError, TypeError) as e:
+        await flash(f"Invalid batch: {e}", "danger")
+        return redirect(url_for('admin_dashboard'))
+    done = await _flash_batch(results, 'deleted', "Deleted")
+    if done:
+        audit.record("Delete Book", f"{session['username']} deleted books {', '.join(done)}")
+    return redirect(url_for('admin_dashboard'))
+
+# --- ADMIN ACTIONS ---
+@web.route("/add_book", methods=["POST"])
+@admin_required
+async def add_book():
+    form = await request.form
+    title, author, category = form.get("title"), form.get("author"), form.get("category")
+    await async_ops.add_book(title, author, category)
+    audit.record("Add Book", f"{session['username']} added '{title}' by {author}")
+    await flash("New book added successfully!", "success")
+    return redirect(url_for('admin_dashboard'))
+
+@web.route("/update_book", methods=["POST"])
+@admin_required
+async def update_book():
+    form = await request.form
+    book_id, field, new_value = form.get("book_id"), form.get("field"), form.get("new_value")
+    if await async_ops.update_book_field(book_id, field, new_value):
+        audit.record("Update Book", f"{session['username']} set {field} of book {book_id} to '{new_value}'")
+        await flash(f"Book ID {book_id} was updated successfully!", "success")
+    else:
+        await flash(f"Update failed. Book with ID {book_id} not found.", "danger")
+    return redirect(url_for('admin_dashboard'))
+
+@web.route("/delete_book", methods=["POST"])
+@admin_required
+async def delete_book():
+    book_id = (await request.form).get("book_id")
+    if await async_ops.delete_book(book_id):
+        audit.record("Delete Book", f"{session['username']} deleted book {book_id}")
+        await flash(f"Book ID {book_id} has been deleted.", "success")
+    else:
+        await flash(f"Delete failed. Book with ID {book_id} not found.", "danger")
+    return redirect(url_for('admin_dashboard'))
+
+@web.route("/create_user", methods=["POST"])
+@admin_required
+async def create_user():
+    form = await request.form
+    username, role = form.get("username"), form.get("role")
+    if await async_ops.create_user(username, form.get("password"), role):
+        audit.record("Create User", f"{session['username']} created {role} account {username}")
+        await flash(f"Account for {username} created successfully.", "success")
+    else:
+        await flash("Failed to create account. Username may be taken.", "danger")
+    return redirect(url_for('admin_dashboard'))
+
+@web.route("/update_user_role", methods=["POST"])
+@admin_required
+async def update_user_role():
+    form = await request.form
+    username, role = form.get("username"), form.get("role")
+    if await async_ops.update_user_role(username, role):
+        article = 'an' if role == 'admin' else 'a'
+        audit.record("Change Role", f"{session['username']} made {username} {article} {role}")
+        await flash(f"{username} is now {article} {role}.", "success")
+    else:
+        await flash(f"Role change failed. User {username} not found.", "danger")
+    return redirect(url_for('admin_dashboard'))
+
+# --- PROBES ---
+@web.route("/healthz")
+async def healthz():
+    """Liveness probe: answers as long as the worker's event loop is serving requests."""
+    return startup.health()
+
+@web.route("/metrics")
+async def prometheus_metrics():
+    """The sync app's metrics (both apps record into them; summed over all workers) plus the asyncpg pool."""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+def metrics_snapshots():
+    """The sync app's gauges plus the asyncpg pool and async admission counters."""
+    return dict(sync_app.metrics_snapshots(), lms_async_pool=adb.pool_stats(),
+                lms_async_admission=request_limit.snapshot())
+
+metrics.set_snapshot_source(metrics_snapshots)
+
+# --- DISPATCH TO THE SYNC APP ---
+# Routes without an async view are registered here under their app.py endpoint names too,
+# so url_for builds links to them; requests for them never reach these placeholders.
+NATIVE_ENDPOINTS = frozenset(web.view_functions)
+
+async def _served_by_sync_app(**kwargs):
+    abort(404)
+
+for _rule in sync_app.app.url_map.iter_rules():
+    if _rule.endpoint not in web.view_functions:
+        web.add_url_rule(_rule.rule, endpoint=_rule.endpoint, view_func=_served_by_sync_app,
+                         methods=_rule.methods - {'HEAD', 'OPTIONS'})
+
+_routes = web.url_map.bind('localhost')
+_sync = WSGIMiddleware(sync_app.app, workers=ASYNC_SYNC_THREADS)
+
+
+def _is_native(scope):
+    try:
+        endpoint, _ = _routes.match(scope['path'], method=scope['method'])
+    except HTTPException:
+        return True  # Unknown paths and redirects are answered by the async app.
+    return endpoint in NATIVE_ENDPOINTS
+
+
+async def app(scope, receive, send):
+    """The ASGI application: async views where they exist, the sync app for everything else."""
+    if scope['type'] == 'http' and not _is_native(scope):
+        await _sync(scope, receive, send)
+    else:
+        await web(scope, receive, send)
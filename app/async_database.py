@@ -0,0 +1,141 @@
+# async_database.py
+
+import asyncio
+import json
+import random
+import time
+from contextlib import asynccontextmanager
+
+import asyncpg
+import metrics
+import statements
+from config import (DB_NAME, DB_USER, DB_PASS, DB_HOST, DB_PORT, DB_CONNECT_TIMEOUT, DB_POOL_TIMEOUT,
+                    DB_RETRY_ATTEMPTS, DB_RETRY_BACKOFF, ASYNC_POOL_MIN, ASYNC_POOL_MAX)
+
+# The asyncpg counterpart of database.py, used by the async entry point (asgi.py).
+# Statements are written in psycopg2's paramstyle everywhere, so the sync and async code
+# share their SQL; convert() rewrites them for asyncpg. Every query goes to the primary.
+# asyncpg prepares every statement on first use and caches it per connection, so the hot
+# statements in statements.py are only timed here, not prepared explicitly.
+
+# Errors that mean "a concurrent transaction got in the way", which are safe to retry.
+RETRYABLE_ERRORS = (asyncpg.SerializationError, asyncpg.DeadlockDetectedError)
+
+_pool = None
+
+
+def convert(query, params=None):
+    """
+    Rewrites a psycopg2-style statement, or a registered Statement, into asyncpg's
+    numbered $n form. Returns (sql, args) for conn.fetch(sql, *args).
+    """
+    if isinstance(query, statements.Statement):
+        return query.numbered_sql, statements.arguments(query.names, params)
+    sql, names = statements.numbered(query)
+    return sql, statements.arguments(names, params)
+
+
+async def _init_connection(conn):
+    # json and jsonb arrive as Python objects, as they do from psycopg2.
+    for type_name in ('json', 'jsonb'):
+        await conn.set_type_codec(type_name, encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+
+
+async def open_pool():
+    """Opens this process's asyncpg pool. Called once per worker, before it starts serving."""
+    global _pool
+    if _pool is None:
+        _pool = await asyncpg.create_pool(
+            host=DB_HOST, port=int(DB_PORT), user=DB_USER, password=DB_PASS, database=DB_NAME,
+            min_size=ASYNC_POOL_MIN, max_size=ASYNC_POOL_MAX, timeout=DB_CONNECT_TIMEOUT,
+            init=_init_connection)
+    return _pool
+
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        pool, _pool = _pool, None
+        await pool.close()
+
+
+@asynccontextmanager
+async def connection(timeout=None):
+    """
+    Checks a connection out of the pool, waiting at most `timeout` seconds
+    (DB_POOL_TIMEOUT by default); raises asyncio.TimeoutError if none becomes free.
+    """
+    pool = _pool or await open_pool()
+    start = time.perf_counter()
+    conn = await pool.acquire(timeout=DB_POOL_TIMEOUT if timeout is None else timeout)
+    metrics.observe_checkout(time.perf_counter() - start)
+    try:
+        yield conn
+    finally:
+        await pool.release(conn)
+
+
+async def _timed(method, query, params):
+    sql, args = convert(query, params)
+    start = time.perf_counter()
+    try:
+        return await method(sql, *args)
+    finally:
+        seconds = time.perf_counter() - start
+        if isinstance(query, statements.Statement):
+            statements.observe(query, seconds)
+            query = query.sql
+        metrics.observe_query(query, seconds)
+
+
+async def fetch(query, params=None, conn=None):
+    """Runs a query and returns every row (asyncpg Records, which index like DictCursor rows)."""
+    if conn is not None:
+        return await _timed(conn.fetch, query, params)
+    async with connection() as conn:
+        return await _timed(conn.fetch, query, params)
+
+
+async def fetchrow(query, params=None, conn=None):
+    """Runs a query and returns its first row, or None."""
+    if conn is not None:
+        return await _timed(conn.fetchrow, query, params)
+    async with connection() as conn:
+        return await _timed(conn.fetchrow, query, params)
+
+
+async def execute_atomic(query, params=None, attempts=None):
+    """
+    Runs a single statement as its own implicit transaction and returns its rows ([] if it
+    returns none), like database.execute_atomic. Serialization failures and deadlocks are
+    retried with jittered exponential backoff, up to `attempts` tries.
+    """
+    attempts = attempts or DB_RETRY_ATTEMPTS
+    for attempt in range(1, attempts + 1):
+        try:
+            return await fetch(query, params)
+        except RETRYABLE_ERRORS:
+            if attempt == attempts:
+                raise
+        await asyncio.sleep(DB_RETRY_BACKOFF * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+
+
+async def stream(query, params=None, prefetch=500):
+    """
+    Yields the rows of a query from a server-side cursor, `prefetch` rows per round trip,
+    holding one pooled connection until the iteration finishes.
+    """
+    sql, args = convert(query, params)
+    async with connection() as conn:
+        async with conn.transaction(readonly=True):
+            start = time.perf_counter()
+            async for row in conn.cursor(sql, *args, prefetch=prefetch):
+                yield row
+            metrics.observe_query(query, time.perf_counter() - start)
+
+
+def pool_stats():
+    """Returns this process's asyncpg pool size and idle connections."""
+    if _pool is None:
+        return {'size': 0, 'idle': 0, 'max': ASYNC_POOL_MAX}
+    return {'size': _pool.get_size(), 'idle': _pool.get_idle_size(), 'max': ASYNC_POOL_MAX}
@@ -0,0 +1,240 @@
+# async_operations.py
+
+import asyncio
+import hashlib
+from datetime import datetime
+
+import asyncpg
+import async_database as adb
+import auth
+import user_operations as user_ops
+import admin_operations as admin_ops
+from database import note_write
+from cache import lookup_catalogue, store_catalogue, bump_catalogue_version
+from pagination import split_page
+
+# Async versions of the auth, user and admin operations the async entry point (asgi.py)
+# serves natively. They run the same SQL as auth.py, user_operations.py and
+# admin_operations.py, and share their caches, so both entry points behave the same.
+# The catalogue cache may live in Redis (CACHE_REDIS_URL), so its calls run in a thread
+# rather than on the event loop.
+
+# --- AUTH ---
+
+async def authenticate(username, password):
+    """Checks a username and password; returns the user's record or None (see auth.authenticate)."""
+    password_hash = hashlib.sha256(password.encode()).hexdigest()
+    row = await adb.fetchrow(auth.LOGIN, (username, password_hash))
+    user = auth._user_record(row)
+    if user:
+        auth._user_cache.set(user['id'], user)
+    return user
+
+async def get_user(user_id):
+    """Returns a user's current record from auth's cache, loading it on a miss (see auth.get_user)."""
+    auth._ensure_subscribed()
+
+    async def load():
+        return auth._user_record(await adb.fetchrow(auth.USER_BY_ID, (user_id,)))
+    return await auth._user_cache.get_or_load_async(user_id, load)
+
+async def session_user(session):
+    """Revalidates a logged-in session against the user's record (see auth.session_user)."""
+    if 'user_id' not in session:
+        return None
+    user = await get_user(session['user_id'])
+    if user is None:
+        session.clear()
+        return None
+    if session.get('role') != user['role']:
+        session['role'] = user['role']
+    return user
+
+async def signup(username, password):
+    """Creates a new user with the 'user' role. Returns False if the username is taken."""
+    return await _insert_user(username, password, 'user')
+
+async def _insert_user(username, password, role):
+    password_hash = hashlib.sha256(password.encode()).hexdigest()
+    try:
+        await adb.fetch("INSERT INTO users (username, password, role) VALUES (%s, %s, %s)",
+                        (username, password_hash, role))
+    except asyncpg.UniqueViolationError:
+        return False
+    return True
+
+# --- USER ---
+
+def _timestamp_keyset(keyset):
+    # Keyset tokens carry timestamps as text; asyncpg binds timestamp parameters as datetimes.
+    return (datetime.fromisoformat(keyset[0]), keyset[1]) if keyset else None
+
+async def load_dashboard(user_id, query=None, show_all=False, books_page=1, history_before=None,
+                         history_limit=user_ops.HISTORY_PAGE_SIZE, books_limit=user_ops.SEARCH_PAGE_SIZE,
+                         categories=None):
+    """Loads a page of available books and of the user's history in one round trip (see user_ops.load_dashboard)."""
+    plan = await asyncio.to_thread(user_ops._plan_dashboard, user_id, query, show_all, books_page,
+                                   _timestamp_keyset(history_before), history_limit, books_limit, categories)
+    row = await adb.fetchrow(plan['statement'], plan['params'])
+    return await asyncio.to_thread(user_ops._finish_dashboard, plan, row['books'], row['facets'], row['history'])
+
+async def borrow_book(user_id, username, book_id, days_to_borrow):
+    """Borrows a book for `days_to_borrow` days. Returns False if it is unavailable or `book_id` is not an ID."""
+    try:
+        book_id = int(book_id)
+    except (TypeError, ValueError):
+        return False
+    try:
+        loan = await adb.execute_atomic(user_ops.BORROW, {'user_id': user_id, 'username': username,
+                                                              'book_id': book_id, 'days': days_to_borrow})
+    except asyncpg.UniqueViolationError:
+        return False
+    if loan:
+        await asyncio.to_thread(bump_catalogue_version)
+        note_write()
+    return bool(loan)
+
+async def return_book(user_id, book_id):
+    """Returns a borrowed book. Returns False if the user has no open loan of it."""
+    try:
+        book_id = int(book_id)
+    except (TypeError, ValueError):
+        return False
+    returned = await adb.execute_atomic(user_ops.RETURN, {'user_id': user_id, 'book_id': book_id})
+    if returned:
+        await asyncio.to_thread(bump_catalogue_version)
+        note_write()
+    return bool(returned)
+
+async def borrow_books(user_id, username, book_ids, days_to_borrow):
+    """Borrows several books in one statement (see user_ops.borrow_books)."""
+    ids = user_ops.batch_book_ids(book_ids)
+    if not ids:
+        return {}
+    try:
+        rows = await adb.execute_atomic(user_ops.BORROW_BATCH, {'ids': ids, 'user_id': user_id,
+                                                                    'username': username, 'days': days_to_borrow})
+    except asyncpg.UniqueViolationError:
+        return dict.fromkeys(ids, 'unavailable')
+    results = {row[0]: row[1] for row in rows}
+    if 'borrowed' in results.values():
+        await asyncio.to_thread(bump_catalogue_version)
+        note_write()
+    return results
+
+async def return_books(user_id, book_ids):
+    """Returns several books in one statement; user_id=None checks them in for anyone (see user_ops.return_books)."""
+    ids = user_ops.batch_book_ids(book_ids)
+    if not ids:
+        return {}
+    rows = await adb.execute_atomic(user_ops.RETURN_BATCH, {'ids': ids, 'user_id': user_id})
+    results = {row[0]: row[1] for row in rows}
+    if 'returned' in results.values():
+        await asyncio.to_thread(bump_catalogue_version)
+        note_write()
+    return results
+
+# --- ADMIN ---
+
+async def view_books_page(sort='id', descending=False, after=None, limit=admin_ops.ADMIN_PAGE_SIZE):
+    """Returns one cached page of books as (books, next_cursor) (see admin_ops.view_books_page)."""
+    cache_key, query, params = admin_ops.books_page_query(sort, descending, after, limit)
+    page, slot = await asyncio.to_thread(lookup_catalogue, cache_key)
+    if page is None:
+        books = await adb.fetch(query, params)
+        page = split_page(books, limit, key=lambda row: (row['sort_key'], row['id']))
+        await asyncio.to_thread(store_catalogue, slot, page)
+    return page
+
+async def view_borrowing_records_page(after=None, limit=admin_ops.ADMIN_PAGE_SIZE):
+    """Returns one page of borrowing records, newest first, as (records, next_cursor)."""
+    query, params = admin_ops.records_page_query(after, limit)
+    if 'after_date' in params:
+        params['after_date'], params['after_id'] = _timestamp_keyset((params['after_date'], params['after_id']))
+    records = await adb.fetch(query, params)
+    return split_page(records, limit, key=lambda row: (row['borrow_date'], row['id']))
+
+def iter_all_books(sort='id', descending=False):
+    """Streams every book in the requested order from a server-side cursor."""
+    return adb.stream(admin_ops._all_books_sql(sort, descending), prefetch=admin_ops.STREAM_BATCH_SIZE)
+
+def iter_all_borrowing_records():
+    """Streams every borrowing record, newest first, from a server-side cursor."""
+    return adb.stream(admin_ops.ALL_RECORDS_SQL, prefetch=admin_ops.STREAM_BATCH_SIZE)
+
+async def add_book(title, author, category):
+    await adb.fetch("INSERT INTO books (title, author, category) VALUES (%s, %s, %s)", (title, author, category))
+    await asyncio.to_thread(bump_catalogue_version)
+    note_write()
+
+async def update_book_field(book_id, field_to_update, new_value):
+    """Updates one whitelisted field of a book. Returns False if the field or book is invalid."""
+    if field_to_update not in ('title', 'author', 'category'):
+        return False
+    try:
+        book_id = int(book_id)
+    except (TypeError, ValueError):
+        return False
+    updated = await adb.fetch(f"UPDATE books SET {field_to_update} = %s WHERE id = %s RETURNING id",
+                              (new_value, book_id))
+    if not updated:
+        return False
+    await asyncio.to_thread(bump_catalogue_version)
+    note_write()
+    return True
+
+async def delete_book(book_id):
+    """Deletes a book. Returns False if it does not exist."""
+    try:
+        book_id = int(book_id)
+    except (TypeError, ValueError):
+        return False
+    deleted = await adb.fetch("DELETE FROM books WHERE id = %s RETURNING id", (book_id,))
+    if not deleted:
+        return False
+    await asyncio.to_thread(bump_catalogue_version)
+    note_write()
+    return True
+
+async def update_books(book_ids, changes):
+    """Applies the same field changes to several books in one statement (see admin_ops.update_books)."""
+    fields = {field: value for field, value in changes.items() if field in ('title', 'author', 'category')}
+    if not fields or len(fields) != len(changes):
+        return {}
+    ids = user_ops.batch_book_ids(book_ids)
+    if not ids:
+        return {}
+    rows = await adb.execute_atomic(admin_ops._update_books_sql(fields), dict(fields, ids=ids))
+    results = {row[0]: row[1] for row in rows}
+    if 'updated' in results.values():
+        await asyncio.to_thread(bump_catalogue_version)
+        note_write()
+    return results
+
+async def delete_books(book_ids):
+    """Deletes several books in one statement, keeping those with loan history (see admin_ops.delete_books)."""
+    ids = user_ops.batch_book_ids(book_ids)
+    if not ids:
+        return {}
+    rows = await adb.execute_atomic(admin_ops.DELETE_BATCH_SQL, {'ids': ids})
+    results = {row[0]: row[1] for row in rows}
+    if 'deleted' in results.values():
+        await asyncio.to_thread(bump_catalogue_version)
+        note_write()
+    return results
+
+async def create_user(username, password, role):
+    """Creates a user or admin account. Returns False if the role is invalid or the username taken."""
+    if role not in ('user', 'admin'):
+        return False
+    return await _insert_user(username, password, role)
+
+async def update_user_role(username, role):
+    """Changes a user's role. Returns False if the role or user is invalid."""
+    if role not in ('user', 'admin'):
+        return False
+    updated = await adb.fetchrow("UPDATE users SET role = %s WHERE username = %s RETURNING id", (role, username))
+    if not updated:
+        return False
+    auth.invalidate_user(updated['id'])
+    return True
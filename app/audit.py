@@ -0,0 +1,252 @@
+# audit.py
+
+import atexit
+import glob
+import json
+import os
+import queue
+import re
+import threading
+import time
+from datetime import datetime
+
+import psycopg2
+import psycopg2.extras
+
+import database
+from database import get_db_connection
+from config import AUDIT_QUEUE_SIZE, AUDIT_BATCH_SIZE, AUDIT_FLUSH_INTERVAL, AUDIT_SPILL_DIR
+
+# Each process spills to audit-<pid>.jsonl; the pid says whether the owner can still append.
+_SPILL_FILE = re.compile(r'^audit-(\d+)\.jsonl$')
+
+
+class AuditLogger:
+    """
+    Non-blocking writer for the logs table.
+
+    record() only appends to a bounded in-memory queue. A background thread drains it and
+    inserts up to `batch_size` entries per statement with execute_values. When the database
+    is unavailable (or the queue is full) entries are appended to a JSON Lines spill file
+    instead, and spill files are replayed into the table after the next successful write.
+    Lines of a spill file that cannot be read back are set aside in rejected-<pid>.jsonl.
+    """
+
+    def __init__(self, maxsize, batch_size, flush_interval, spill_dir):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spill_dir = spill_dir
+        self.pid = os.getpid()
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._spill_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+        self.stats = {'queued': 0, 'written': 0, 'batches': 0, 'spilled': 0, 'replayed': 0, 'rejected': 0}
+        self._thread.start()
+
+    def _count(self, stat, amount=1):
+        with self._stats_lock:
+            self.stats[stat] += amount
+
+    def record(self, action, details):
+        """Queues one audit entry without touching the database."""
+        entry = (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), action, details)
+        try:
+            self._queue.put_nowait(entry)
+            self._count('queued')
+        except queue.Full:
+            self._spill([entry])
+
+    def _drain(self, first):
+        batch = [first]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _insert(self, entries):
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                psycopg2.extras.execute_values(
+                    cursor,
+                    "INSERT INTO logs (timestamp, action, details) VALUES %s",
+                    entries, page_size=self.batch_size)
+            conn.commit()
+
+    def _write(self, batch):
+        try:
+            self._insert(batch)
+        except (psycopg2.Error, database.PoolTimeoutError) as e:
+            print(f"⚠️ Audit log write failed, spilling {len(batch)} entries to disk: {e}")
+            self._spill(batch)
+            return False
+        self._count('written', len(batch))
+        self._count('batches')
+        return True
+
+    def _spill_path(self):
+        return os.path.join(self.spill_dir, f"audit-{os.getpid()}.jsonl")
+
+    def _spill(self, entries, count=True):
+        with self._spill_lock:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            with open(self._spill_path(), 'a') as f:
+                for entry in entries:
+                    f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+        if count:
+            self._count('spilled', len(entries))
+
+    def _replay_spill_files(self):
+        """
+        Moves spilled entries into the logs table. A file is only replayed once nothing can
+        append to it any more: this process's own file is rotated under the spill lock, and
+        another process's only once that process has exited. Files are claimed by rename,
+        so several processes can replay the same directory safely.
+        """
+        me = os.getpid()
+        for path in sorted(glob.glob(os.path.join(self.spill_dir, "audit-*.jsonl"))):
+            match = _SPILL_FILE.match(os.path.basename(path))
+            if not match or (int(match.group(1)) != me and _process_alive(int(match.group(1)))):
+                continue  # A live process may still be appending to it.
+            claimed = f"{path}.replaying-{me}"
+            with self._spill_lock:
+                try:
+                    os.rename(path, claimed)
+                except OSError:
+                    continue  # Another process claimed it first.
+            self._replay_file(claimed)
+        # Files left behind mid-replay by a process that crashed, or by this one after an error.
+        for claimed in glob.glob(os.path.join(self.spill_dir, "audit-*.jsonl.replaying-*")):
+            owner = claimed.rsplit('-', 1)[-1]
+            if not owner.isdigit() or (int(owner) != me and _process_alive(int(owner))):
+                continue
+            reclaimed = f"{claimed.rsplit('.replaying-', 1)[0]}.replaying-{me}"
+            if reclaimed != claimed:
+                try:
+                    os.rename(claimed, reclaimed)
+                except OSError:
+                    continue
+            self._replay_file(reclaimed)
+
+    def _replay_file(self, path):
+        entries, rejected = [], []
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    entry = None
+                if isinstance(entry, list) and len(entry) == 3:
+                    entries.append(tuple(entry))
+                else:
+                    # Torn by a crash mid-write, or otherwise unreadable: set aside, not retried.
+                    rejected.append(line.rstrip('\n'))
+        if rejected:
+            self._reject(rejected, path)
+        for start in range(0, len(entries), self.batch_size):
+            try:
+                self._insert(entries[start:start + self.batch_size])
+            except (psycopg2.Error, database.PoolTimeoutError):
+                # Put the remainder back for a later attempt.
+                self._spill(entries[start:], count=False)
+                break
+            self._count('replayed', len(entries[start:start + self.batch_size]))
+        os.remove(path)
+
+    def _reject(self, lines, source):
+        print(f"⚠️ Setting aside {len(lines)} unreadable audit spill lines from {source}")
+        with open(os.path.join(self.spill_dir, f"rejected-{os.getpid()}.jsonl"), 'a') as f:
+            for line in lines:
+                f.write(line + '\n')
+        self._count('rejected', len(lines))
+
+    def _run(self):
+        next_replay = 0
+        while not self._stopping.is_set():
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                first = None
+            if first is not None and not self._write(self._drain(first)):
+                continue
+            if time.monotonic() >= next_replay and os.path.isdir(self.spill_dir):
+                next_replay = time.monotonic() + 30
+                try:
+                    self._replay_spill_files()
+                except (OSError, ValueError) as e:
+                    print(f"⚠️ Could not replay audit spill files: {e}")
+
+    def flush(self):
+        """Writes out everything still queued, synchronously (used at shutdown)."""
+        while True:
+            try:
+                first = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            self._write(self._drain(first))
+
+    def shutdown(self):
+        self._stopping.set()
+        self._thread.join(timeout=self.flush_interval + 1)
+        self.flush()
+
+    def snapshot(self):
+        with self._stats_lock:
+            return dict(self.stats, pending=self._queue.qsize())
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+_logger = None
+_logger_lock = threading.Lock()
+
+
+def get_logger():
+    """Returns this process's audit logger, starting its writer thread on first use (and after a fork)."""
+    global _logger
+    logger = _logger
+    if logger is not None and logger.pid == os.getpid():
+        return logger
+    with _logger_lock:
+        if _logger is None or _logger.pid != os.getpid():
+            _logger = AuditLogger(AUDIT_QUEUE_SIZE, AUDIT_BATCH_SIZE, AUDIT_FLUSH_INTERVAL, AUDIT_SPILL_DIR)
+        return _logger
+
+
+def _reset_lock_after_fork():
+    global _logger_lock
+    _logger_lock = threading.Lock()  # The parent's lock may have been held at fork time.
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_lock_after_fork)
+
+
+def record(action, details):
+    """Queues an audit entry for the logs table; never blocks on the database."""
+    get_logger().record(action, details)
+
+
+def stats():
+    return get_logger().snapshot()
+
+
+@atexit.register
+def _flush_on_exit():
+    if _logger is not None and _logger.pid == os.getpid():
+        _logger.shutdown()
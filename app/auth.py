@@ -1,52 +1,132 @@
 # auth.py
 
+import os
+import threading
 import psycopg2
+import psycopg2.extras
 import hashlib
+import database
+import statements
+from cache import TTLCache
+from config import AUTH_CACHE_TTL, AUTH_CACHE_SIZE
 from database import get_db_connection
 
-def login(username, password):
-    """Authenticates a user by comparing hashed passwords and returns their role."""
+# NOTIFY channel the users-table trigger (migration 6) publishes changed user ids on.
+USER_CHANGES_CHANNEL = 'user_changes'
+
+# user id -> {'id', 'username', 'role'}, or None for users that no longer exist.
+_user_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+_subscribed_pid = None
+_subscribe_lock = threading.Lock()
+
+# The two statements behind every login and every logged-in request (see statements.py).
+LOGIN = statements.register(
+    'auth_login', "SELECT id, username, role FROM users WHERE username = %s AND password = %s",
+    example=('load-user-0', hashlib.sha256(b'load-password').hexdigest()))
+USER_BY_ID = statements.register('auth_user_by_id', "SELECT id, username, role FROM users WHERE id = %s",
+                                 example=(1,))
+
+def _user_record(row):
+    return {'id': row['id'], 'username': row['username'], 'role': row['role']} if row else None
+
+def authenticate(username, password):
+    """
+    Checks a username and password in a single query.
+    Returns the user's record ({'id', 'username', 'role'}) or None if the credentials are wrong.
+    """
     password_hash = hashlib.sha256(password.encode()).hexdigest()
 
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cursor.execute("SELECT role FROM users WHERE username = %s AND password = %s", (username, password_hash))
-    user = cursor.fetchone()
-    cursor.close()
-    conn.close()
-    
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            statements.execute(cursor, LOGIN, (username, password_hash))
+            user = _user_record(cursor.fetchone())
+
     if user:
-        return user['role']
-    return None
+        _user_cache.set(user['id'], user)
+    return user
+
+def login(username, password):
+    """Authenticates a user by comparing hashed passwords and returns their role."""
+    user = authenticate(username, password)
+    return user['role'] if user else None
+
+def _on_user_changed(payload):
+    try:
+        _user_cache.invalidate(int(payload))
+    except ValueError:
+        _user_cache.clear()
+
+def _ensure_subscribed():
+    """Starts listening for user-change notifications once per process."""
+    global _subscribed_pid
+    if _subscribed_pid == os.getpid():
+        return
+    with _subscribe_lock:
+        if _subscribed_pid != os.getpid():
+            database.subscribe(USER_CHANGES_CHANNEL, _on_user_changed, on_reset=_user_cache.clear)
+            _subscribed_pid = os.getpid()
+
+def _load_user(user_id):
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            statements.execute(cursor, USER_BY_ID, (user_id,))
+            return _user_record(cursor.fetchone())
+
+def get_user(user_id):
+    """
+    Returns the current record ({'id', 'username', 'role'}) for a user id, or None if the
+    user no longer exists. Served from the in-process cache, which is invalidated when the
+    users table changes, so this is cheap enough to call on every request.
+    """
+    _ensure_subscribed()
+    return _user_cache.get_or_load(user_id, lambda: _load_user(user_id))
+
+def session_user(session):
+    """
+    Revalidates a logged-in session against the (cached) user record, so role changes and
+    deleted accounts take effect on the next request. Returns the record or None, clearing
+    sessions whose user no longer exists.
+    """
+    if 'user_id' not in session:
+        return None
+    user = get_user(session['user_id'])
+    if user is None:
+        session.clear()
+        return None
+    if session.get('role') != user['role']:
+        session['role'] = user['role']
+    return user
+
+def invalidate_user(user_id):
+    """Drops a user's cached record in this process (other processes learn via NOTIFY)."""
+    _user_cache.invalidate(user_id)
+
+def cache_stats():
+    """Returns hit, miss and eviction counters for the user-record cache."""
+    return _user_cache.snapshot()
 
 def signup(username, password):
     """Creates a new user with the 'user' role and a hashed password."""
     password_hash = hashlib.sha256(password.encode()).hexdigest()
     role = 'user'
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    try:
-        cursor.execute("INSERT INTO users (username, password, role) VALUES (%s, %s, %s)",
-                       (username, password_hash, role))
-        conn.commit()
-    except psycopg2.IntegrityError:
-        # This error occurs if the username is already taken (due to UNIQUE constraint)
-        conn.rollback() # Rollback the failed transaction
-        return False
-    finally:
-        cursor.close()
-        conn.close()
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            try:
+                cursor.execute("INSERT INTO users (username, password, role) VALUES (%s, %s, %s)",
+                               (username, password_hash, role))
+                conn.commit()
+            except psycopg2.IntegrityError:
+                # This error occurs if the username is already taken (due to UNIQUE constraint)
+                conn.rollback() # Rollback the failed transaction
+                return False
 
     return True
 
 def get_user_id(username):
     """Gets the user ID for a given username."""
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cursor.execute("SELECT id FROM users WHERE username = %s", (username,))
-    user_id = cursor.fetchone()
-    cursor.close()
-    conn.close()
-    return user_id['id'] if user_id else None
\ No newline at end of file
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            cursor.execute("SELECT id FROM users WHERE username = %s", (username,))
+            user_id = cursor.fetchone()
+    return user_id['id'] if user_id else None
@@ -0,0 +1,6 @@
+# benchmarks: performance harnesses for the library app. Run them from the app directory,
+# e.g. `python -m benchmarks.search_benchmark`, against a disposable PostgreSQL database
+# (benchmarks/docker-compose.yml starts one). Seed it with `python -m benchmarks.seed`,
+# then run `benchmarks.load_test`, `benchmarks.micro_benchmark` or
+# `benchmarks.startup_benchmark` (cold start to ready) and compare result files with
+# `python -m benchmarks.results baseline.json candidate.json`.
@@ -0,0 +1,172 @@
+# borrow_stress.py
+"""
+Multi-threaded borrow/return stress test.
+
+Worker threads repeatedly borrow and return a small, hot set of books so that many
+borrows race for the same rows. Afterwards the transactions table is checked for
+double loans: a book with more than one open loan, or two loans of the same book whose
+borrow periods overlap. The run is done twice, once with the original check-then-update
+borrow path and once with user_operations.borrow_book, and throughput is reported for both.
+Once the one-open-loan guard exists (migration 5, kept by open_loans since migration 9),
+the legacy path's double loans surface as errors rather than as overlapping rows.
+
+Keep --threads at or below DB_POOL_MAX so the test measures the database, not pool waits.
+
+The test creates its own users and books (prefixed `stress-`) and deletes them at the end.
+
+    python -m benchmarks.borrow_stress --threads 8 --books 5 --seconds 10
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+
+import psycopg2
+import psycopg2.extras
+
+import database
+import user_operations
+from database import get_db_connection
+
+PREFIX = "stress-"
+
+
+def legacy_borrow_book(user_id, username, book_id, days_to_borrow):
+    """The pre-atomic borrow path: SELECT status, then UPDATE, then INSERT, without a row lock."""
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            cursor.execute("SELECT status FROM books WHERE id = %s", (book_id,))
+            book_status = cursor.fetchone()
+            if book_status and book_status['status'] == 'available':
+                cursor.execute("UPDATE books SET status = 'borrowed' WHERE id = %s", (book_id,))
+                cursor.execute("""
+                    INSERT INTO transactions (user_id, username, book_id, borrow_date, due_date)
+                    VALUES (%s, %s, %s, LOCALTIMESTAMP, LOCALTIMESTAMP + make_interval(days => %s))
+                """, (user_id, username, book_id, days_to_borrow))
+                conn.commit()
+                return True
+    return False
+
+
+def setup(thread_count, book_count):
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            users = []
+            for i in range(thread_count):
+                cursor.execute("""
+                    INSERT INTO users (username, password, role) VALUES (%s, 'x', 'user')
+                    ON CONFLICT (username) DO UPDATE SET role = 'user' RETURNING id, username
+                """, (f"{PREFIX}user-{i}",))
+                users.append(cursor.fetchone())
+            books = []
+            for i in range(book_count):
+                cursor.execute("INSERT INTO books (title, author, category) VALUES (%s, 'Stress', 'stress') RETURNING id",
+                               (f"{PREFIX}book-{i}",))
+                books.append(cursor.fetchone()[0])
+        conn.commit()
+    return users, books
+
+
+def reset(book_ids):
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("DELETE FROM transactions WHERE book_id = ANY(%s)", (book_ids,))
+            cursor.execute("UPDATE books SET status = 'available' WHERE id = ANY(%s)", (book_ids,))
+        conn.commit()
+
+
+def teardown(user_ids, book_ids):
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("DELETE FROM transactions WHERE book_id = ANY(%s) OR user_id = ANY(%s)", (book_ids, user_ids))
+            cursor.execute("DELETE FROM books WHERE id = ANY(%s)", (book_ids,))
+            cursor.execute("DELETE FROM users WHERE id = ANY(%s)", (user_ids,))
+        conn.commit()
+
+
+def count_double_loans(book_ids):
+    """Counts pairs of loans of the same book whose borrow periods overlap."""
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT count(*) FROM transactions a
+                JOIN transactions b ON a.book_id = b.book_id AND a.id < b.id
+                WHERE a.book_id = ANY(%s)
+                  AND a.borrow_date < COALESCE(b.return_date, 'infinity')
+                  AND b.borrow_date < COALESCE(a.return_date, 'infinity')
+            """, (book_ids,))
+            return cursor.fetchone()[0]
+
+
+def hammer(borrow, users, books, seconds):
+    """Runs one worker thread per user for `seconds`; returns operation and error counts."""
+    stop_at = time.monotonic() + seconds
+    totals = {"borrows": 0, "failed_borrows": 0, "returns": 0, "errors": 0}
+    lock = threading.Lock()
+
+    def worker(user_id, username, seed):
+        rng = random.Random(seed)
+        mine = []
+        counts = dict.fromkeys(totals, 0)
+        while time.monotonic() < stop_at:
+            try:
+                if mine and rng.random() < 0.5:
+                    user_operations.return_book(user_id, mine.pop())
+                    counts["returns"] += 1
+                else:
+                    book_id = rng.choice(books)
+                    if borrow(user_id, username, book_id, 7):
+                        mine.append(book_id)
+                        counts["borrows"] += 1
+                    else:
+                        counts["failed_borrows"] += 1
+            except psycopg2.Error:
+                counts["errors"] += 1
+        with lock:
+            for key, value in counts.items():
+                totals[key] += value
+
+    threads = [threading.Thread(target=worker, args=(uid, name, i)) for i, (uid, name) in enumerate(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    operations = totals["borrows"] + totals["failed_borrows"] + totals["returns"]
+    totals["ops_per_second"] = round(operations / seconds, 1)
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--books", type=int, default=5, help="size of the contended book set")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    database.create_tables()
+    users, books = setup(args.threads, args.books)
+    user_ids = [uid for uid, _ in users]
+    results = {}
+    try:
+        for name, borrow in (("legacy", legacy_borrow_book), ("atomic", user_operations.borrow_book)):
+            reset(books)
+            stats = hammer(borrow, users, books, args.seconds)
+            stats["double_loans"] = count_double_loans(books)
+            results[name] = stats
+            print(f"{name:<7} {stats['ops_per_second']:>8} ops/s  borrows={stats['borrows']} "
+                  f"returns={stats['returns']} errors={stats['errors']} double_loans={stats['double_loans']}")
+    finally:
+        teardown(user_ids, books)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if results["atomic"]["double_loans"]:
+        raise SystemExit("FAIL: the atomic borrow path produced double loans")
+
+
+if __name__ == "__main__":
+    main()
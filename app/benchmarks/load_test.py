@@ -0,0 +1,350 @@
+# load_test.py
+"""
+Concurrent load test of the main routes: login, dashboard search, borrow/return and the
+admin dashboard.
+
+Each scenario is driven by --clients concurrent clients, each logged in as its own seeded
+user, first for a short warm-up and then for --seconds. Two drivers are available:
+
+  testclient  requests go through Flask's test client inside this process, which
+              measures the application and database code without any HTTP overhead;
+  gunicorn    a real gunicorn server is started on --port and requests go over HTTP;
+  asgi        the same, serving the async entry point (asgi.py with gunicorn_asgi.conf.py),
+              so the sync and async serving modes can be compared.
+
+--idle-clients holds that many extra connections open, without sending a request, for the
+whole of every scenario, as slow mobile clients and idle keep-alives do. A sync worker is
+tied up by each of them until its timeout; an async worker just keeps the socket.
+
+For every route the test reports throughput and p50/p95/p99 latency, and for every
+scenario the number of SQL statements per request (from pg_stat_statements). Seed the
+database first with benchmarks.seed; a Postgres with pg_stat_statements preloaded is
+provided by benchmarks/docker-compose.yml.
+
+    python -m benchmarks.load_test --mode testclient gunicorn --clients 16 --output run.json
+    python -m benchmarks.load_test --mode gunicorn asgi --clients 64 --idle-clients 2000
+    python -m benchmarks.results baseline.json run.json
+"""
+
+import argparse
+import http.cookiejar
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import database
+from benchmarks import seed
+from benchmarks.results import QueryCounter, summarize, write_results
+from benchmarks.search_benchmark import WORDS, AUTHORS, misspell
+
+SCENARIOS = ("login", "search", "borrow_return", "admin")
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class _FlaskClient:
+    """Issues requests through Flask's test client; redirects are not followed."""
+
+    def __init__(self, flask_app):
+        self._client = flask_app.test_client()
+
+    def get(self, path):
+        return self._client.get(path).status_code
+
+    def post(self, path, data):
+        return self._client.post(path, data=data).status_code
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class _HttpClient:
+    """Issues requests over HTTP with its own cookie jar; redirects are not followed."""
+
+    def __init__(self, base_url):
+        self._base_url = base_url
+        self._opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect())
+
+    def _open(self, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        try:
+            with self._opener.open(self._base_url + path, body, timeout=30) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def get(self, path):
+        return self._open(path)
+
+    def post(self, path, data):
+        return self._open(path, data)
+
+
+class TestClientDriver:
+    name = "testclient"
+
+    def __init__(self):
+        os.environ["SKIP_DB_INIT"] = "1"
+        import app as webapp
+        self._app = webapp.app
+
+    def client(self):
+        return _FlaskClient(self._app)
+
+    def close(self):
+        pass
+
+
+def start_gunicorn(port, workers, worker_class="sync", threads=1, skip_db_init=True,
+                   config="gunicorn.conf.py", target="app:app"):
+    """
+    Starts gunicorn with the app's gunicorn.conf.py (or `config`), listening on
+    127.0.0.1:`port`. With worker_class=None the config file's worker class is used.
+    """
+    env = dict(os.environ)
+    if skip_db_init:
+        env["SKIP_DB_INIT"] = "1"
+    command = [sys.executable, "-m", "gunicorn", "--config", config, "--bind", f"127.0.0.1:{port}",
+               "--workers", str(workers), "--threads", str(threads), "--log-level", "warning"]
+    if worker_class:
+        command += ["--worker-class", worker_class]
+    return subprocess.Popen(command + [target], cwd=APP_DIR, env=env)
+
+
+def wait_until_ready(process, base_url, started, path="/readyz", timeout=60):
+    """Polls `path` until it answers 200 and returns the seconds since `started`."""
+    deadline = started + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with status {process.returncode}")
+        try:
+            if _HttpClient(base_url).get(path) == 200:
+                return time.monotonic() - started
+        except OSError:
+            pass
+        time.sleep(0.02)
+    process.terminate()
+    raise RuntimeError(f"gunicorn was not ready within {timeout}s")
+
+
+class GunicornDriver:
+    name = "gunicorn"
+
+    def __init__(self, port, workers, worker_class, threads, config="gunicorn.conf.py", target="app:app"):
+        self.port = port
+        self._base_url = f"http://127.0.0.1:{port}"
+        started = time.monotonic()
+        self._process = start_gunicorn(port, workers, worker_class, threads, config=config, target=target)
+        self.startup_seconds = wait_until_ready(self._process, self._base_url, started)
+
+    def client(self):
+        return _HttpClient(self._base_url)
+
+    def close(self):
+        self._process.terminate()
+        try:
+            self._process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+
+
+class AsgiDriver(GunicornDriver):
+    """The async serving mode: asgi.py under gunicorn_asgi.conf.py's uvicorn workers."""
+    name = "asgi"
+
+    def __init__(self, port, workers):
+        super().__init__(port, workers, None, 1, config="gunicorn_asgi.conf.py", target="asgi:app")
+
+
+def hold_idle_connections(port, count):
+    """Opens `count` connections to the server and sends nothing on them. Returns the sockets."""
+    held = []
+    for _ in range(count):
+        try:
+            held.append(socket.create_connection(("127.0.0.1", port), timeout=5))
+        except OSError as e:
+            print(f"could only open {len(held)} idle connections: {e}")
+            break
+    return held
+
+
+def _search_terms(rng):
+    word = rng.choice(WORDS + [a.lower() for a in AUTHORS])
+    return misspell(word, rng) if rng.random() < 0.3 else word
+
+
+class _Worker:
+    """One simulated client. `step()` performs one iteration of the scenario and records timings."""
+
+    def __init__(self, driver, scenario, index, clients, books):
+        self.client = driver.client()
+        self.scenario = scenario
+        self.rng = random.Random(index)
+        self.username = f"{seed.PREFIX}admin" if scenario == "admin" else f"{seed.PREFIX}user-{index}"
+        # Each client borrows from its own slice of the seeded books, so borrows do not collide.
+        first, last = books
+        self.books = list(range(first + index, last + 1, clients))
+        self.latencies = {}
+        self.errors = {}
+        if scenario != "login":
+            self.login()
+
+    def login(self):
+        return self.client.post("/login", {"username": self.username, "password": seed.PASSWORD})
+
+    def timed(self, route, request, *args):
+        start = time.perf_counter()
+        try:
+            status = request(*args)
+        except OSError:
+            status = None
+        elapsed = (time.perf_counter() - start) * 1000
+        if status is None or status >= 500:
+            self.errors[route] = self.errors.get(route, 0) + 1
+        else:
+            self.latencies.setdefault(route, []).append(elapsed)
+
+    def step(self):
+        if self.scenario == "login":
+            self.timed("login", self.login)
+        elif self.scenario == "search":
+            query = urllib.parse.urlencode({"search": _search_terms(self.rng)})
+            self.timed("dashboard_search", self.client.get, f"/dashboard?{query}")
+        elif self.scenario == "borrow_return":
+            book_id = self.rng.choice(self.books)
+            self.timed("borrow", self.client.post, "/borrow", {"book_id": book_id, "days_to_borrow": 7})
+            self.timed("return", self.client.post, "/return", {"book_id": book_id})
+        elif self.scenario == "admin":
+            sort = self.rng.choice(("id", "title", "author"))
+            self.timed("admin", self.client.get, f"/admin?sort={sort}")
+
+
+def _drive(workers, seconds):
+    stop_at = time.monotonic() + seconds
+
+    def loop(worker):
+        while time.monotonic() < stop_at:
+            worker.step()
+
+    threads = [threading.Thread(target=loop, args=(worker,)) for worker in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def run_scenario(driver, scenario, clients, books, seconds, warmup, counter, idle_clients=0):
+    workers = [_Worker(driver, scenario, i, clients, books) for i in range(clients)]
+    idle = hold_idle_connections(driver.port, idle_clients) if idle_clients else []
+    try:
+        result = _measure(workers, seconds, warmup, counter)
+    finally:
+        for sock in idle:
+            sock.close()
+    if idle_clients:
+        result["idle_clients"] = len(idle)
+    return result
+
+
+def _measure(workers, seconds, warmup, counter):
+    _drive(workers, warmup)
+    for worker in workers:
+        worker.latencies, worker.errors = {}, {}
+
+    queries_before = counter.total()
+    started = time.perf_counter()
+    _drive(workers, seconds)
+    elapsed = time.perf_counter() - started
+    queries_after = counter.total()
+
+    routes = sorted({route for worker in workers for route in list(worker.latencies) + list(worker.errors)})
+    result = {}
+    for route in routes:
+        samples = [ms for worker in workers for ms in worker.latencies.get(route, [])]
+        errors = sum(worker.errors.get(route, 0) for worker in workers)
+        result[route] = summarize(samples, errors, elapsed)
+    requests = sum(stats["requests"] + stats["errors"] for stats in result.values())
+    result["queries_per_request"] = counter.per_request(queries_before, queries_after, requests)
+    return result
+
+
+def _print_scenario(mode, scenario, result):
+    for route, stats in result.items():
+        if route in ("queries_per_request", "idle_clients") or not stats["requests"]:
+            continue
+        print(f"{mode:<10} {scenario:<14} {route:<17} {stats['throughput_rps']:>8} req/s"
+              f"  p50={stats['p50_ms']:.1f}ms p95={stats['p95_ms']:.1f}ms p99={stats['p99_ms']:.1f}ms"
+              f"  errors={stats['errors']}")
+    if result["queries_per_request"] is not None:
+        print(f"{'':<26}{result['queries_per_request']} queries/request")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", nargs="+", choices=("testclient", "gunicorn", "asgi"), default=["testclient"])
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--clients", type=int, default=8, help="concurrent clients per scenario")
+    parser.add_argument("--seconds", type=float, default=15, help="measured duration of each scenario")
+    parser.add_argument("--warmup", type=float, default=3, help="unmeasured warm-up before each scenario")
+    parser.add_argument("--seed", action="store_true", help="(re)seed the database before running")
+    parser.add_argument("--books", type=int, default=10_000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--transactions", type=int, default=50_000)
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn worker processes")
+    parser.add_argument("--worker-class", default="sync")
+    parser.add_argument("--threads", type=int, default=1, help="threads per gunicorn worker")
+    parser.add_argument("--idle-clients", type=int, default=0,
+                        help="connections held open without a request during each scenario (server modes)")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    database.create_tables()
+    if args.seed:
+        seed.seed(args.books, max(args.users, args.clients), args.transactions)
+    books = seed.seeded_book_range()
+    if books is None:
+        sys.exit("No seeded data found; run `python -m benchmarks.seed` or pass --seed")
+
+    counter = QueryCounter()
+    results = {}
+    try:
+        for mode in args.mode:
+            if mode == "testclient":
+                driver = TestClientDriver()
+            elif mode == "asgi":
+                driver = AsgiDriver(args.port, args.workers)
+            else:
+                driver = GunicornDriver(args.port, args.workers, args.worker_class, args.threads)
+            try:
+                if getattr(driver, "startup_seconds", None) is not None:
+                    results.setdefault(mode, {})["startup_seconds"] = round(driver.startup_seconds, 3)
+                    print(f"{mode}: cold start to ready in {driver.startup_seconds:.2f}s")
+                for scenario in args.scenarios:
+                    idle_clients = args.idle_clients if mode != "testclient" else 0
+                    result = run_scenario(driver, scenario, args.clients, books,
+                                          args.seconds, args.warmup, counter, idle_clients)
+                    results.setdefault(mode, {})[scenario] = result
+                    _print_scenario(mode, scenario, result)
+            finally:
+                driver.close()
+    finally:
+        counter.close()
+
+    if args.output:
+        parameters = {key: value for key, value in vars(args).items() if key not in ("output", "seed")}
+        write_results(args.output, "load_test", parameters, results)
+
+
+if __name__ == "__main__":
+    main()
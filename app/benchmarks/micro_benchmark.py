@@ -0,0 +1,112 @@
+# micro_benchmark.py
+"""
+Times the hot functions in auth, user_operations and admin_operations directly, without
+Flask or HTTP, so a change to one of them can be measured in isolation.
+
+Each operation is called --iterations times from a single thread against the seeded data
+(see benchmarks.seed). Caches are cleared before each operation and its cold first call
+is reported separately from the warm steady state.
+
+    python -m benchmarks.micro_benchmark --iterations 500 --output micro.json
+"""
+
+import argparse
+import random
+import sys
+import time
+
+import auth
+import cache
+import database
+import admin_operations as admin_ops
+import user_operations as user_ops
+from benchmarks import seed
+from benchmarks.results import QueryCounter, summarize, write_results
+from benchmarks.search_benchmark import WORDS
+
+
+def _user(username):
+    return auth.authenticate(username, seed.PASSWORD)
+
+
+def operations(user, books, rng):
+    """Returns (name, zero-argument callable) pairs for every benchmarked operation."""
+    first, last = books
+
+    def borrow_and_return():
+        book_id = rng.randint(first, last)
+        if user_ops.borrow_book(user['id'], user['username'], book_id, 7):
+            user_ops.return_book(user['id'], book_id)
+
+    return [
+        ("auth.authenticate", lambda: auth.authenticate(user['username'], seed.PASSWORD)),
+        ("auth.get_user", lambda: auth.get_user(user['id'])),
+        ("search_available_books", lambda: user_ops.search_available_books(rng.choice(WORDS))),
+        ("search_available_books.all", lambda: user_ops.search_available_books()),
+        ("view_borrowing_history", lambda: user_ops.view_borrowing_history(user['id'])),
+        ("load_dashboard", lambda: user_ops.load_dashboard(user['id'], query=rng.choice(WORDS))),
+        ("borrow_and_return", borrow_and_return),
+        ("view_books_page", lambda: admin_ops.view_books_page(rng.choice(("id", "title", "author")))),
+        ("view_borrowing_records_page", lambda: admin_ops.view_borrowing_records_page()),
+        ("get_book_details", lambda: admin_ops.get_book_details(rng.randint(first, last))),
+    ]
+
+
+def _clear_caches():
+    cache.bump_catalogue_version()
+    auth._user_cache.clear()
+
+
+def run(iterations, names, counter):
+    user = _user(f"{seed.PREFIX}user-0")
+    books = seed.seeded_book_range()
+    if user is None or books is None:
+        sys.exit("No seeded data found; run `python -m benchmarks.seed` first")
+    rng = random.Random(7)
+    results = {}
+    for name, operation in operations(user, books, rng):
+        if names and name not in names:
+            continue
+        _clear_caches()
+        start = time.perf_counter()
+        operation()
+        cold_ms = (time.perf_counter() - start) * 1000
+
+        samples = []
+        queries_before = counter.total()
+        started = time.perf_counter()
+        for _ in range(iterations):
+            start = time.perf_counter()
+            operation()
+            samples.append((time.perf_counter() - start) * 1000)
+        elapsed = time.perf_counter() - started
+        stats = summarize(samples, 0, elapsed)
+        stats["cold_ms"] = round(cold_ms, 3)
+        stats["queries_per_call"] = counter.per_request(queries_before, counter.total(), iterations)
+        results[name] = stats
+        print(f"{name:<30} p50={stats['p50_ms']:.3f}ms p95={stats['p95_ms']:.3f}ms "
+              f"p99={stats['p99_ms']:.3f}ms cold={stats['cold_ms']:.3f}ms "
+              f"queries/call={stats['queries_per_call']}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--only", nargs="+", help="benchmark only these operations")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    database.create_tables()
+    counter = QueryCounter()
+    try:
+        results = run(args.iterations, args.only, counter)
+    finally:
+        counter.close()
+    if args.output:
+        write_results(args.output, "micro_benchmark",
+                      {"iterations": args.iterations, "only": args.only}, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+# results.py
+"""
+Shared reporting for the benchmark suite: latency summaries, queries-per-request
+counting through pg_stat_statements, and machine-readable result files that can be
+compared between runs.
+
+    python -m benchmarks.results baseline.json candidate.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import psycopg2
+
+import config
+import database
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def summarize(latencies_ms, errors, seconds):
+    """Throughput and latency percentiles for one route or operation."""
+    if not latencies_ms:
+        return {"requests": 0, "errors": errors, "throughput_rps": 0.0}
+    return {
+        "requests": len(latencies_ms),
+        "errors": errors,
+        "throughput_rps": round(len(latencies_ms) / seconds, 1),
+        "mean_ms": round(statistics.fmean(latencies_ms), 3),
+        "p50_ms": round(percentile(latencies_ms, 0.50), 3),
+        "p95_ms": round(percentile(latencies_ms, 0.95), 3),
+        "p99_ms": round(percentile(latencies_ms, 0.99), 3),
+    }
+
+
+class QueryCounter:
+    """
+    Counts statements executed against the benchmark database, using pg_stat_statements.
+    Everything on the server is counted, including background work such as audit-log
+    batches, so run benchmarks against a database nothing else is using.
+    If the extension is not available, counts are reported as None.
+    """
+
+    def __init__(self):
+        self._conn = database.connect()
+        self._conn.autocommit = True
+        self.available = self._enable()
+
+    def _enable(self):
+        try:
+            with self._conn.cursor() as cursor:
+                cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_stat_statements")
+                cursor.execute("SELECT 1 FROM pg_stat_statements LIMIT 1")
+            return True
+        except psycopg2.Error as e:
+            print(f"⚠️ pg_stat_statements unavailable, queries per request will not be reported: {e}")
+            return False
+
+    def total(self):
+        if not self.available:
+            return None
+        with self._conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT COALESCE(sum(calls), 0) FROM pg_stat_statements
+                WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+            """)
+            # Minus one for this query itself.
+            return int(cursor.fetchone()[0]) - 1
+
+    def per_request(self, before, after, requests):
+        if before is None or after is None or not requests:
+            return None
+        return round((after - before) / requests, 2)
+
+    def close(self):
+        self._conn.close()
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    """Describes the run, so results from different machines or settings are not mixed up."""
+    return {
+        "revision": _git_revision(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "db_host": config.DB_HOST,
+        "db_name": config.DB_NAME,
+        "db_pool_max": config.DB_POOL_MAX,
+        "cache_backend": "redis" if config.CACHE_REDIS_URL else "local",
+    }
+
+
+def write_results(path, kind, parameters, results):
+    with open(path, "w") as f:
+        json.dump({"benchmark": kind, "environment": environment(), "parameters": parameters,
+                   "results": results}, f, indent=2)
+    print(f"Results written to {path}")
+
+
+def _flatten(value, prefix=""):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from _flatten(item, f"{prefix}{key}.")
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield prefix[:-1], value
+
+
+def compare(baseline_path, candidate_path):
+    """Prints every metric that differs between two result files, with the relative change."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    with open(candidate_path) as f:
+        candidate = json.load(f)
+    if baseline.get("benchmark") != candidate.get("benchmark"):
+        sys.exit(f"Cannot compare a {baseline.get('benchmark')} run with a {candidate.get('benchmark')} run")
+    if baseline.get("parameters") != candidate.get("parameters"):
+        print("⚠️ The runs used different parameters; differences may not be meaningful.")
+    before = dict(_flatten(baseline["results"]))
+    for metric, new in _flatten(candidate["results"]):
+        old = before.get(metric)
+        if old is None or old == new:
+            continue
+        change = f"{(new - old) / old * 100:+.1f}%" if old else "new"
+        print(f"{metric:<55} {old:>12} -> {new:<12} {change}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    args = parser.parse_args()
+    compare(args.baseline, args.candidate)
+
+
+if __name__ == "__main__":
+    main()
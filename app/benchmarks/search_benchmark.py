@@ -0,0 +1,164 @@
+# search_benchmark.py
+"""
+Measures catalogue search latency at several catalogue sizes.
+
+Each size is seeded into a throwaway `search_bench` schema (the real tables are never
+touched) and queried with a mix of substring, prefix and misspelled searches. The old
+ILIKE query is timed first against the unindexed table, as it ran before the search
+indexes existed. The table is then indexed exactly like the application schema and the
+ranked trigram search used by user_operations.search_available_books is timed.
+
+    python -m benchmarks.search_benchmark --sizes 10000 100000 1000000 --queries 200
+"""
+
+import argparse
+import json
+import random
+import statistics
+import time
+
+import database
+import migrations
+import user_operations
+
+SCHEMA = "search_bench"
+
+WORDS = [
+    "history", "river", "garden", "shadow", "empire", "winter", "silent", "ocean",
+    "machine", "forest", "letters", "kingdom", "journey", "science", "memory", "island",
+    "mountain", "secret", "harbor", "crystal", "thunder", "library", "window", "desert",
+]
+AUTHORS = [
+    "Austen", "Tolstoy", "Morrison", "Achebe", "Murakami", "Atwood", "Mahfouz", "Borges",
+    "Woolf", "Orwell", "Ishiguro", "Adichie", "Calvino", "Lessing", "Naipaul", "Rushdie",
+]
+
+LEGACY_SQL = """
+    SELECT id, title, author, category FROM books
+    WHERE status = 'available' AND (title ILIKE %(term)s OR author ILIKE %(term)s)
+"""
+
+
+def seed(cursor, size):
+    """Recreates the unindexed benchmark schema with `size` books, about 10% of them borrowed."""
+    cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    cursor.execute(f"CREATE SCHEMA {SCHEMA}")
+    cursor.execute(f"SET search_path TO {SCHEMA}, public")
+    cursor.execute("""
+        CREATE TABLE books (
+            id SERIAL PRIMARY KEY,
+            title TEXT NOT NULL,
+            author TEXT NOT NULL,
+            category TEXT,
+            status TEXT NOT NULL DEFAULT 'available' CHECK(status IN ('available', 'borrowed'))
+        )
+    """)
+    cursor.execute("""
+        INSERT INTO books (title, author, category, status)
+        SELECT initcap(w.words[1 + (i * 7) %% array_length(w.words, 1)]) || ' of the ' ||
+                   w.words[1 + (i * 13) %% array_length(w.words, 1)] || ' ' || i,
+               a.authors[1 + (i * 5) %% array_length(a.authors, 1)],
+               'Category ' || (i % 40),
+               CASE WHEN i % 10 = 0 THEN 'borrowed' ELSE 'available' END
+        FROM generate_series(1, %s) AS i,
+             (SELECT %s::text[] AS words) w,
+             (SELECT %s::text[] AS authors) a
+    """, (size, WORDS, AUTHORS))
+    cursor.execute("ANALYZE books")
+
+
+def create_search_indexes(cursor):
+    for statement in migrations.SEARCH_INDEX_DDL:
+        cursor.execute(statement)
+    cursor.execute("ANALYZE books")
+
+
+def misspell(word, rng):
+    """Swaps two adjacent letters to simulate a typo."""
+    i = rng.randrange(len(word) - 1)
+    return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+
+
+def build_queries(count, rng):
+    queries = []
+    for i in range(count):
+        kind = ("substring", "prefix", "typo")[i % 3]
+        word = rng.choice(WORDS + [a.lower() for a in AUTHORS])
+        if kind == "prefix":
+            word = word[:4]
+        elif kind == "typo":
+            word = misspell(word, rng)
+        queries.append((kind, word))
+    return queries
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def time_queries(cursor, queries, sql_for, params_for):
+    timings = {}
+    for kind, query in queries:
+        start = time.perf_counter()
+        cursor.execute(sql_for(query), params_for(query))
+        cursor.fetchall()
+        timings.setdefault(kind, []).append((time.perf_counter() - start) * 1000)
+    return {
+        kind: {
+            "p50_ms": round(statistics.median(samples), 3),
+            "p99_ms": round(percentile(samples, 0.99), 3),
+            "queries": len(samples),
+        }
+        for kind, samples in timings.items()
+    }
+
+
+def run(sizes, query_count, keep):
+    rng = random.Random(42)
+    results = []
+    conn = database.connect()
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            for size in sizes:
+                print(f"Seeding {size} books...")
+                seed(cursor, size)
+                queries = build_queries(query_count, rng)
+                legacy = time_queries(
+                    cursor, queries,
+                    lambda q: LEGACY_SQL,
+                    lambda q: {"term": f"%{q}%"})
+                create_search_indexes(cursor)
+                ranked = time_queries(
+                    cursor, queries,
+                    user_operations._available_books_sql,
+                    lambda q: user_operations._available_books_params(q, user_operations.SEARCH_PAGE_SIZE, 0))
+                results.append({"books": size, "ranked_search": ranked, "legacy_ilike": legacy})
+                for kind, stats in ranked.items():
+                    print(f"  {kind:<9} ranked p50={stats['p50_ms']:.2f}ms p99={stats['p99_ms']:.2f}ms"
+                          f" | legacy p50={legacy[kind]['p50_ms']:.2f}ms p99={legacy[kind]['p99_ms']:.2f}ms")
+            if not keep:
+                cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    finally:
+        conn.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--queries", type=int, default=200, help="searches timed per catalogue size")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--keep", action="store_true", help="leave the benchmark schema in place")
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.queries, args.keep)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
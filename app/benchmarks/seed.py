@@ -0,0 +1,136 @@
+# seed.py
+"""
+Seeds the configured database with a synthetic library for the load tests.
+
+Creates `--users` regular accounts (load-user-0, load-user-1, ...), one admin account
+(load-admin), `--books` books in `load-*` categories and `--transactions` returned loans
+spread over the last two years, each month in its own transactions partition (so the
+oldest are old enough to archive). All seeded accounts use the password in PASSWORD.
+Rows from a previous seed are removed first; nothing else in the database is touched,
+but run it against a disposable database (see benchmarks/docker-compose.yml).
+
+    python -m benchmarks.seed --books 100000 --users 1000 --transactions 500000
+"""
+
+import argparse
+import hashlib
+import time
+
+import database
+from config import TRANSACTIONS_PARTITIONS_AHEAD
+from benchmarks.search_benchmark import WORDS, AUTHORS
+
+PREFIX = "load-"
+PASSWORD = "load-password"
+# Seeded loans are borrowed between LOAN_MIN_AGE and LOAN_MIN_AGE + LOAN_SPREAD days ago.
+LOAN_SPREAD = 730
+LOAN_MIN_AGE = 14
+
+
+def clear(cursor):
+    """Deletes everything a previous seed created."""
+    cursor.execute("""
+        DELETE FROM transactions
+        WHERE user_id IN (SELECT id FROM users WHERE username LIKE 'load-%')
+           OR book_id IN (SELECT id FROM books WHERE category LIKE 'load-%')
+    """)
+    cursor.execute("DELETE FROM books WHERE category LIKE 'load-%'")
+    cursor.execute("DELETE FROM users WHERE username LIKE 'load-%'")
+
+
+def vacuum(tables):
+    """
+    VACUUM ANALYZEs freshly seeded tables, as autovacuum would soon after. Until then the
+    bulk-loaded rows sit in the GIN pending lists and the planner prices the trigram
+    indexes far above a sequential scan.
+    """
+    conn = database.connect()
+    conn.autocommit = True  # VACUUM cannot run inside a transaction.
+    try:
+        with conn.cursor() as cursor:
+            for table in tables:
+                cursor.execute(f"VACUUM ANALYZE {table}")
+    finally:
+        conn.close()
+
+
+def seed(books, users, transactions):
+    """Replaces the seeded data and returns the new books' id range as (first, last)."""
+    password_hash = hashlib.sha256(PASSWORD.encode()).hexdigest()
+    started = time.perf_counter()
+    with database.get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            clear(cursor)
+            cursor.execute("""
+                INSERT INTO users (username, password, role)
+                SELECT %s || 'user-' || i, %s, 'user' FROM generate_series(0, %s - 1) AS i
+            """, (PREFIX, password_hash, users))
+            cursor.execute("INSERT INTO users (username, password, role) VALUES (%s, %s, 'admin')",
+                           (f"{PREFIX}admin", password_hash))
+            cursor.execute("""
+                INSERT INTO books (title, author, category)
+                SELECT initcap(w.words[1 + (i * 7) %% array_length(w.words, 1)]) || ' of the ' ||
+                           w.words[1 + (i * 13) %% array_length(w.words, 1)] || ' ' || i,
+                       a.authors[1 + (i * 5) %% array_length(a.authors, 1)],
+                       %s || (i %% 40)
+                FROM generate_series(1, %s) AS i,
+                     (SELECT %s::text[] AS words) w,
+                     (SELECT %s::text[] AS authors) a
+                RETURNING id
+            """, (PREFIX, books, WORDS, AUTHORS))
+            book_ids = [row[0] for row in cursor.fetchall()]
+            # Partitions otherwise start at the current month and the back-dated loans would
+            # all land in transactions_default, where nothing is pruned or archived.
+            cursor.execute("SELECT ensure_transaction_partitions("
+                           "(LOCALTIMESTAMP - make_interval(days => %s))::date, %s)",
+                           (LOAN_SPREAD + LOAN_MIN_AGE, TRANSACTIONS_PARTITIONS_AHEAD))
+            cursor.execute("""
+                WITH u AS (SELECT array_agg(id ORDER BY id) AS ids, array_agg(username ORDER BY id) AS names
+                           FROM users WHERE username LIKE 'load-user-%%'),
+                     loans AS (
+                         SELECT i, 1 + (i::bigint * 7919) %% array_length(u.ids, 1) AS who,
+                                LOCALTIMESTAMP - make_interval(days => (i %% %s) + %s) AS borrowed
+                         FROM generate_series(1, %s) AS i, u)
+                INSERT INTO transactions (user_id, username, book_id, borrow_date, due_date, return_date)
+                SELECT u.ids[loans.who], u.names[loans.who], %s + (loans.i::bigint * 104729) %% %s,
+                       loans.borrowed, loans.borrowed + interval '14 days',
+                       loans.borrowed + make_interval(days => loans.i %% 14)
+                FROM loans, u
+            """, (LOAN_SPREAD, LOAN_MIN_AGE, transactions, min(book_ids), len(book_ids)))
+        conn.commit()
+    vacuum(("users", "books", "categories", "circulation_counters", "transactions"))
+    print(f"🌱 Seeded {users} users, {books} books and {transactions} loans "
+          f"in {time.perf_counter() - started:.1f}s")
+    return min(book_ids), max(book_ids)
+
+
+def seeded_book_range():
+    """Returns the (first, last) id of the currently seeded books, or None if there are none."""
+    with database.get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT min(id), max(id) FROM books WHERE category LIKE 'load-%'")
+            first, last = cursor.fetchone()
+    return (first, last) if first is not None else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--books", type=int, default=10_000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--transactions", type=int, default=50_000)
+    parser.add_argument("--clear", action="store_true", help="only remove previously seeded data")
+    args = parser.parse_args()
+
+    database.create_tables()
+    if args.clear:
+        with database.get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                clear(cursor)
+            conn.commit()
+        print("Seeded data removed.")
+    else:
+        seed(args.books, args.users, args.transactions)
+
+
+if __name__ == "__main__":
+    main()
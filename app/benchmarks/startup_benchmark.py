@@ -0,0 +1,68 @@
+# startup_benchmark.py
+"""
+Cold-start benchmark: how long a fresh gunicorn (with gunicorn.conf.py) takes to answer
+/healthz (workers are serving) and /readyz (the database answers and the schema is
+current), measured from process launch.
+
+Each of --runs runs starts gunicorn with --workers workers, polls both probes every 20 ms
+and stops it again. Initialization runs as in production (not skipped), against a
+database whose schema is already current, so the figures are what a restarted pod costs.
+
+    python -m benchmarks.startup_benchmark --runs 5 --workers 4 --output startup.json
+"""
+
+import argparse
+import statistics
+import time
+
+import database
+from benchmarks.load_test import start_gunicorn, wait_until_ready
+from benchmarks.results import percentile, write_results
+
+
+def measure(port, workers):
+    """Starts gunicorn once and returns {probe: seconds from launch to its first 200}."""
+    base_url = f"http://127.0.0.1:{port}"
+    started = time.monotonic()
+    process = start_gunicorn(port, workers, skip_db_init=False)
+    try:
+        healthy = wait_until_ready(process, base_url, started, path="/healthz")
+        ready = wait_until_ready(process, base_url, started, path="/readyz")
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+    return {"healthz": healthy, "readyz": ready}
+
+
+def _summary(samples):
+    return {"runs": len(samples),
+            "mean_s": round(statistics.fmean(samples), 3),
+            "p50_s": round(percentile(samples, 0.50), 3),
+            "max_s": round(max(samples), 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn worker processes")
+    parser.add_argument("--port", type=int, default=5056)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    database.create_tables()
+    samples = {"healthz": [], "readyz": []}
+    for run in range(args.runs):
+        timings = measure(args.port, args.workers)
+        for probe, seconds in timings.items():
+            samples[probe].append(seconds)
+        print(f"run {run + 1}: serving after {timings['healthz']:.2f}s, ready after {timings['readyz']:.2f}s")
+
+    results = {probe: _summary(values) for probe, values in samples.items()}
+    for probe, summary in results.items():
+        print(f"{probe:<8} p50 {summary['p50_s']:.2f}s  mean {summary['mean_s']:.2f}s  max {summary['max_s']:.2f}s")
+    if args.output:
+        write_results(args.output, "startup", {"runs": args.runs, "workers": args.workers}, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+# bulk_operations.py
+
+import csv
+import io
+import json
+import queue
+import threading
+
+from database import get_db_connection
+from cache import bump_catalogue_version
+
+# Rows accepted by import_books, in the column order CSV files must use (with a header row).
+IMPORT_COLUMNS = ('title', 'author', 'category')
+
+# Queries behind each export, streamed out with COPY ... TO STDOUT.
+EXPORTS = {
+    'books': "SELECT id, title, author, category, status FROM books ORDER BY id",
+    'transactions': """
+        SELECT id, user_id, username, book_id, borrow_date, due_date, return_date
+        FROM transactions ORDER BY id
+    """,
+}
+
+# Size of each chunk handed to the HTTP response when streaming an export, and how many
+# chunks may be buffered between the COPY thread and the response.
+_EXPORT_CHUNK_SIZE = 64 * 1024
+_EXPORT_QUEUE_CHUNKS = 16
+
+
+class _JsonLinesAsCsv:
+    """Read-only file adapter that turns a JSON Lines stream into CSV for COPY, one line at a time."""
+
+    def __init__(self, stream):
+        self._lines = iter(stream)
+        self._buffer = ','.join(IMPORT_COLUMNS) + '\n'
+        self._line_number = 0
+
+    def _csv_row(self, record):
+        out = io.StringIO()
+        csv.writer(out, lineterminator='\n').writerow(record.get(column) for column in IMPORT_COLUMNS)
+        return out.getvalue()
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            self._line_number += 1
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"Invalid JSON on line {self._line_number}: {e}") from None
+            if not isinstance(record, dict):
+                raise ValueError(f"Line {self._line_number} is not a JSON object")
+            self._buffer += self._csv_row(record)
+        if size < 0:
+            size = len(self._buffer)
+        chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+
+def import_books(stream, fmt='csv'):
+    """
+    Bulk-loads books from a CSV (with a title,author,category header) or JSON Lines stream.
+
+    Rows are streamed into a temporary staging table with COPY and merged into books in a
+    single transaction. Blank titles or authors are dropped, and rows that repeat a book
+    already in the catalogue or earlier in the file (same title and author, ignoring case
+    and surrounding whitespace) are skipped.
+    Returns a dict with the number of rows 'staged', 'imported' and 'skipped'.
+    """
+    source = _JsonLinesAsCsv(stream) if fmt == 'jsonl' else stream
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                CREATE TEMP TABLE books_staging (title TEXT, author TEXT, category TEXT)
+                ON COMMIT DROP
+            """)
+            cursor.copy_expert(
+                "COPY books_staging (title, author, category) FROM STDIN WITH (FORMAT csv, HEADER true)",
+                source)
+            cursor.execute("SELECT count(*) FROM books_staging")
+            staged = cursor.fetchone()[0]
+            cursor.execute("""
+                INSERT INTO books (title, author, category)
+                SELECT DISTINCT ON (lower(s.title), lower(s.author)) s.title, s.author, s.category
+                FROM (SELECT btrim(title) AS title, btrim(author) AS author,
+                             NULLIF(btrim(category), '') AS category
+                      FROM books_staging) s
+                WHERE s.title <> '' AND s.author <> ''
+                  AND NOT EXISTS (SELECT 1 FROM books b
+                                  WHERE lower(b.title) = lower(s.title)
+                                    AND lower(b.author) = lower(s.author))
+                ORDER BY lower(s.title), lower(s.author)
+            """)
+            imported = cursor.rowcount
+        conn.commit()
+    if imported:
+        bump_catalogue_version()
+    return {'staged': staged, 'imported': imported, 'skipped': staged - imported}
+
+
+def _copy_out_sql(name):
+    if name not in EXPORTS:
+        raise ValueError(f"Unknown export: {name}")
+    return f"COPY ({EXPORTS[name]}) TO STDOUT WITH (FORMAT csv, HEADER true)"
+
+
+def _copy_out(sql, out_file):
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.copy_expert(sql, out_file)
+
+
+def export_csv(name, out_file):
+    """Writes the named export ('books' or 'transactions') as CSV to a file object."""
+    _copy_out(_copy_out_sql(name), out_file)
+
+
+class _ExportCancelled(Exception):
+    pass
+
+
+class _QueueWriter:
+    """File adapter that batches the rows COPY writes into chunks on a bounded queue."""
+
+    def __init__(self, chunks, cancelled):
+        self._chunks = chunks
+        self._cancelled = cancelled
+        self._pending = []
+        self._pending_size = 0
+
+    def write(self, data):
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if self._pending_size >= _EXPORT_CHUNK_SIZE:
+            self.flush()
+        return len(data)
+
+    def put(self, item):
+        while True:
+            if self._cancelled.is_set():
+                raise _ExportCancelled()
+            try:
+                self._chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def flush(self):
+        if self._pending:
+            # psycopg2 writes bytes to plain (non-text) file objects.
+            self.put(self._pending[0][:0].join(self._pending))
+            self._pending, self._pending_size = [], 0
+
+
+def stream_export(name):
+    """
+    Yields the named export as CSV chunks while COPY is still running.
+    At most a small, fixed number of chunks is ever held in memory; if the consumer
+    stops early (for example the HTTP client disconnects) the COPY is aborted.
+    """
+    sql = _copy_out_sql(name)
+    chunks = queue.Queue(maxsize=_EXPORT_QUEUE_CHUNKS)
+    cancelled = threading.Event()
+    done = object()
+    failure = []
+
+    def copy_out():
+        writer = _QueueWriter(chunks, cancelled)
+        try:
+            _copy_out(sql, writer)
+            writer.flush()
+        except Exception as e:
+            if not cancelled.is_set():
+                failure.append(e)
+        finally:
+            try:
+                writer.put(done)
+            except _ExportCancelled:
+                pass
+
+    worker = threading.Thread(target=copy_out, name=f"export-{name}", daemon=True)
+    worker.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is done:
+                break
+            yield chunk
+        if failure:
+            raise failure[0]
+    finally:
+        cancelled.set()
+        worker.join()
+
@@ -0,0 +1,308 @@
+# cache.py
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import database
+from config import CATALOGUE_CACHE_SIZE, CATALOGUE_CACHE_TTL, CACHE_REDIS_URL
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    A thread-safe, size-limited LRU cache whose entries also expire after `ttl` seconds.
+    Keeps hit, miss and eviction counters so the cache can be sized from real traffic.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()   # key -> (expires at, value), least recently used first
+        self._lock = threading.Lock()
+        # Bumped by every invalidation, so a load that raced with one is not cached.
+        self._generation = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+
+    def get(self, key, default=None):
+        """Returns the cached value for `key`, or `default` if it is absent or expired."""
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is _MISSING:
+                self.stats['misses'] += 1
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self.stats['expirations'] += 1
+                self.stats['misses'] += 1
+                return default
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return value
+
+    def set(self, key, value, generation=None):
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def get_or_load(self, key, loader):
+        """Returns the cached value for `key`, calling `loader()` and caching its result on a miss."""
+        generation = self._generation
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = loader()
+            self.set(key, value, generation)
+        return value
+
+    async def get_or_load_async(self, key, loader):
+        """Like get_or_load, for a `loader` that is a coroutine function (see async_operations.py)."""
+        generation = self._generation
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = await loader()
+            self.set(key, value, generation)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generation += 1
+            if self._entries.pop(key, _MISSING) is not _MISSING:
+                self.stats['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self.stats['invalidations'] += len(self._entries)
+            self._entries.clear()
+
+    def snapshot(self):
+        """Returns the counters together with the current and maximum size."""
+        with self._lock:
+            return dict(self.stats, size=len(self._entries), maxsize=self.maxsize)
+
+
+class LocalCacheBackend:
+    """Cache backend that keeps entries and version counters in this process."""
+
+    def __init__(self, maxsize, ttl):
+        self._entries = TTLCache(maxsize, ttl)
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self._entries.get(key, _MISSING)
+
+    def set(self, key, value):
+        self._entries.set(key, value)
+
+    def get_version(self, namespace):
+        with self._lock:
+            return self._versions.get(namespace, 0)
+
+    def incr_version(self, namespace):
+        with self._lock:
+            self._versions[namespace] = self._versions.get(namespace, 0) + 1
+            return self._versions[namespace]
+
+    def snapshot(self):
+        return dict(self._entries.snapshot(), backend='local')
+
+
+class RedisCacheBackend:
+    """
+    Cache backend on any Redis-compatible client (get, set with ex, incr).
+    Values are stored as JSON, and version counters are shared by every process using it.
+    """
+
+    def __init__(self, client, ttl, prefix='lms:'):
+        self._client = client
+        self._ttl = int(ttl)
+        self._prefix = prefix
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'errors': 0}
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def get(self, key):
+        try:
+            raw = self._client.get(self._prefix + key)
+        except Exception:
+            self._count('errors')
+            return _MISSING
+        if raw is None:
+            self._count('misses')
+            return _MISSING
+        self._count('hits')
+        return json.loads(raw)
+
+    def set(self, key, value):
+        try:
+            self._client.set(self._prefix + key, json.dumps(value, default=str), ex=self._ttl)
+        except Exception:
+            self._count('errors')
+
+    def get_version(self, namespace):
+        try:
+            return int(self._client.get(f"{self._prefix}version:{namespace}") or 0)
+        except Exception:
+            self._count('errors')
+            return None
+
+    def incr_version(self, namespace):
+        try:
+            return self._client.incr(f"{self._prefix}version:{namespace}")
+        except Exception:
+            self._count('errors')
+            return None
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, backend='redis')
+
+
+class InMemoryRedis:
+    """Minimal in-process stand-in for a Redis client, covering what RedisCacheBackend uses."""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value, expires_at = self._data.get(key, (None, None))
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, ex=None):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ex if ex else None)
+        return True
+
+    def incr(self, key):
+        with self._lock:
+            value, expires_at = self._data.get(key, (0, None))
+            value = int(value) + 1
+            self._data[key] = (value, expires_at)
+            return value
+
+    def delete(self, key):
+        with self._lock:
+            return 1 if self._data.pop(key, None) else 0
+
+
+class VersionedCache:
+    """
+    Read-through cache whose keys embed a version number. Bumping the version makes every
+    existing entry unreachable at once; stale entries then age out of the backend.
+    """
+
+    def __init__(self, backend, namespace):
+        self.backend = backend
+        self.namespace = namespace
+
+    def lookup(self, key):
+        """
+        Returns (value, slot) for `key` at the current version. On a miss the value is None;
+        pass the slot to store() so the loaded value is filed under the version it was read at.
+        """
+        version = self.backend.get_version(self.namespace)
+        if version is None:
+            return None, None  # The backend is unreachable; read straight through.
+        slot = f"{self.namespace}:v{version}:{key}"
+        value = self.backend.get(slot)
+        return (None, slot) if value is _MISSING else (value, None)
+
+    def store(self, slot, value):
+        if slot is not None:
+            self.backend.set(slot, value)
+
+    def get_or_load(self, key, loader):
+        """Returns the value cached for `key` at the current version, loading it on a miss."""
+        value, slot = self.lookup(key)
+        if value is None:
+            value = loader()
+            self.store(slot, value)
+        return value
+
+    def bump_version(self):
+        """Invalidates every entry in this cache."""
+        self.backend.incr_version(self.namespace)
+
+    def snapshot(self):
+        return dict(self.backend.snapshot(), namespace=self.namespace,
+                    version=self.backend.get_version(self.namespace))
+
+
+def _make_backend(maxsize, ttl, redis_url):
+    if not redis_url:
+        return LocalCacheBackend(maxsize, ttl)
+    if redis_url == 'memory://':
+        return RedisCacheBackend(InMemoryRedis(), ttl)
+    import redis  # Optional dependency, only needed when CACHE_REDIS_URL points at a server.
+    return RedisCacheBackend(redis.Redis.from_url(redis_url), ttl)
+
+
+# NOTIFY channel the books-table trigger (migration 7) publishes on after any change.
+CATALOGUE_CHANGES_CHANNEL = 'catalogue_changes'
+
+# Cache of catalogue listings: available books, admin book pages.
+catalogue_cache = VersionedCache(
+    _make_backend(CATALOGUE_CACHE_SIZE, CATALOGUE_CACHE_TTL, CACHE_REDIS_URL), 'catalogue')
+_catalogue_subscribed_pid = None
+
+
+def _ensure_catalogue_subscription():
+    # With the local backend each process keeps its own version, so it listens for
+    # catalogue-change notifications and writes made by other workers invalidate its
+    # entries too. The Redis backend shares one version across processes.
+    global _catalogue_subscribed_pid
+    if isinstance(catalogue_cache.backend, LocalCacheBackend) and _catalogue_subscribed_pid != os.getpid():
+        _catalogue_subscribed_pid = os.getpid()
+        database.subscribe(CATALOGUE_CHANGES_CHANNEL,
+                           lambda payload: catalogue_cache.bump_version(),
+                           on_reset=catalogue_cache.bump_version)
+
+
+def cached_catalogue_read(key, loader):
+    """
+    Serves a catalogue read from catalogue_cache, calling `loader()` on a miss.
+    Rows are converted to plain dicts so they can be stored in any backend.
+    """
+    _ensure_catalogue_subscription()
+    return catalogue_cache.get_or_load(key, lambda: _plain_rows(loader()))
+
+
+def lookup_catalogue(key):
+    """Returns (value, slot) from catalogue_cache; on a miss, load and pass slot to store_catalogue."""
+    _ensure_catalogue_subscription()
+    return catalogue_cache.lookup(key)
+
+
+def store_catalogue(slot, value):
+    catalogue_cache.store(slot, _plain_rows(value))
+
+
+def _plain_rows(value):
+    if isinstance(value, tuple):
+        return tuple(_plain_rows(item) for item in value)
+    if isinstance(value, list):
+        return [dict(row) for row in value]
+    return value
+
+
+def bump_catalogue_version():
+    """Called after every write to books so cached catalogue reads are never served stale."""
+    catalogue_cache.bump_version()
@@ -1,58 +1,334 @@
+# check_dbTables.py
+"""
+Database diagnostics for the database configured in config.py (DB_HOST, DB_NAME, ...).
+
+Reports, without scanning any table:
+  * estimated rows (from pg_class), table and index sizes and dead-tuple bloat per table,
+    with partitions rolled up into their parent;
+  * buffer cache hit ratios for the database, each table and each index;
+  * indexes that have never been scanned since the statistics were last reset;
+  * missing indexes: sequential scans in the plans of the hot statements (statements.py)
+    and the admin listings, and tables read mostly by large sequential scans;
+  * the most expensive statements from pg_stat_statements, when it is installed.
+
+    python check_dbTables.py                 # human-readable report
+    python check_dbTables.py --json          # one JSON document
+    python check_dbTables.py --fail-on-findings --allow-seq-scan categories
+
+With --fail-on-findings the exit status is 1 whenever a finding is reported, so the
+diagnostics Job (k8s/11-db-diagnostics-job.yml) fails on a performance regression.
+"""
+
+import argparse
+import json
+import sys
+
 import psycopg2
+import psycopg2.extras
+import database
+import statements
+import admin_operations as admin_ops
+from pagination import encode_cursor
 
-print("🔍 CHECKING DATABASE TABLES...")
-print("=" * 50)
-
-try:
-    conn = psycopg2.connect(
-        host="localhost",
-        database="library",
-        user="postgres", 
-        password="password",
-        port="5432"
-    )
-    cursor = conn.cursor()
-    
-    print("✅ Connected to PostgreSQL!")
-    print()
-    
-    # Check all tables
+# A table is flagged as bloated above this share of dead tuples (and DEAD_TUPLES_MIN of them).
+DEAD_TUPLE_RATIO = 0.2
+DEAD_TUPLES_MIN = 10_000
+# Cache hit ratios below this are flagged once at least HIT_RATIO_MIN_READS blocks were read.
+HIT_RATIO_MIN = 0.95
+HIT_RATIO_MIN_READS = 10_000
+# Unscanned indexes smaller than this are not worth reporting.
+UNUSED_INDEX_MIN_BYTES = 1024 * 1024
+# A table is flagged as missing an index when most of its scans are sequential and they
+# read more than this many rows each on average.
+SEQ_SCAN_ROWS_MIN = 10_000
+
+
+def _ratio(hits, reads):
+    total = (hits or 0) + (reads or 0)
+    return round((hits or 0) / total, 4) if total else None
+
+
+def table_report(cursor):
+    """Estimated rows, sizes, dead tuples, scans and heap hit ratio per table, partitions rolled up."""
     cursor.execute("""
-        SELECT table_name 
-        FROM information_schema.tables 
-        WHERE table_schema = 'public'
-        ORDER BY table_name
+        SELECT COALESCE(root.relname, c.relname) AS table_name, root.oid IS NOT NULL AS is_partition,
+               GREATEST(c.reltuples, 0)::bigint AS estimated_rows,
+               pg_table_size(c.oid) AS table_bytes,
+               pg_indexes_size(c.oid) AS index_bytes,
+               COALESCE(s.n_dead_tup, 0) AS dead_tuples,
+               COALESCE(s.n_live_tup, 0) AS live_tuples,
+               COALESCE(s.seq_scan, 0) AS seq_scans,
+               COALESCE(s.seq_tup_read, 0) AS seq_rows_read,
+               COALESCE(s.idx_scan, 0) AS index_scans,
+               COALESCE(io.heap_blks_hit, 0) AS heap_hits,
+               COALESCE(io.heap_blks_read, 0) AS heap_reads,
+               GREATEST(s.last_vacuum, s.last_autovacuum) AS last_vacuum,
+               GREATEST(s.last_analyze, s.last_autoanalyze) AS last_analyze
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+        LEFT JOIN pg_statio_user_tables io ON io.relid = c.oid
+        LEFT JOIN pg_class root ON root.oid = pg_partition_root(c.oid) AND root.oid <> c.oid
+        WHERE n.nspname = 'public' AND c.relkind IN ('r', 'm')
     """)
-    tables = cursor.fetchall()
-    
-    print("📊 TABLES IN DATABASE:")
-    if tables:
-        for table in tables:
-            print(f"   ✅ {table[0]}")
-    else:
+    tables = {}
+    for row in cursor.fetchall():
+        table = tables.setdefault(row['table_name'], {
+            'table': row['table_name'], 'partitions': 0, 'estimated_rows': 0, 'table_bytes': 0,
+            'index_bytes': 0, 'dead_tuples': 0, 'live_tuples': 0, 'seq_scans': 0, 'seq_rows_read': 0,
+            'index_scans': 0, 'heap_hits': 0, 'heap_reads': 0, 'last_vacuum': None, 'last_analyze': None})
+        table['partitions'] += row['is_partition']
+        for field in ('estimated_rows', 'table_bytes', 'index_bytes', 'dead_tuples', 'live_tuples',
+                      'seq_scans', 'seq_rows_read', 'index_scans', 'heap_hits', 'heap_reads'):
+            table[field] += row[field]
+        # For a partitioned table, the oldest vacuum or analyze of any partition.
+        for field in ('last_vacuum', 'last_analyze'):
+            if row[field] is not None and (table[field] is None or row[field] < table[field]):
+                table[field] = row[field]
+    for table in tables.values():
+        table['total_bytes'] = table['table_bytes'] + table['index_bytes']
+        tuples = table['live_tuples'] + table['dead_tuples']
+        table['dead_ratio'] = round(table['dead_tuples'] / tuples, 4) if tuples else 0.0
+        table['heap_hit_ratio'] = _ratio(table.pop('heap_hits'), table['heap_reads'])
+    return sorted(tables.values(), key=lambda table: table['total_bytes'], reverse=True)
+
+
+def index_report(cursor):
+    """Size, scans and hit ratio per index, partition indexes rolled up into their parent index."""
+    cursor.execute("""
+        SELECT COALESCE(root.relname, i.relname) AS index_name,
+               COALESCE(root_table.relname, t.relname) AS table_name,
+               x.indisunique OR x.indisprimary AS is_unique,
+               pg_relation_size(i.oid) AS index_bytes,
+               COALESCE(s.idx_scan, 0) AS scans,
+               COALESCE(io.idx_blks_hit, 0) AS hits,
+               COALESCE(io.idx_blks_read, 0) AS reads
+        FROM pg_index x
+        JOIN pg_class i ON i.oid = x.indexrelid
+        JOIN pg_class t ON t.oid = x.indrelid
+        JOIN pg_namespace n ON n.oid = i.relnamespace
+        LEFT JOIN pg_stat_user_indexes s ON s.indexrelid = i.oid
+        LEFT JOIN pg_statio_user_indexes io ON io.indexrelid = i.oid
+        LEFT JOIN pg_class root ON root.oid = pg_partition_root(i.oid) AND root.oid <> i.oid
+        LEFT JOIN pg_class root_table ON root_table.oid = pg_partition_root(t.oid) AND root_table.oid <> t.oid
+        WHERE n.nspname = 'public' AND i.relkind = 'i'
+    """)
+    indexes = {}
+    for row in cursor.fetchall():
+        index = indexes.setdefault(row['index_name'], {
+            'index': row['index_name'], 'table': row['table_name'], 'unique': row['is_unique'],
+            'index_bytes': 0, 'scans': 0, 'hits': 0, 'reads': 0})
+        for field in ('index_bytes', 'scans', 'hits', 'reads'):
+            index[field] += row[field]
+    for index in indexes.values():
+        index['hit_ratio'] = _ratio(index.pop('hits'), index['reads'])
+    return sorted(indexes.values(), key=lambda index: index['index_bytes'], reverse=True)
+
+
+def database_report(cursor):
+    """Database-wide buffer cache hit ratio and when the statistics were last reset."""
+    cursor.execute("""
+        SELECT blks_hit, blks_read, stats_reset, pg_database_size(datname) AS database_bytes
+        FROM pg_stat_database WHERE datname = current_database()
+    """)
+    row = cursor.fetchone()
+    return {'database_bytes': row['database_bytes'], 'blocks_read': row['blks_read'],
+            'hit_ratio': _ratio(row['blks_hit'], row['blks_read']), 'stats_reset': row['stats_reset']}
+
+
+def _admin_statements():
+    # The admin dashboard's listings: the first and a later page of each book ordering, and
+    # of the borrowing records, built with admin_operations' own query builders.
+    examples = {'id': 1000}
+    for sort in admin_ops.BOOK_SORT_COLUMNS:
+        for after in (None, encode_cursor(examples.get(sort, 'M'), 1000)):
+            _, sql, params = admin_ops.books_page_query(sort, False, after, admin_ops.ADMIN_PAGE_SIZE)
+            yield statements.Statement(f"admin_books_{sort}{'_keyset' if after else ''}", sql, params)
+    for after in (None, encode_cursor('2024-01-01 00:00:00', 1000)):
+        sql, params = admin_ops.records_page_query(after, admin_ops.ADMIN_PAGE_SIZE)
+        yield statements.Statement(f"admin_records{'_keyset' if after else ''}", sql, params)
+
+
+def plan_report(conn):
+    """
+    EXPLAINs the hot statements and the admin listings with their example parameters and
+    returns, per statement, the tables its plan reads with a sequential scan (or the error).
+    """
+    plans = []
+    for statement in [*statements.load_all().values(), *_admin_statements()]:
+        entry = {'statement': statement.name}
+        try:
+            with conn.cursor() as cursor:
+                _, entry['seq_scans'] = statements.explain(cursor, statement)
+        except psycopg2.Error as e:
+            entry['error'] = str(e).strip().splitlines()[0]
+        conn.rollback()
+        plans.append(entry)
+    return plans
+
+
+def top_statements(cursor, limit):
+    """The `limit` statements with the most total execution time, or None without pg_stat_statements."""
+    cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_stat_statements'")
+    if cursor.fetchone() is None:
+        return None
+    # The timing columns were renamed in PostgreSQL 13.
+    cursor.execute("SHOW server_version_num")
+    total, mean = (('total_exec_time', 'mean_exec_time') if int(cursor.fetchone()[0]) >= 130000
+                   else ('total_time', 'mean_time'))
+    try:
+        cursor.execute(f"""
+            SELECT left(regexp_replace(query, '\\s+', ' ', 'g'), 200) AS query, calls,
+                   round({total}::numeric, 1) AS total_ms, round({mean}::numeric, 3) AS mean_ms, rows,
+                   shared_blks_hit, shared_blks_read
+            FROM pg_stat_statements
+            WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+            ORDER BY {total} DESC
+            LIMIT %s
+        """, (limit,))
+    except psycopg2.Error:
+        # Installed but not in shared_preload_libraries.
+        cursor.connection.rollback()
+        return None
+    rows = []
+    for row in cursor.fetchall():
+        row = dict(row)
+        row['hit_ratio'] = _ratio(row.pop('shared_blks_hit'), row.pop('shared_blks_read'))
+        row['total_ms'], row['mean_ms'] = float(row['total_ms']), float(row['mean_ms'])
+        rows.append(row)
+    return rows
+
+
+def findings(report, allow_seq_scan=()):
+    """
+    Turns the report into a list of problems worth acting on. Sequential scans in the plans
+    of tables in `allow_seq_scan` (small lookup tables, read whole anyway) are not reported.
+    """
+    found = []
+    for table in report['tables']:
+        if table['dead_tuples'] >= DEAD_TUPLES_MIN and table['dead_ratio'] >= DEAD_TUPLE_RATIO:
+            found.append({'kind': 'bloat', 'table': table['table'],
+                          'detail': f"{table['dead_ratio']:.0%} dead tuples ({table['dead_tuples']})"})
+        if table['heap_reads'] >= HIT_RATIO_MIN_READS and table['heap_hit_ratio'] < HIT_RATIO_MIN:
+            found.append({'kind': 'low_hit_ratio', 'table': table['table'],
+                          'detail': f"heap hit ratio {table['heap_hit_ratio']:.2%}"})
+        if (table['seq_scans'] > table['index_scans']
+                and table['seq_rows_read'] / max(table['seq_scans'], 1) >= SEQ_SCAN_ROWS_MIN):
+            found.append({'kind': 'missing_index', 'table': table['table'],
+                          'detail': f"{table['seq_scans']} sequential scans reading "
+                                    f"{table['seq_rows_read'] // table['seq_scans']} rows each, "
+                                    f"{table['index_scans']} index scans"})
+    for index in report['indexes']:
+        if not index['unique'] and index['scans'] == 0 and index['index_bytes'] >= UNUSED_INDEX_MIN_BYTES:
+            found.append({'kind': 'unused_index', 'table': index['table'], 'index': index['index'],
+                          'detail': f"never scanned, {index['index_bytes']} bytes"})
+        if index['reads'] >= HIT_RATIO_MIN_READS and index['hit_ratio'] < HIT_RATIO_MIN:
+            found.append({'kind': 'low_hit_ratio', 'table': index['table'], 'index': index['index'],
+                          'detail': f"index hit ratio {index['hit_ratio']:.2%}"})
+    for plan in report['plans']:
+        if 'error' in plan:
+            found.append({'kind': 'plan_error', 'statement': plan['statement'], 'detail': plan['error']})
+        for table in plan.get('seq_scans', ()):
+            if table in allow_seq_scan:
+                continue
+            found.append({'kind': 'missing_index', 'table': table, 'statement': plan['statement'],
+                          'detail': 'sequential scan in the plan'})
+    return found
+
+
+def collect(top=10, explain=True, allow_seq_scan=()):
+    """Gathers the whole report over one dedicated connection."""
+    conn = database.connect()
+    try:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            report = {'database': database_report(cursor),
+                      'tables': table_report(cursor),
+                      'indexes': index_report(cursor)}
+        conn.rollback()
+        report['plans'] = plan_report(conn) if explain else []
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            report['top_statements'] = top_statements(cursor, top)
+    finally:
+        conn.close()
+    report['findings'] = findings(report, allow_seq_scan)
+    return report
+
+
+def _size(size):
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+def print_report(report):
+    db = report['database']
+    print("🔍 DATABASE DIAGNOSTICS")
+    print("=" * 50)
+    print(f"📦 Size {_size(db['database_bytes'])}, cache hit ratio {db['hit_ratio']}, "
+          f"statistics since {db['stats_reset'] or 'the server started'}")
+    if not report['tables']:
         print("   ❌ No tables found!")
         print("   💡 Run: python database.py to create tables")
-    
     print()
-    
-    # Check if admin user exists
-    cursor.execute("SELECT username, role FROM users WHERE username = 'admin'")
-    admin = cursor.fetchone()
-    if admin:
-        print(f"✅ Admin user exists: {admin[0]} (Role: {admin[1]})")
+    print("📊 TABLES (estimated rows, table + index size, dead tuples):")
+    for t in report['tables']:
+        print(f"   {t['table']}: ~{t['estimated_rows']} rows, {_size(t['table_bytes'])} + "
+              f"{_size(t['index_bytes'])}, {t['dead_ratio']:.0%} dead, hit ratio {t['heap_hit_ratio']}, "
+              f"{t['seq_scans']} seq / {t['index_scans']} index scans")
+    print()
+    print("🗂️ INDEXES (size, scans, hit ratio):")
+    for i in report['indexes']:
+        print(f"   {i['table']}.{i['index']}: {_size(i['index_bytes'])}, {i['scans']} scans, hit ratio {i['hit_ratio']}")
+    print()
+    print("🧭 PLANS OF THE HOT QUERIES:")
+    for plan in report['plans']:
+        if 'error' in plan:
+            print(f"   ❌ {plan['statement']}: {plan['error']}")
+        elif plan['seq_scans']:
+            print(f"   ⚠️ {plan['statement']}: sequential scan on {', '.join(plan['seq_scans'])}")
+        else:
+            print(f"   ✅ {plan['statement']}")
+    print()
+    if report['top_statements'] is None:
+        print("🐢 TOP STATEMENTS: pg_stat_statements is not installed")
     else:
-        print("❌ No admin user found!")
-        
-    # Count records in each table
-    for table in ['users', 'books', 'transactions']:
-        cursor.execute(f"SELECT COUNT(*) FROM {table}")
-        count = cursor.fetchone()[0]
-        print(f"   {table}: {count} records")
-    
-    cursor.close()
-    conn.close()
-    
-except Exception as e:
-    print(f"❌ Error: {e}")
-
-print("=" * 50)
\ No newline at end of file
+        print("🐢 TOP STATEMENTS (total ms, calls, mean ms):")
+        for s in report['top_statements']:
+            print(f"   {s['total_ms']:>12} {s['calls']:>10} {s['mean_ms']:>10}  {s['query']}")
+    print()
+    if report['findings']:
+        print(f"❌ {len(report['findings'])} FINDINGS:")
+        for f in report['findings']:
+            where = f.get('index') or f.get('statement') or ''
+            print(f"   [{f['kind']}] {f.get('table', '')} {where}: {f['detail']}")
+    else:
+        print("✅ No findings.")
+    print("=" * 50)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--json", action="store_true", help="print the report as one JSON document")
+    parser.add_argument("--top", type=int, default=10, help="statements to list from pg_stat_statements")
+    parser.add_argument("--no-explain", action="store_true", help="skip EXPLAINing the hot queries")
+    parser.add_argument("--fail-on-findings", action="store_true", help="exit 1 if anything is reported")
+    parser.add_argument("--allow-seq-scan", action="append", default=[], metavar="TABLE",
+                        help="a table the plans may read with a sequential scan (repeatable)")
+    args = parser.parse_args()
+
+    try:
+        report = collect(args.top, not args.no_explain, args.allow_seq_scan)
+    except psycopg2.Error as e:
+        print(f"❌ Error: {e}", file=sys.stderr)
+        return 2
+    if args.json:
+        print(json.dumps(report, indent=2, default=str))
+    else:
+        print_report(report)
+    return 1 if args.fail_on_findings and report['findings'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,285 @@
+# compaction.py
+
+import argparse
+import gzip
+import json
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from config import (COMPACTION_ROOT, COMPACTION_MIN_SIZE, COMPACTION_MIN_AGE, COMPACTION_FORMAT,
+                    COMPACTION_WORKERS, COMPACTION_BLOCK_SIZE, COMPACTION_LEVEL)
+
+EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+# Compression level per format when COMPACTION_LEVEL is not set.
+DEFAULT_LEVELS = {'gzip': 6, 'zstd': 3}
+# Suffixes of files this job writes, which are never themselves compacted.
+_OWN_SUFFIXES = ('.gz', '.zst', '.part', '.compacting.json', '.compacting.json.tmp')
+# How often (seconds) progress on a single large file is reported.
+PROGRESS_INTERVAL = 30
+
+
+def find_candidates(root, min_size, min_age):
+    """
+    Walks `root` recursively with os.scandir and yields (path, stat) for every regular file
+    of at least `min_size` bytes not modified in the last `min_age` seconds.
+    Symbolic links are not followed, and already-compressed files are skipped.
+    """
+    cutoff = time.time() - min_age
+    pending = [root]
+    while pending:
+        directory = pending.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False) and not entry.name.endswith(_OWN_SUFFIXES):
+                            stat = entry.stat(follow_symlinks=False)
+                            if stat.st_size >= min_size and stat.st_mtime <= cutoff:
+                                yield entry.path, stat
+                    except OSError:
+                        continue  # Vanished or unreadable while we were looking.
+        except OSError:
+            continue
+
+
+def _compress_block(path, offset, length, fmt, level):
+    """Runs in a worker process: reads one block of `path` and compresses it as a self-contained member."""
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(length)
+    if fmt == 'zstd':
+        import zstandard  # Optional dependency, only needed for COMPACTION_FORMAT=zstd.
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    # Concatenated gzip members form a valid gzip file that gunzip and gzip.open read whole.
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def _fsync_directory(path):
+    fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _Manifest:
+    """
+    Progress record kept next to the partial output (`<target>.compacting.json`), so an
+    interrupted compaction resumes from its last completed block instead of starting over.
+    """
+
+    def __init__(self, target):
+        self.path = f"{target}.compacting.json"
+        self.state = None
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.state = json.load(f)
+        except (OSError, ValueError):
+            self.state = None
+        return self.state
+
+    def save(self, **state):
+        self.state = state
+        temporary = f"{self.path}.tmp"
+        with open(temporary, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class Compactor:
+    """
+    Compresses large files with block-parallel gzip (or zstd) on a process pool.
+
+    Each file is split into `block_size` blocks that are compressed independently by the
+    workers and written in order to `<file>.gz.part`. When every block is written the part
+    file is fsynced and atomically renamed over `<file>.gz`, and only then is the original
+    removed. A manifest records progress after each block, so a crash or restart resumes
+    the file where it stopped; files changed since the manifest was written start over.
+    """
+
+    def __init__(self, workers=COMPACTION_WORKERS, block_size=COMPACTION_BLOCK_SIZE,
+                 fmt=COMPACTION_FORMAT, level=COMPACTION_LEVEL, report=None):
+        if fmt not in EXTENSIONS:
+            raise ValueError(f"Unknown compaction format: {fmt}")
+        self.workers = workers or os.cpu_count() or 1
+        self.block_size = block_size
+        self.fmt = fmt
+        self.level = level or DEFAULT_LEVELS[fmt]
+        self.report = report or (lambda action, details: print(f"🗜️ {action}: {details}"))
+
+    def run(self, root=COMPACTION_ROOT, min_size=COMPACTION_MIN_SIZE, min_age=COMPACTION_MIN_AGE):
+        """Compacts every candidate under `root` and returns one alert message per file."""
+        alerts = []
+        started = time.monotonic()
+        compressed = total_in = total_out = 0
+        # 'spawn' keeps worker start-up safe inside a threaded server process.
+        with ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            for path, stat in find_candidates(root, min_size, min_age):
+                try:
+                    written = self.compact_file(pool, path, stat)
+                except Exception as e:
+                    message = f"Error compressing {path}: {e}"
+                    alerts.append(message)
+                    self.report("System Error", message)
+                    continue
+                if written is None:
+                    continue
+                compressed += 1
+                total_in += stat.st_size
+                total_out += written
+                alerts.append(self._file_message(path, stat.st_size, written))
+        if compressed:
+            elapsed = time.monotonic() - started
+            self.report("System Alert",
+                        f"Compaction of {root} finished: {compressed} files, "
+                        f"{_gb(total_in):.2f} GB -> {_gb(total_out):.2f} GB in {elapsed:.0f}s "
+                        f"({_mb(total_in) / max(elapsed, 0.001):.0f} MB/s)")
+        return alerts
+
+    def _file_message(self, path, size, written):
+        message = (f"Compressed {os.path.basename(path)} due to large size ({_gb(size):.2f} GB "
+                   f"-> {_gb(written):.2f} GB).")
+        self.report("System Alert", message)
+        return message
+
+    def compact_file(self, pool, path, stat):
+        """
+        Compresses one file, resuming a previous attempt if possible. Returns the compressed
+        size, or None if the file changed while it was being compressed and was left alone.
+        """
+        target = path + EXTENSIONS[self.fmt]
+        part = target + '.part'
+        manifest = _Manifest(target)
+        source = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'format': self.fmt,
+                  'block_size': self.block_size}
+
+        state = manifest.load()
+        if state and state.get('source') == source and state.get('complete') and os.path.exists(target):
+            # Crashed after the rename but before the original was removed.
+            return self._finish(path, target, manifest, state['written'])
+
+        blocks = (stat.st_size + self.block_size - 1) // self.block_size
+        done, written = 0, 0
+        if state and state.get('source') == source and os.path.exists(part):
+            done, written = state['blocks'], state['written']
+            self.report("System Alert", f"Resuming compression of {path} at block {done}/{blocks}")
+        mode = 'r+b' if done else 'wb'
+
+        started = time.monotonic()
+        last_report = started
+        with open(part, mode) as out:
+            out.truncate(written)
+            out.seek(written)
+            in_flight = []
+            next_block = done
+            while done < blocks:
+                # Keep a bounded number of blocks in flight so memory use stays flat.
+                while next_block < blocks and len(in_flight) < self.workers * 2:
+                    in_flight.append(pool.submit(_compress_block, path, next_block * self.block_size,
+                                                 self.block_size, self.fmt, self.level))
+                    next_block += 1
+                data = in_flight.pop(0).result()
+                out.write(data)
+                out.flush()
+                os.fsync(out.fileno())
+                done += 1
+                written += len(data)
+                manifest.save(source=source, blocks=done, written=written, complete=False)
+                if time.monotonic() - last_report >= PROGRESS_INTERVAL:
+                    last_report = time.monotonic()
+                    processed = min(done * self.block_size, stat.st_size)
+                    self.report("System Alert",
+                                f"Compressing {path}: {processed * 100 // max(stat.st_size, 1)}% "
+                                f"at {_mb(processed) / (last_report - started):.0f} MB/s")
+
+        current = os.stat(path)
+        if current.st_size != stat.st_size or current.st_mtime_ns != stat.st_mtime_ns:
+            os.remove(part)
+            manifest.remove()
+            self.report("System Alert", f"Skipped {path}: it changed while being compressed")
+            return None
+
+        manifest.save(source=source, blocks=done, written=written, complete=True)
+        os.replace(part, target)
+        _fsync_directory(target)
+        return self._finish(path, target, manifest, written)
+
+    def _finish(self, path, target, manifest, written):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        manifest.remove()
+        return written
+
+
+def _gb(size):
+    return size / (1024 * 1024 * 1024)
+
+
+def _mb(size):
+    return size / (1024 * 1024)
+
+
+class CompactionJob:
+    """A compaction run on a background thread; wait() returns its alerts."""
+
+    def __init__(self, compactor, root, min_size, min_age):
+        self.alerts = None
+        self._thread = threading.Thread(target=self._run, args=(compactor, root, min_size, min_age),
+                                        name="compaction", daemon=True)
+        self._thread.start()
+
+    def _run(self, compactor, root, min_size, min_age):
+        try:
+            self.alerts = compactor.run(root, min_size, min_age)
+        except Exception as e:
+            self.alerts = [f"Compaction of {root} failed: {e}"]
+            compactor.report("System Error", self.alerts[0])
+
+    @property
+    def running(self):
+        return self._thread.is_alive()
+
+    def wait(self, timeout=None):
+        self._thread.join(timeout)
+        return self.alerts
+
+
+_job = None
+_job_lock = threading.Lock()
+
+
+def start_job(report=None, root=COMPACTION_ROOT, min_size=COMPACTION_MIN_SIZE, min_age=COMPACTION_MIN_AGE):
+    """Starts a background compaction run, or returns the one already in progress in this process."""
+    global _job
+    with _job_lock:
+        if _job is None or not _job.running:
+            _job = CompactionJob(Compactor(report=report), root, min_size, min_age)
+        return _job
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compress large, idle files in parallel.")
+    parser.add_argument("root", nargs="?", default=COMPACTION_ROOT)
+    parser.add_argument("--min-size", type=int, default=COMPACTION_MIN_SIZE, help="bytes")
+    parser.add_argument("--min-age", type=float, default=COMPACTION_MIN_AGE, help="seconds since last change")
+    parser.add_argument("--format", choices=sorted(EXTENSIONS), default=COMPACTION_FORMAT)
+    parser.add_argument("--workers", type=int, default=COMPACTION_WORKERS)
+    args = parser.parse_args()
+    Compactor(workers=args.workers, fmt=args.format).run(args.root, args.min_size, args.min_age)
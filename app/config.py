@@ -9,4 +9,150 @@ DB_NAME = os.getenv("DB_NAME", "library")
 DB_USER = os.getenv("DB_USER", "user")
 DB_PASS = os.getenv("DB_PASS", "password")
 DB_HOST = os.getenv("DB_HOST", "localhost")
-DB_PORT = os.getenv("DB_PORT", "5432")
\ No newline at end of file
+DB_PORT = os.getenv("DB_PORT", "5432")
+# Seconds to wait for a new connection to be established before giving up.
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "5"))
+
+# Read replicas: a comma-separated list of libpq connection strings or postgresql:// URIs.
+# Read-only queries are spread over them round-robin (see database.get_read_connection);
+# empty means every query goes to the primary above. A replica that fails, or lags the
+# primary by more than DB_REPLICA_MAX_LAG seconds, is skipped for DB_REPLICA_CHECK_INTERVAL
+# seconds. After a user borrows or returns a book their reads stay on the primary for
+# READ_YOUR_WRITES_WINDOW seconds, so they always see their own change.
+DB_REPLICA_DSNS = [dsn.strip() for dsn in os.getenv("DB_REPLICA_DSNS", "").split(",") if dsn.strip()]
+DB_REPLICA_MAX_LAG = float(os.getenv("DB_REPLICA_MAX_LAG", "5"))
+DB_REPLICA_CHECK_INTERVAL = float(os.getenv("DB_REPLICA_CHECK_INTERVAL", "5"))
+READ_YOUR_WRITES_WINDOW = float(os.getenv("READ_YOUR_WRITES_WINDOW", "5"))
+
+# Connection pool settings (per worker process).
+# DB_POOL_MIN connections are opened eagerly, up to DB_POOL_MAX are opened on demand.
+# A checkout waits at most DB_POOL_TIMEOUT seconds for a free connection before failing.
+# Idle connections older than DB_POOL_MAX_IDLE seconds are pinged before being handed out.
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "30"))
+
+# The hot statements in statements.py are prepared once per pooled connection and then
+# run with EXECUTE. Set DB_PREPARED_STATEMENTS=0 behind a transaction-pooling PgBouncer,
+# which does not keep server sessions (and their prepared statements) per client.
+DB_PREPARED_STATEMENTS = int(os.getenv("DB_PREPARED_STATEMENTS", "1"))
+
+# Statements that hit a serialization failure or deadlock are retried this many times in
+# total, sleeping a jittered DB_RETRY_BACKOFF * 2**attempt seconds between attempts.
+DB_RETRY_ATTEMPTS = int(os.getenv("DB_RETRY_ATTEMPTS", "3"))
+DB_RETRY_BACKOFF = float(os.getenv("DB_RETRY_BACKOFF", "0.05"))
+
+# In-process cache of user records (id, username, role) consulted on every request.
+# Entries are dropped on LISTEN/NOTIFY change events; the TTL bounds staleness if
+# the notification listener is disconnected.
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "30"))
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+
+# Versioned read cache for catalogue listings (see cache.catalogue_cache).
+# Entries live in an in-process LRU by default. Set CACHE_REDIS_URL to share them through
+# Redis, or to "memory://" for an in-process Redis stand-in (useful for local testing).
+CATALOGUE_CACHE_SIZE = int(os.getenv("CATALOGUE_CACHE_SIZE", "256"))
+CATALOGUE_CACHE_TTL = float(os.getenv("CATALOGUE_CACHE_TTL", "300"))
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "")
+
+# Audit log pipeline (see audit.py). Entries are queued in memory and batch-inserted by a
+# background thread; if PostgreSQL is unreachable they are appended to files in
+# AUDIT_SPILL_DIR and replayed once it is back.
+AUDIT_QUEUE_SIZE = int(os.getenv("AUDIT_QUEUE_SIZE", "10000"))
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "500"))
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", "1"))
+AUDIT_SPILL_DIR = os.getenv("AUDIT_SPILL_DIR", "/tmp/lms-audit-spill")
+
+# Statements taking at least SLOW_QUERY_MS milliseconds are printed to the log and counted
+# in lms_db_slow_queries_total on /metrics. 0 turns the slow-query log off.
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "0"))
+
+# Gunicorn workers each keep their own metrics. With METRICS_DIR set, every process writes
+# them to a file there (every METRICS_FLUSH_INTERVAL seconds and on each scrape) and /metrics
+# sums the files, so a scrape reports the whole pod whichever worker answers it (see
+# metrics.py). The gunicorn configs default it to /tmp/lms-metrics; empty = this process only.
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "1"))
+
+# Background compaction of large files (see compaction.py). Files under COMPACTION_ROOT of
+# at least COMPACTION_MIN_SIZE bytes, unchanged for COMPACTION_MIN_AGE seconds, are
+# compressed in COMPACTION_BLOCK_SIZE blocks by COMPACTION_WORKERS processes (0 = one per
+# CPU). COMPACTION_FORMAT is "gzip" or "zstd" (needs the zstandard package).
+COMPACTION_ROOT = os.getenv("COMPACTION_ROOT", os.path.dirname(os.path.abspath(__file__)))
+COMPACTION_MIN_SIZE = int(os.getenv("COMPACTION_MIN_SIZE", str(1024 ** 3)))
+COMPACTION_MIN_AGE = float(os.getenv("COMPACTION_MIN_AGE", "300"))
+COMPACTION_FORMAT = os.getenv("COMPACTION_FORMAT", "gzip")
+COMPACTION_WORKERS = int(os.getenv("COMPACTION_WORKERS", "0"))
+COMPACTION_BLOCK_SIZE = int(os.getenv("COMPACTION_BLOCK_SIZE", str(16 * 1024 * 1024)))
+COMPACTION_LEVEL = int(os.getenv("COMPACTION_LEVEL", "0"))
+
+# Transactions are partitioned by borrow month (see partitions.py). Maintenance keeps
+# TRANSACTIONS_PARTITIONS_AHEAD months of empty partitions ready, and archives fully
+# returned partitions older than TRANSACTIONS_ARCHIVE_AFTER_MONTHS as gzipped CSV files in
+# TRANSACTIONS_ARCHIVE_DIR before dropping them (0 = never archive). TRANSACTIONS_ARCHIVE_DIR
+# may be an s3://bucket/prefix URL (needs boto3), so that every pod can read the archive.
+TRANSACTIONS_PARTITIONS_AHEAD = int(os.getenv("TRANSACTIONS_PARTITIONS_AHEAD", "3"))
+TRANSACTIONS_ARCHIVE_AFTER_MONTHS = int(os.getenv("TRANSACTIONS_ARCHIVE_AFTER_MONTHS", "24"))
+TRANSACTIONS_ARCHIVE_DIR = os.getenv("TRANSACTIONS_ARCHIVE_DIR", "/var/lib/lms/archive")
+
+# Overdue loans (see overdue.py). A worker flags loans whose due date has passed every
+# OVERDUE_SCAN_INTERVAL seconds, OVERDUE_BATCH_SIZE loans per statement, and accrues a fine
+# of OVERDUE_FINE_PER_DAY cents per started day, at most OVERDUE_FINE_CAP cents.
+# OVERDUE_NOTIFY picks where notices go: "log", "file:/path/notices.jsonl",
+# "smtp://host:port" or "none". Users have no e-mail column, so mail is addressed to
+# <username>@OVERDUE_MAIL_DOMAIN.
+OVERDUE_SCAN_INTERVAL = float(os.getenv("OVERDUE_SCAN_INTERVAL", "60"))
+OVERDUE_BATCH_SIZE = int(os.getenv("OVERDUE_BATCH_SIZE", "1000"))
+OVERDUE_FINE_PER_DAY = int(os.getenv("OVERDUE_FINE_PER_DAY", "25"))
+OVERDUE_FINE_CAP = int(os.getenv("OVERDUE_FINE_CAP", "2000"))
+OVERDUE_NOTIFY = os.getenv("OVERDUE_NOTIFY", "log")
+OVERDUE_MAIL_FROM = os.getenv("OVERDUE_MAIL_FROM", "library@localhost")
+OVERDUE_MAIL_DOMAIN = os.getenv("OVERDUE_MAIL_DOMAIN", "localhost")
+
+# Startup and probes (see startup.py). At startup PostgreSQL is polled with a backoff
+# for up to DB_INIT_TIMEOUT seconds before migrations run. /readyz caches its database
+# check for READY_CHECK_INTERVAL seconds and waits at most READY_CHECK_TIMEOUT seconds
+# for a pooled connection.
+DB_INIT_TIMEOUT = float(os.getenv("DB_INIT_TIMEOUT", "60"))
+READY_CHECK_INTERVAL = float(os.getenv("READY_CHECK_INTERVAL", "1"))
+READY_CHECK_TIMEOUT = float(os.getenv("READY_CHECK_TIMEOUT", "1"))
+
+# Signs the session cookie. The sync (app.py) and async (asgi.py) entry points share it, so a
+# session started on either is valid on both.
+SECRET_KEY = os.getenv("SECRET_KEY", "your_super_secret_key_for_dev")
+
+# Async serving mode (asgi.py, served by gunicorn_asgi.conf.py). Each worker process keeps an
+# asyncpg pool of ASYNC_POOL_MIN to ASYNC_POOL_MAX connections, accepts up to
+# ASYNC_MAX_CONNECTIONS concurrent client connections (answering 503 beyond that) and
+# closes keep-alive connections idle for ASYNC_KEEPALIVE seconds. Routes without an async
+# implementation run the sync app on ASYNC_SYNC_THREADS threads per worker.
+ASYNC_POOL_MIN = int(os.getenv("ASYNC_POOL_MIN", "2"))
+ASYNC_POOL_MAX = int(os.getenv("ASYNC_POOL_MAX", "20"))
+ASYNC_MAX_CONNECTIONS = int(os.getenv("ASYNC_MAX_CONNECTIONS", "4096"))
+ASYNC_KEEPALIVE = int(os.getenv("ASYNC_KEEPALIVE", "75"))
+ASYNC_SYNC_THREADS = int(os.getenv("ASYNC_SYNC_THREADS", "8"))
+
+# Admission control (see admission.py). Login and signup attempts are rate-limited with token
+# buckets per client IP and per username: each bucket holds up to *_BURST attempts and
+# refills at *_RATE attempts per second (0 turns a limit off). Buckets are kept in this
+# process unless ADMISSION_REDIS_URL is set ("memory://" for the in-process stand-in, as
+# for CACHE_REDIS_URL), which shares them between workers.
+LOGIN_RATE_PER_IP = float(os.getenv("LOGIN_RATE_PER_IP", "0.5"))
+LOGIN_BURST_PER_IP = int(os.getenv("LOGIN_BURST_PER_IP", "20"))
+LOGIN_RATE_PER_USER = float(os.getenv("LOGIN_RATE_PER_USER", "0.1"))
+LOGIN_BURST_PER_USER = int(os.getenv("LOGIN_BURST_PER_USER", "5"))
+SIGNUP_RATE_PER_IP = float(os.getenv("SIGNUP_RATE_PER_IP", "0.05"))
+SIGNUP_BURST_PER_IP = int(os.getenv("SIGNUP_BURST_PER_IP", "5"))
+ADMISSION_REDIS_URL = os.getenv("ADMISSION_REDIS_URL", "")
+ADMISSION_MAX_BUCKETS = int(os.getenv("ADMISSION_MAX_BUCKETS", "100000"))
+
+# Requests handled at once per worker; beyond that they are answered 503 with Retry-After
+# (ADMISSION_RETRY_AFTER seconds) instead of queueing for a connection. 0 uses the size of
+# the connection pool the request would draw on (DB_POOL_MAX, or ASYNC_POOL_MAX in asgi.py).
+ADMISSION_MAX_CONCURRENCY = int(os.getenv("ADMISSION_MAX_CONCURRENCY", "0"))
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "1"))
+
+# Reverse proxies in front of the app that append the client address to X-Forwarded-For.
+# The client IP used for rate limits is the address that many hops from the right.
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "0"))
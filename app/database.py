@@ -1,84 +1,580 @@
 # database.py
 
+import os
+import time
+import random
+import select
+import itertools
+import threading
+import contextvars
+import functools
+from contextlib import contextmanager
+
 import psycopg2
 import psycopg2.extras
-import hashlib
-from config import DB_NAME, DB_USER, DB_PASS, DB_HOST, DB_PORT
-
-def get_db_connection():
-    """Establishes a connection to the PostgreSQL database."""
-    conn = psycopg2.connect(
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASS,
-        host=DB_HOST,
-        port=DB_PORT
-    )
+import psycopg2.extensions
+import psycopg2.errors
+import metrics
+import statements
+from config import (DB_NAME, DB_USER, DB_PASS, DB_HOST, DB_PORT, DB_CONNECT_TIMEOUT,
+                    DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_MAX_IDLE,
+                    DB_RETRY_ATTEMPTS, DB_RETRY_BACKOFF, DB_REPLICA_DSNS, DB_REPLICA_MAX_LAG,
+                    DB_REPLICA_CHECK_INTERVAL, READ_YOUR_WRITES_WINDOW)
+
+
+class PoolTimeoutError(Exception):
+    """Raised when no pooled connection becomes free within the checkout timeout."""
+
+
+def connect(dsn=None):
+    """Opens a new, unpooled connection to the primary PostgreSQL database, or to `dsn` if given."""
+    start = time.perf_counter()
+    if dsn:
+        conn = psycopg2.connect(dsn, connect_timeout=DB_CONNECT_TIMEOUT,
+                                connection_factory=metrics.InstrumentedConnection)
+    else:
+        conn = psycopg2.connect(
+            dbname=DB_NAME,
+            user=DB_USER,
+            password=DB_PASS,
+            host=DB_HOST,
+            port=DB_PORT,
+            connect_timeout=DB_CONNECT_TIMEOUT,
+            connection_factory=metrics.InstrumentedConnection
+        )
+    metrics.observe_connect(time.perf_counter() - start)
     return conn
 
+
+class ConnectionPool:
+    """A thread-safe, blocking connection pool owned by a single process.
+
+    Connections are health-checked on checkout: closed or broken connections are
+    replaced, and connections idle for longer than `max_idle` seconds are pinged first.
+    """
+
+    def __init__(self, connect_fn, minconn, maxconn, timeout, max_idle):
+        self._connect = connect_fn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.pid = os.getpid()
+        self._idle = []      # (connection, last returned at) pairs, most recent last
+        self._size = 0       # open connections, idle and checked out
+        self._cond = threading.Condition()
+        self.stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'reconnects': 0,
+            'connections_opened': 0,
+        }
+        for _ in range(minconn):
+            try:
+                conn = self._open()
+            except psycopg2.OperationalError:
+                break  # The database may not be up yet; connections are opened on demand.
+            self._size += 1
+            self._idle.append((conn, time.monotonic()))
+
+    def _open(self):
+        conn = self._connect()
+        with self._cond:
+            self.stats['connections_opened'] += 1
+        return conn
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        if time.monotonic() - last_used < self.max_idle:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _release_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def getconn(self, timeout=None):
+        """Checks out a connection, waiting up to `timeout` (default: the pool's) seconds for one to free up."""
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        conn, last_used = None, None
+        with self._cond:
+            waited = False
+            while True:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    self._size += 1
+                    break
+                if not waited:
+                    self.stats['waits'] += 1
+                    waited = True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.stats['timeouts'] += 1
+                    raise PoolTimeoutError(
+                        f"No database connection became free within {timeout}s "
+                        f"(pool size {self.maxconn})")
+                self._cond.wait(remaining)
+            self.stats['checkouts'] += 1
+
+        if conn is not None:
+            if self._is_healthy(conn, last_used):
+                return conn
+            _close_quietly(conn)
+            with self._cond:
+                self.stats['reconnects'] += 1
+        try:
+            return self._open()
+        except Exception:
+            self._release_slot()
+            raise
+
+    def putconn(self, conn):
+        """Returns a connection to the pool, rolling back any transaction left open."""
+        if not conn.closed:
+            status = conn.info.transaction_status
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                _close_quietly(conn)
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    _close_quietly(conn)
+        if conn.closed:
+            self._release_slot()
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        """Closes every idle connection; checked-out connections close when returned."""
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for conn, _ in idle:
+            _close_quietly(conn)
+
+    def snapshot(self):
+        """Returns the pool counters together with its current size."""
+        with self._cond:
+            return dict(self.stats, size=self._size, idle=len(self._idle), maxconn=self.maxconn)
+
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+# Connections inherited from a parent process. They are kept referenced and never
+# closed, because closing them would terminate the parent's server sessions.
+_inherited_connections = []
+
+
+def get_pool():
+    """Returns this process's connection pool, creating a fresh one after a fork."""
+    global _pool
+    pool = _pool
+    if pool is not None and pool.pid == os.getpid():
+        return pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            _discard_inherited_pool()
+            _pool = ConnectionPool(connect, DB_POOL_MIN, DB_POOL_MAX,
+                                   DB_POOL_TIMEOUT, DB_POOL_MAX_IDLE)
+        return _pool
+
+
+def _discard_inherited_pool():
+    global _pool, _replicas
+    if _pool is not None and _pool.pid != os.getpid():
+        _inherited_connections.extend(conn for conn, _ in _pool._idle)
+        _pool = None
+    if _replicas is not None and _replicas.pid != os.getpid():
+        for replica in _replicas.replicas:
+            _inherited_connections.extend(conn for conn, _ in replica.pool._idle)
+        _replicas = None
+
+
+def _reset_pool_after_fork():
+    global _pool_lock, _listener_lock, _replicas_lock
+    _pool_lock = threading.Lock()
+    _listener_lock = threading.Lock()
+    _replicas_lock = threading.Lock()
+    _discard_inherited_pool()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_pool_after_fork)
+
+
+@contextmanager
+def get_db_connection(timeout=None):
+    """Borrows a connection from the process-wide pool for the duration of a `with` block.
+
+    Uncommitted work is rolled back when the connection is returned. `timeout` overrides
+    DB_POOL_TIMEOUT for this checkout.
+    """
+    pool = get_pool()
+    start = time.perf_counter()
+    conn = pool.getconn(timeout)
+    metrics.observe_checkout(time.perf_counter() - start)
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+
+def pool_stats():
+    """Returns checkout, wait, timeout and reconnect counters for this process's pool."""
+    return get_pool().snapshot()
+
+
+class _Replica:
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.pool = ConnectionPool(functools.partial(connect, dsn), 0, DB_POOL_MAX,
+                                   DB_POOL_TIMEOUT, DB_POOL_MAX_IDLE)
+        self.skip_until = 0.0    # monotonic time before which the replica is not used
+        self.checked_at = 0.0    # monotonic time of the last replication lag check
+
+
+class ReplicaSet:
+    """
+    Per-process pools for the read replicas, handed out round-robin.
+
+    A replica whose connection fails is skipped for `check_interval` seconds. Every
+    `check_interval` seconds a replica's replication lag is checked on the connection about
+    to be used, and a replica more than `max_lag` seconds behind is skipped as well.
+    """
+
+    # Zero when the standby has replayed everything it received (an idle primary sends
+    # nothing, which would otherwise look like ever-growing lag).
+    LAG_SQL = """
+        SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+               END
+    """
+
+    def __init__(self, dsns, max_lag, check_interval):
+        self.pid = os.getpid()
+        self.replicas = [_Replica(dsn) for dsn in dsns]
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+        self.stats = {'replica_reads': 0, 'primary_reads': 0, 'pinned_reads': 0,
+                      'failures': 0, 'lagging': 0}
+
+    def count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def skip(self, replica, stat='failures'):
+        replica.skip_until = time.monotonic() + self.check_interval
+        self.count(stat)
+
+    def _lag(self, conn):
+        with conn.cursor() as cursor:
+            cursor.execute(self.LAG_SQL)
+            lag = cursor.fetchone()[0]
+        conn.rollback()
+        return float(lag)
+
+    def checkout(self, preferred=None):
+        """
+        Returns (replica, connection) from the next usable replica, trying `preferred` first,
+        or None if there is none.
+        """
+        start = next(self._turn)
+        order = [self.replicas[(start + i) % len(self.replicas)] for i in range(len(self.replicas))]
+        if preferred is not None:
+            order.remove(preferred)
+            order.insert(0, preferred)
+        for replica in order:
+            now = time.monotonic()
+            if replica.skip_until > now:
+                continue
+            try:
+                conn = replica.pool.getconn()
+            except (psycopg2.OperationalError, PoolTimeoutError):
+                self.skip(replica)
+                continue
+            if now - replica.checked_at >= self.check_interval:
+                replica.checked_at = now
+                try:
+                    lagging = self._lag(conn) > self.max_lag
+                except psycopg2.Error:
+                    replica.pool.putconn(conn)
+                    self.skip(replica)
+                    continue
+                if lagging:
+                    replica.pool.putconn(conn)
+                    self.skip(replica, 'lagging')
+                    continue
+            self.count('replica_reads')
+            return replica, conn
+        return None
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+        now = time.monotonic()
+        stats['replicas'] = len(self.replicas)
+        stats['replicas_available'] = sum(1 for replica in self.replicas if replica.skip_until <= now)
+        return stats
+
+
+_replicas = None
+_replicas_lock = threading.Lock()
+
+
+def get_replicas():
+    """Returns this process's ReplicaSet, or None when no replicas are configured."""
+    global _replicas
+    if not DB_REPLICA_DSNS:
+        return None
+    replicas = _replicas
+    if replicas is not None and replicas.pid == os.getpid():
+        return replicas
+    with _replicas_lock:
+        if _replicas is None or _replicas.pid != os.getpid():
+            _discard_inherited_pool()
+            _replicas = ReplicaSet(DB_REPLICA_DSNS, DB_REPLICA_MAX_LAG, DB_REPLICA_CHECK_INTERVAL)
+        return _replicas
+
+
+# Wall-clock time until which reads in this context must see the primary (read-your-writes).
+_primary_reads_until = contextvars.ContextVar('primary_reads_until', default=0.0)
+
+
+def note_write():
+    """
+    Keeps this context's reads on the primary for READ_YOUR_WRITES_WINDOW seconds, so the
+    caller sees its own write even if the replicas have not replayed it yet.
+    Returns the time the window ends; the web app carries it over in the user's session.
+    """
+    until = time.time() + READ_YOUR_WRITES_WINDOW
+    _primary_reads_until.set(until)
+    return until
+
+
+def pin_reads_until(until):
+    """Restores a read-your-writes window (a time.time() value, or None for none)."""
+    _primary_reads_until.set(until or 0.0)
+
+
+def reads_pinned_until():
+    return _primary_reads_until.get()
+
+
+# Set by consistent_reads(): a one-item list holding the replica this context reads from.
+_sticky_replica = contextvars.ContextVar('sticky_replica', default=None)
+
+
+@contextmanager
+def consistent_reads():
+    """
+    Sends every read inside the block to the same replica (while it stays healthy), so
+    later reads never see an older state than earlier ones, e.g. a version number and
+    then the data it describes.
+    """
+    token = _sticky_replica.set([None])
+    try:
+        yield
+    finally:
+        _sticky_replica.reset(token)
+
+
+@contextmanager
+def get_read_connection():
+    """
+    Borrows a connection for read-only queries: from the next healthy replica when replicas
+    are configured, otherwise (or inside a read-your-writes window) from the primary pool.
+    """
+    replicas = get_replicas()
+    picked = None
+    if replicas is not None:
+        if _primary_reads_until.get() > time.time():
+            replicas.count('pinned_reads')
+        else:
+            sticky = _sticky_replica.get()
+            start = time.perf_counter()
+            picked = replicas.checkout(sticky[0] if sticky else None)
+            if picked is None:
+                replicas.count('primary_reads')
+            else:
+                metrics.observe_checkout(time.perf_counter() - start)
+                if sticky is not None:
+                    sticky[0] = picked[0]
+    if picked is None:
+        with get_db_connection() as conn:
+            yield conn
+        return
+
+    replica, conn = picked
+    try:
+        yield conn
+    except psycopg2.OperationalError:
+        replicas.skip(replica)
+        raise
+    finally:
+        replica.pool.putconn(conn)
+
+
+def replica_stats():
+    """Returns read routing counters, or an empty dict when no replicas are configured."""
+    replicas = get_replicas()
+    return replicas.snapshot() if replicas is not None else {}
+
+
+class NotificationListener:
+    """
+    Background thread that LISTENs on PostgreSQL channels over its own dedicated connection
+    and dispatches each NOTIFY payload to the subscribed callbacks.
+
+    Notifications sent while the listener is disconnected are lost, so every subscriber's
+    `on_reset` callback runs whenever the listener (re)connects.
+    """
+
+    RECONNECT_DELAY = 5
+    POLL_INTERVAL = 5
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self._subscribers = {}      # channel -> [(callback, on_reset)]
+        self._listening = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self, channel, callback, on_reset=None):
+        with self._lock:
+            self._subscribers.setdefault(channel, []).append((callback, on_reset))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="pg-notify-listener", daemon=True)
+                self._thread.start()
+
+    def _reset_all(self):
+        with self._lock:
+            resets = [on_reset for subs in self._subscribers.values() for _, on_reset in subs if on_reset]
+        for on_reset in resets:
+            on_reset()
+
+    def _listen_to_new_channels(self, cursor):
+        with self._lock:
+            channels = set(self._subscribers) - self._listening
+        for channel in channels:
+            # Channel names are internal constants, never user input.
+            cursor.execute(f'LISTEN "{channel}"')
+            self._listening.add(channel)
+
+    def _dispatch(self, notify):
+        with self._lock:
+            callbacks = [callback for callback, _ in self._subscribers.get(notify.channel, [])]
+        for callback in callbacks:
+            callback(notify.payload)
+
+    def _run(self):
+        while True:
+            conn = None
+            try:
+                conn = connect()
+                conn.autocommit = True
+                self._listening = set()
+                with conn.cursor() as cursor:
+                    self._listen_to_new_channels(cursor)
+                    self._reset_all()
+                    while True:
+                        select.select([conn], [], [], self.POLL_INTERVAL)
+                        conn.poll()
+                        while conn.notifies:
+                            self._dispatch(conn.notifies.pop(0))
+                        self._listen_to_new_channels(cursor)
+            except Exception as e:
+                print(f"⚠️ Notification listener disconnected: {e}")
+                self._reset_all()
+            finally:
+                if conn is not None:
+                    _close_quietly(conn)
+            time.sleep(self.RECONNECT_DELAY)
+
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def subscribe(channel, callback, on_reset=None):
+    """
+    Calls `callback(payload)` for every NOTIFY on `channel` received by this process, and
+    `on_reset()` whenever notifications may have been missed. Safe to call after a fork.
+    """
+    global _listener
+    with _listener_lock:
+        if _listener is None or _listener.pid != os.getpid():
+            _listener = NotificationListener()
+        listener = _listener
+    listener.subscribe(channel, callback, on_reset)
+
+
+# Errors that mean "a concurrent transaction got in the way", which are safe to retry.
+RETRYABLE_ERRORS = (psycopg2.errors.SerializationFailure, psycopg2.errors.DeadlockDetected)
+
+
+def execute_atomic(query, params=None, cursor_factory=None, attempts=None):
+    """
+    Runs a single statement (SQL, or a Statement registered in statements.py) in autocommit
+    mode and returns its rows ([] if it returns none).
+
+    The statement is its own implicit transaction, so it is atomic and costs exactly one
+    round trip with no separate COMMIT. Serialization failures and deadlocks are retried
+    with jittered exponential backoff, up to `attempts` tries (DB_RETRY_ATTEMPTS by default).
+    """
+    attempts = attempts or DB_RETRY_ATTEMPTS
+    for attempt in range(1, attempts + 1):
+        with get_db_connection() as conn:
+            conn.autocommit = True
+            try:
+                with conn.cursor(cursor_factory=cursor_factory) as cursor:
+                    if isinstance(query, statements.Statement):
+                        statements.execute(cursor, query, params)
+                    else:
+                        cursor.execute(query, params)
+                    return cursor.fetchall() if cursor.description else []
+            except RETRYABLE_ERRORS:
+                if attempt == attempts:
+                    raise
+            finally:
+                if not conn.closed:
+                    conn.autocommit = False
+        time.sleep(DB_RETRY_BACKOFF * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+
+
 def create_tables():
-    """Creates the necessary tables in the database if they don't exist."""
-    conn = get_db_connection()
-    # Use DictCursor to access columns by name
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-
-    # Create users table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id SERIAL PRIMARY KEY,
-            username TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL,
-            role TEXT NOT NULL CHECK(role IN ('user', 'admin'))
-        );
-    ''')
-
-    # Create books table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS books (
-            id SERIAL PRIMARY KEY,
-            title TEXT NOT NULL,
-            author TEXT NOT NULL,
-            category TEXT,
-            status TEXT NOT NULL DEFAULT 'available' CHECK(status IN ('available', 'borrowed'))
-        );
-    ''')
-
-    # Create transactions table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS transactions (
-            id SERIAL PRIMARY KEY,
-            user_id INTEGER NOT NULL,
-            username TEXT NOT NULL,
-            book_id INTEGER NOT NULL,
-            borrow_date TEXT NOT NULL,
-            due_date TEXT NOT NULL,
-            return_date TEXT,
-            FOREIGN KEY (user_id) REFERENCES users (id),
-            FOREIGN KEY (book_id) REFERENCES books (id)
-        );
-    ''')
-
-    # Create logs table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS logs (
-            id SERIAL PRIMARY KEY,
-            timestamp TEXT NOT NULL,
-            action TEXT NOT NULL,
-            details TEXT
-        );
-    ''')
-
-    # Add a default admin if one doesn't exist
-    cursor.execute("SELECT * FROM users WHERE username = 'admin'")
-    if not cursor.fetchone():
-        admin_pass_hashed = hashlib.sha256('admin123'.encode()).hexdigest()
-        cursor.execute("INSERT INTO users (username, password, role) VALUES (%s, %s, %s)",
-                       ('admin', admin_pass_hashed, 'admin'))
-
-    conn.commit()
-    cursor.close()
-    conn.close()
+    """
+    Brings the schema up to date by applying any pending migrations (see migrations.py).
+    Returns False if another process is already migrating.
+    """
+    import migrations  # Imported here because migrations depends on this module.
+    return migrations.run_migrations()
+
 
 if __name__ == '__main__':
     create_tables()
-    print("Database and tables created successfully for PostgreSQL.")
\ No newline at end of file
+    print("Database and tables created successfully for PostgreSQL.")
@@ -0,0 +1,34 @@
+# gunicorn.conf.py
+
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+# Worker count comes from WEB_CONCURRENCY (gunicorn's own default is 1).
+
+# Import the app once in the master, so start-up (waiting for PostgreSQL and migrating the
+# schema, see startup.initialize) runs a single time instead of racing in every worker,
+# and the workers fork from an already-imported application.
+preload_app = True
+
+# Every worker writes its metrics to METRICS_DIR and /metrics sums them (see metrics.py), so
+# a scrape reports the whole server rather than whichever worker answered it.
+os.environ.setdefault("METRICS_DIR", "/tmp/lms-metrics")
+
+
+def post_fork(server, worker):
+    # The pool, audit writer and caches rebuild themselves in the child; open the pool now.
+    import startup
+    startup.after_fork()
+
+
+def on_starting(server):
+    # Drop the metrics files of an earlier run before any worker writes its own.
+    import metrics
+    metrics.clear_files()
+
+
+def when_ready(server):
+    import startup
+    seconds = startup.timings.get('initialize_seconds')
+    if seconds is not None:
+        server.log.info("Application initialized in %.2fs", seconds)
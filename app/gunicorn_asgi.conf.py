@@ -0,0 +1,55 @@
+# gunicorn_asgi.conf.py
+#
+# Async serving mode: `gunicorn --config gunicorn_asgi.conf.py asgi:app` (see asgi.py).
+# Each worker process runs one event loop, so a few workers hold thousands of open client
+# connections, most of them idle keep-alives, and one slow query only delays its own
+# request. Needs the packages in requirements-async.txt.
+
+import os
+
+# As in gunicorn.conf.py: /metrics sums every worker's metrics, written to METRICS_DIR.
+# Set before config is imported below.
+os.environ.setdefault("METRICS_DIR", "/tmp/lms-metrics")
+
+from uvicorn_worker import UvicornWorker
+from config import ASYNC_MAX_CONNECTIONS, ASYNC_KEEPALIVE
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+# Worker count comes from WEB_CONCURRENCY (gunicorn's own default is 1); one per CPU is plenty.
+
+# As in gunicorn.conf.py: start-up (waiting for PostgreSQL, migrations) runs once in the master.
+preload_app = True
+
+# Keep-alive connections are closed after ASYNC_KEEPALIVE idle seconds (gunicorn's default
+# of 2 would make every client reconnect), and up to 2048 connections wait to be accepted.
+keepalive = ASYNC_KEEPALIVE
+backlog = 2048
+
+
+class AsyncWorker(UvicornWorker):
+    # uvloop and httptools when installed. Past ASYNC_MAX_CONNECTIONS open connections and
+    # requests a worker answers 503 instead of queueing without bound.
+    CONFIG_KWARGS = {"loop": "auto", "http": "auto", "limit_concurrency": ASYNC_MAX_CONNECTIONS}
+
+
+worker_class = AsyncWorker
+
+
+def post_fork(server, worker):
+    # The sync pool still serves the routes asgi.py hands to app.py; the asyncpg pool is
+    # opened by the worker's lifespan start-up (asgi._open_pool).
+    import startup
+    startup.after_fork()
+
+
+def on_starting(server):
+    # Drop the metrics files of an earlier run before any worker writes its own.
+    import metrics
+    metrics.clear_files()
+
+
+def when_ready(server):
+    import startup
+    seconds = startup.timings.get('initialize_seconds')
+    if seconds is not None:
+        server.log.info("Application initialized in %.2fs", seconds)
@@ -0,0 +1,129 @@
+# http_cache.py
+
+import gzip
+import hashlib
+import json
+import os
+
+from flask import request, Response
+
+from database import get_read_connection
+
+try:
+    import brotli  # Optional: enables Content-Encoding: br for clients that accept it.
+except ImportError:
+    brotli = None
+
+# Responses smaller than this many bytes are sent uncompressed.
+COMPRESS_MIN_SIZE = 1024
+COMPRESSIBLE_TYPES = ('text/html', 'text/css', 'text/csv', 'text/plain', 'application/json',
+                      'application/javascript')
+# Static files are served with URLs carrying their content hash (see static_version), so
+# they can be cached for a year without ever being served stale.
+STATIC_MAX_AGE = 365 * 24 * 3600
+
+
+def table_versions(tables):
+    """
+    Returns (versions, last_modified) for the given tables: a dict of change counters kept
+    by the table_versions triggers (migration 8) and the time of the latest change.
+    """
+    with get_read_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT table_name, version, changed_at FROM table_versions "
+                           "WHERE table_name = ANY(%s)", (list(tables),))
+            rows = cursor.fetchall()
+    versions = {name: version for name, version, _ in rows}
+    last_modified = max((changed_at for _, _, changed_at in rows), default=None)
+    return versions, last_modified
+
+
+def make_etag(*parts):
+    """A weak ETag over everything the response depends on (table versions, parameters, user)."""
+    digest = hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+    return digest[:20]
+
+
+def not_modified(etag, last_modified):
+    """True if the client's cached copy (If-None-Match / If-Modified-Since) is still current."""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if last_modified is not None and request.if_modified_since is not None:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+def _set_validators(response, etag, last_modified):
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # Clients may keep the response but must revalidate it before reuse.
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def conditional_json(tables, key, build):
+    """
+    Serves a JSON response under HTTP validators derived from `tables`' change versions.
+    `key` identifies everything else the response depends on; `build()` returns the body
+    and is only called when the client's copy is out of date.
+    """
+    versions, last_modified = table_versions(tables)
+    etag = make_etag(versions, key)
+    if not_modified(etag, last_modified):
+        return _set_validators(Response(status=304), etag, last_modified)
+    response = Response(json.dumps(build(), default=str), mimetype='application/json')
+    return _set_validators(response, etag, last_modified)
+
+
+def preferred_encoding(accepted):
+    """Picks brotli or gzip from a request's accept_encodings, or None for neither."""
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress_response(response):
+    """Compresses large text responses with brotli or gzip, as the client accepts."""
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = preferred_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_SIZE:
+        return response
+    response.set_data(encode_body(body, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def encode_body(body, encoding):
+    """Compresses a response body with 'br' or 'gzip'."""
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6)
+
+
+_static_versions = {}
+
+
+def static_version(static_folder, filename):
+    """Short content hash of a static file, used as a cache-busting query parameter."""
+    path = os.path.join(static_folder, filename)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    cached = _static_versions.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, 'rb') as f:
+            cached = (mtime, hashlib.sha1(f.read()).hexdigest()[:12])
+        _static_versions[path] = cached
+    return cached[1]
@@ -0,0 +1,497 @@
+# metrics.py
+
+import atexit
+import contextvars
+import glob
+import json
+import os
+import re
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+from config import SLOW_QUERY_MS, METRICS_DIR, METRICS_FLUSH_INTERVAL
+
+# Upper bounds (seconds) of the latency histogram buckets.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Upper bounds of the per-request count histograms (queries, checkouts, connections).
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_text(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+class Counter:
+    """A monotonically increasing count per label combination."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def values(self):
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def add(total, value):
+        return total + value
+
+    def reset(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def samples(self, values=None):
+        values = self.values() if values is None else values
+        for label_values, value in sorted(values.items()):
+            yield f"{self.name}{_label_text(self.labels, label_values)} {value}"
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count per label combination, as Prometheus expects."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}   # label values -> [per-bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[i] += 1
+                    break
+            else:
+                entry[len(self.buckets)] += 1
+            entry[-1] += value
+
+    def values(self):
+        with self._lock:
+            return {key: list(entry) for key, entry in self._values.items()}
+
+    @staticmethod
+    def add(total, value):
+        return [a + b for a, b in zip(total, value)]
+
+    def reset(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def samples(self, values=None):
+        values = self.values() if values is None else values
+        for label_values, entry in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), entry):
+                cumulative += count
+                labels = _label_text(self.labels + ('le',), label_values + (bound,))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _label_text(self.labels, label_values)
+            yield f"{self.name}_sum{labels} {entry[-1]}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+_metrics = []
+
+
+def _register(metric):
+    _metrics.append(metric)
+    return metric
+
+
+query_duration = _register(Histogram(
+    'lms_db_query_duration_seconds', 'Time spent executing each SQL statement.', ('statement',)))
+slow_queries = _register(Counter(
+    'lms_db_slow_queries_total', 'Statements slower than SLOW_QUERY_MS.', ('statement',)))
+connect_duration = _register(Histogram(
+    'lms_db_connect_duration_seconds', 'Time spent opening new database connections.'))
+checkout_duration = _register(Histogram(
+    'lms_db_checkout_duration_seconds', 'Time spent waiting for a pooled connection.'))
+request_duration = _register(Histogram(
+    'lms_http_request_duration_seconds', 'Time spent handling each request.', ('endpoint', 'method', 'status')))
+request_db_duration = _register(Histogram(
+    'lms_http_request_db_seconds', 'Time spent executing SQL per request.', ('endpoint',)))
+request_queries = _register(Histogram(
+    'lms_http_request_queries', 'SQL statements executed per request.', ('endpoint',), COUNT_BUCKETS))
+request_checkouts = _register(Histogram(
+    'lms_http_request_db_checkouts', 'Pooled connections checked out per request.', ('endpoint',), COUNT_BUCKETS))
+request_connects = _register(Histogram(
+    'lms_http_request_db_connects', 'New database connections opened per request.', ('endpoint',), COUNT_BUCKETS))
+statement_duration = _register(Histogram(
+    'lms_db_statement_duration_seconds', 'Time spent running each registered hot statement.', ('statement',)))
+statement_prepares = _register(Counter(
+    'lms_db_statement_prepares_total', 'Registered statements prepared on a new connection.', ('statement',)))
+admission_decisions = _register(Counter(
+    'lms_admission_decisions_total', 'Requests admitted or rejected by admission control, per gate.',
+    ('gate', 'outcome')))
+render_duration = _register(Histogram(
+    'lms_template_render_seconds', 'Time spent rendering each template.', ('template',)))
+
+
+# --- PER-REQUEST ACCOUNTING ---
+
+# Totals for the request being handled in the current thread (or task), or None outside one.
+_request_totals = contextvars.ContextVar('request_totals', default=None)
+
+
+def start_request():
+    """Starts collecting database totals for the current request."""
+    totals = {'started': time.perf_counter(), 'queries': 0, 'db_seconds': 0.0, 'checkouts': 0, 'connects': 0}
+    _request_totals.set(totals)
+    return totals
+
+
+def finish_request(endpoint, method, status):
+    totals = _request_totals.get()
+    if totals is None:
+        return
+    _request_totals.set(None)
+    endpoint = endpoint or 'unmatched'
+    request_duration.observe(time.perf_counter() - totals['started'], endpoint, method, str(status))
+    request_db_duration.observe(totals['db_seconds'], endpoint)
+    request_queries.observe(totals['queries'], endpoint)
+    request_checkouts.observe(totals['checkouts'], endpoint)
+    request_connects.observe(totals['connects'], endpoint)
+
+
+def _add_to_request(key, amount=1):
+    totals = _request_totals.get()
+    if totals is not None:
+        totals[key] += amount
+
+
+def observe_checkout(seconds):
+    checkout_duration.observe(seconds)
+    _add_to_request('checkouts')
+
+
+def observe_connect(seconds):
+    connect_duration.observe(seconds)
+    _add_to_request('connects')
+
+
+def observe_statement(name, seconds, prepared=False):
+    statement_duration.observe(seconds, name)
+    if prepared:
+        statement_prepares.inc(name)
+
+
+def observe_admission(gate, admitted):
+    admission_decisions.inc(gate, 'admitted' if admitted else 'rejected')
+
+
+def observe_render(template, seconds):
+    render_duration.observe(seconds, template)
+
+
+# --- SQL INSTRUMENTATION ---
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_WHITESPACE = re.compile(r"\s+")
+# A multi-row VALUES list (execute_values inlines a whole batch) is cut to its first row.
+_VALUES_ROWS = re.compile(r"(\bVALUES\s*\([^()]*\))(?:\s*,\s*\([^()]*\))+", re.IGNORECASE)
+# Statements longer than this are normalized on every execution rather than kept as cache keys.
+_MEMO_MAX_LENGTH = 2000
+_normalized = {}
+
+
+def normalize_sql(query):
+    """
+    Collapses whitespace, replaces literals with '?' and multi-row VALUES lists with their
+    first row, so every execution of the same statement is recorded under one label
+    whatever its formatting, inlined values or batch size.
+    """
+    text = _normalized.get(query)
+    if text is None:
+        text = _WHITESPACE.sub(' ', _NUMBER_LITERAL.sub('?', _STRING_LITERAL.sub('?', query))).strip()
+        text = _VALUES_ROWS.sub(r'\1', text)
+        if len(query) <= _MEMO_MAX_LENGTH and len(_normalized) < 10000:
+            _normalized[query] = text
+    return text
+
+
+def observe_query(query, seconds):
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    elif not isinstance(query, str):
+        query = str(query)  # psycopg2.sql.Composed and friends
+    statement = normalize_sql(query)
+    query_duration.observe(seconds, statement)
+    _add_to_request('queries')
+    _add_to_request('db_seconds', seconds)
+    if SLOW_QUERY_MS and seconds * 1000 >= SLOW_QUERY_MS:
+        slow_queries.inc(statement)
+        print(f"🐢 Slow query ({seconds * 1000:.1f} ms): {statement}")
+
+
+class InstrumentedCursorMixin:
+    """Times execute, executemany and copy_expert; mixed into whichever cursor class is requested."""
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            observe_query(query, time.perf_counter() - start)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            observe_query(query, time.perf_counter() - start)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            observe_query(sql, time.perf_counter() - start)
+
+
+_cursor_classes = {}
+_cursor_classes_lock = threading.Lock()
+
+
+def instrumented_cursor_class(base):
+    """Returns a subclass of `base` (e.g. DictCursor) with query timing mixed in."""
+    cls = _cursor_classes.get(base)
+    if cls is None:
+        with _cursor_classes_lock:
+            cls = _cursor_classes.get(base)
+            if cls is None:
+                cls = type(f"Instrumented{base.__name__}", (InstrumentedCursorMixin, base), {})
+                _cursor_classes[base] = cls
+    return cls
+
+
+class InstrumentedConnection(psycopg2.extensions.connection):
+    """Connection whose cursors, of any cursor_factory, record their statements in the metrics."""
+
+    def cursor(self, *args, **kwargs):
+        if len(args) > 1:
+            args = list(args)
+            args[1] = instrumented_cursor_class(args[1] or self.cursor_factory or psycopg2.extensions.cursor)
+        else:
+            factory = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+            kwargs['cursor_factory'] = instrumented_cursor_class(factory)
+        return super().cursor(*args, **kwargs)
+
+
+# --- MULTI-PROCESS AGGREGATION ---
+# Under gunicorn each worker process records its own metrics, and a scrape reaches whichever
+# worker accepts it. With METRICS_DIR set, every process writes its metrics to
+# METRICS_DIR/metrics-<pid>.json (every METRICS_FLUSH_INTERVAL seconds, on each scrape, before
+# forking and at exit) and render() sums all the files, so any worker reports the whole pod.
+# Files of exited workers are kept, so their counts stay in the totals and counters never
+# go backwards; a worker reports at most METRICS_FLUSH_INTERVAL seconds late.
+
+_FILE = re.compile(r'^metrics-(\d+)(?:-\d+)?\.json$')
+_snapshot_source = None
+_write_lock = threading.Lock()
+_writer = None
+_claimed_pid = None
+
+
+def set_snapshot_source(source):
+    """Sets the function returning this process's gauge snapshots (see render)."""
+    global _snapshot_source
+    _snapshot_source = source
+
+
+def _numeric(snapshots):
+    return {prefix: {key: value for key, value in snapshot.items()
+                     if isinstance(value, (int, float)) and not isinstance(value, bool)}
+            for prefix, snapshot in snapshots.items()}
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _write(snapshots=None):
+    """Writes this process's metrics, and its gauge snapshots, to its file in METRICS_DIR."""
+    global _claimed_pid
+    if snapshots is None:
+        snapshots = _snapshot_source() if _snapshot_source is not None else {}
+    data = {'metrics': {metric.name: [[list(labels), value] for labels, value in metric.values().items()]
+                        for metric in _metrics},
+            'gauges': _numeric(snapshots)}
+    pid = os.getpid()
+    path = os.path.join(METRICS_DIR, f"metrics-{pid}.json")
+    with _write_lock:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        if _claimed_pid != pid:
+            # A file under our pid belongs to an exited worker whose pid was reused: keep its counts.
+            if os.path.exists(path):
+                os.replace(path, os.path.join(METRICS_DIR, f"metrics-{pid}-{time.time_ns()}.json"))
+            _claimed_pid = pid
+        with open(f"{path}.part", 'w') as f:
+            json.dump(data, f)
+        os.replace(f"{path}.part", path)
+
+
+def _collect():
+    """
+    Sums the counters and histograms in every file in METRICS_DIR. Returns them with the
+    gauge snapshots of the processes still running, as a list of (pid, snapshots).
+    """
+    totals = {metric.name: {} for metric in _metrics}
+    kinds = {metric.name: metric for metric in _metrics}
+    gauges = []
+    for path in sorted(glob.glob(os.path.join(METRICS_DIR, "metrics-*.json"))):
+        match = _FILE.match(os.path.basename(path))
+        if not match:
+            continue
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue  # Replaced by a pid-reusing worker while listed.
+        for name, values in data['metrics'].items():
+            if name not in totals:
+                continue
+            total = totals[name]
+            for labels, value in values:
+                labels = tuple(labels)
+                total[labels] = value if labels not in total else kinds[name].add(total[labels], value)
+        pid = int(match.group(1))
+        if os.path.basename(path) == f"metrics-{pid}.json" and _process_alive(pid):
+            gauges.append((pid, data['gauges']))
+    return totals, gauges
+
+
+def _write_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            _write()
+        except Exception as e:
+            print(f"⚠️ Could not write metrics to {METRICS_DIR}: {e}")
+
+
+def start_writer():
+    """Starts writing this process's metrics to METRICS_DIR in the background, if it is set."""
+    global _writer
+    if not METRICS_DIR:
+        return
+    with _write_lock:
+        if _writer is None:
+            _writer = threading.Thread(target=_write_loop, name="metrics-writer", daemon=True)
+            _writer.start()
+
+
+def clear_files():
+    """Removes the files of an earlier server run; gunicorn calls it before starting workers."""
+    if not METRICS_DIR:
+        return
+    for path in glob.glob(os.path.join(METRICS_DIR, "metrics-*.json*")):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _write_before_fork():
+    # The parent's counts so far (e.g. gunicorn's master during preload) go in its own file;
+    # the child starts from zero, so they are not counted twice.
+    if METRICS_DIR:
+        try:
+            _write({})
+        except OSError as e:
+            print(f"⚠️ Could not write metrics to {METRICS_DIR}: {e}")
+
+
+def _reset_after_fork():
+    global _write_lock, _writer
+    _write_lock = threading.Lock()
+    _writer = None
+    if METRICS_DIR:
+        for metric in _metrics:
+            metric.reset()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=_write_before_fork, after_in_child=_reset_after_fork)
+
+
+@atexit.register
+def _write_on_exit():
+    if _writer is not None:
+        try:
+            _write()
+        except Exception as e:
+            print(f"⚠️ Could not write metrics to {METRICS_DIR}: {e}")
+
+
+# --- EXPOSITION ---
+
+def _gauge_lines(snapshots):
+    """`snapshots` is a list of (worker, {prefix: snapshot}); worker None for no label."""
+    series = {}
+    for worker, prefixed in snapshots:
+        for prefix, snapshot in prefixed.items():
+            for key, value in snapshot.items():
+                series.setdefault(f"{prefix}_{key}", []).append((worker, value))
+    for name in sorted(series):
+        yield f"# TYPE {name} gauge"
+        for worker, value in series[name]:
+            labels = _label_text(('worker',), (worker,)) if worker is not None else ''
+            yield f"{name}{labels} {value}"
+
+
+def render(snapshots=None):
+    """
+    Returns every metric in the Prometheus text exposition format. `snapshots` maps a
+    metric-name prefix to a dict of counters (e.g. pool_stats()), exported as gauges; by
+    default they come from set_snapshot_source. With METRICS_DIR set, counters and
+    histograms are summed over every worker process and each running worker's gauges are
+    labelled with its pid as `worker`; otherwise only this process is reported.
+    """
+    if snapshots is None:
+        snapshots = _snapshot_source() if _snapshot_source is not None else {}
+    if METRICS_DIR:
+        start_writer()
+        _write(snapshots)
+        totals, gauges = _collect()
+    else:
+        totals = {metric.name: metric.values() for metric in _metrics}
+        gauges = [(None, _numeric(snapshots))]
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples(totals[metric.name]))
+    lines.extend(_gauge_lines(gauges))
+    return '\n'.join(lines) + '\n'
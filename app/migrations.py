@@ -0,0 +1,611 @@
+# migrations.py
+
+import hashlib
+import sys
+
+import psycopg2
+from database import connect
+
+# Key for the session-level advisory lock held while migrating. Only one process across
+# all pods can hold it; everyone else skips migrating instead of waiting.
+MIGRATION_LOCK_ID = 72450001
+
+# Indexes behind user_operations.search_available_books. Searches only ever look at
+# available books, so the trigram indexes are partial on that status as well.
+SEARCH_INDEX_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    """CREATE INDEX IF NOT EXISTS books_available_idx
+           ON books (id) WHERE status = 'available'""",
+    """CREATE INDEX IF NOT EXISTS books_title_trgm_idx
+           ON books USING gin (title gin_trgm_ops) WHERE status = 'available'""",
+    """CREATE INDEX IF NOT EXISTS books_author_trgm_idx
+           ON books USING gin (author gin_trgm_ops) WHERE status = 'available'""",
+]
+
+# Statement-level triggers keeping circulation_counters (migration 10) in step with a table.
+# `contributions` selects (counter, category, delta) from `changes`, the rows the statement
+# touched: inserted rows with delta 1, deleted rows with delta -1 and, for an update, both.
+# A trigger with transition tables can only handle one event, hence three per table.
+_CHANGED_ROWS = {
+    'INSERT': "SELECT *, 1 AS delta FROM new_rows",
+    'UPDATE': "SELECT *, 1 AS delta FROM new_rows UNION ALL SELECT *, -1 AS delta FROM old_rows",
+    'DELETE': "SELECT *, -1 AS delta FROM old_rows",
+}
+_TRANSITION_TABLES = {
+    'INSERT': "NEW TABLE AS new_rows",
+    'UPDATE': "OLD TABLE AS old_rows NEW TABLE AS new_rows",
+    'DELETE': "OLD TABLE AS old_rows",
+}
+
+
+def _counter_triggers(table, contributions):
+    branches = "\n".join(f'''
+            {'IF' if i == 0 else 'ELSIF'} TG_OP = '{op}' THEN
+                INSERT INTO circulation_counters (counter, category, slot, value)
+                SELECT counter, category, pg_backend_pid() % 16, sum(delta)
+                FROM (WITH changes AS ({changes}) {contributions}) c
+                GROUP BY counter, category
+                HAVING sum(delta) <> 0
+                ON CONFLICT (counter, category, slot)
+                DO UPDATE SET value = circulation_counters.value + EXCLUDED.value;'''
+                         for i, (op, changes) in enumerate(_CHANGED_ROWS.items()))
+    statements = [f'''
+        CREATE OR REPLACE FUNCTION count_{table}_changes() RETURNS trigger AS $$
+        BEGIN{branches}
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        ''']
+    for op, transition in _TRANSITION_TABLES.items():
+        statements.append(f'''
+        CREATE TRIGGER {table}_count_{op.lower()}
+            AFTER {op} ON {table} REFERENCING {transition}
+            FOR EACH STATEMENT EXECUTE FUNCTION count_{table}_changes()
+        ''')
+    return statements
+
+
+# Ordered list of (version, description, statements). Applied migrations are recorded in
+# schema_migrations and never re-run, so existing entries must not be edited; add a new
+# version instead. Each migration runs in its own transaction.
+MIGRATIONS = [
+    (1, "baseline tables and default admin", [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            role TEXT NOT NULL CHECK(role IN ('user', 'admin'))
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS books (
+            id SERIAL PRIMARY KEY,
+            title TEXT NOT NULL,
+            author TEXT NOT NULL,
+            category TEXT,
+            status TEXT NOT NULL DEFAULT 'available' CHECK(status IN ('available', 'borrowed'))
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS transactions (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            book_id INTEGER NOT NULL,
+            borrow_date TEXT NOT NULL,
+            due_date TEXT NOT NULL,
+            return_date TEXT,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (book_id) REFERENCES books (id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS logs (
+            id SERIAL PRIMARY KEY,
+            timestamp TEXT NOT NULL,
+            action TEXT NOT NULL,
+            details TEXT
+        )
+        ''',
+        ("INSERT INTO users (username, password, role) VALUES ('admin', %s, 'admin') "
+         "ON CONFLICT (username) DO NOTHING",
+         (hashlib.sha256('admin123'.encode()).hexdigest(),)),
+    ]),
+    (2, "catalogue search indexes", SEARCH_INDEX_DDL),
+    (3, "store transaction dates as timestamps", [
+        '''
+        ALTER TABLE transactions
+            ALTER COLUMN borrow_date TYPE TIMESTAMP USING borrow_date::timestamp,
+            ALTER COLUMN due_date TYPE TIMESTAMP USING due_date::timestamp,
+            ALTER COLUMN return_date TYPE TIMESTAMP USING return_date::timestamp
+        ''',
+    ]),
+    (4, "hot-path indexes", [
+        # Borrowing history: WHERE user_id = ? ORDER BY borrow_date DESC, id DESC.
+        '''CREATE INDEX IF NOT EXISTS transactions_user_history_idx
+               ON transactions (user_id, borrow_date DESC, id DESC)''',
+        # Returns and open-loan checks (book_id = ? AND return_date IS NULL),
+        # and the foreign-key check when a book is deleted.
+        '''CREATE INDEX IF NOT EXISTS transactions_book_return_idx
+               ON transactions (book_id, return_date)''',
+        # Admin borrowing records, newest first.
+        '''CREATE INDEX IF NOT EXISTS transactions_borrow_date_idx
+               ON transactions (borrow_date DESC, id DESC)''',
+        # Login: username is already unique-indexed, so the password and role are
+        # carried in a covering index to answer the lookup from the index alone.
+        '''CREATE INDEX IF NOT EXISTS users_login_idx
+               ON users (username) INCLUDE (password, role, id)''',
+        # Admin book listing sort orders (keyset on sort column, id).
+        "CREATE INDEX IF NOT EXISTS books_title_id_idx ON books (title, id)",
+        "CREATE INDEX IF NOT EXISTS books_author_id_idx ON books (author, id)",
+        "CREATE INDEX IF NOT EXISTS books_category_id_idx ON books ((COALESCE(category, '')), id)",
+    ]),
+    (5, "at most one open loan per book", [
+        # The old check-then-update borrow path could record two open loans for one book.
+        # Close all but the newest so the unique index can be built.
+        '''
+        UPDATE transactions t SET return_date = LOCALTIMESTAMP
+        WHERE t.return_date IS NULL
+          AND EXISTS (SELECT 1 FROM transactions newer
+                      WHERE newer.book_id = t.book_id AND newer.return_date IS NULL
+                        AND (newer.borrow_date, newer.id) > (t.borrow_date, t.id))
+        ''',
+        '''CREATE UNIQUE INDEX IF NOT EXISTS transactions_one_open_loan_idx
+               ON transactions (book_id) WHERE return_date IS NULL''',
+    ]),
+    (6, "notify on user changes", [
+        # Lets every app process drop its cached copy of a user whose role changed
+        # or who was deleted (see auth.get_user).
+        '''
+        CREATE OR REPLACE FUNCTION notify_user_change() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('user_changes', OLD.id::text);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+        "DROP TRIGGER IF EXISTS users_notify_change ON users",
+        '''
+        CREATE TRIGGER users_notify_change
+            AFTER UPDATE OR DELETE ON users
+            FOR EACH ROW EXECUTE FUNCTION notify_user_change()
+        ''',
+    ]),
+    (7, "notify on catalogue changes", [
+        # Tells every app process to drop its cached catalogue listings (see cache.py).
+        '''
+        CREATE OR REPLACE FUNCTION notify_catalogue_change() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('catalogue_changes', '');
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+        "DROP TRIGGER IF EXISTS books_notify_change ON books",
+        '''
+        CREATE TRIGGER books_notify_change
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON books
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_catalogue_change()
+        ''',
+    ]),
+    (8, "table change versions", [
+        # One row per table, bumped in the writing transaction by every statement that
+        # touches the table. The JSON API derives ETag and Last-Modified from it (see http_cache.py).
+        '''
+        CREATE TABLE IF NOT EXISTS table_versions (
+            table_name TEXT PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 1,
+            changed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        ''',
+        "INSERT INTO table_versions (table_name) VALUES ('books'), ('transactions'), ('users') ON CONFLICT DO NOTHING",
+        '''
+        CREATE OR REPLACE FUNCTION bump_table_version() RETURNS trigger AS $$
+        BEGIN
+            UPDATE table_versions SET version = version + 1, changed_at = now()
+            WHERE table_name = TG_TABLE_NAME;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+    ] + [statement for table in ('books', 'transactions', 'users') for statement in (
+        f"DROP TRIGGER IF EXISTS {table}_bump_version ON {table}",
+        f'''
+        CREATE TRIGGER {table}_bump_version
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+            FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version()
+        ''',
+    )]),
+    (9, "partition transactions by borrow date", [
+        # At most one open loan per book, kept by a row trigger on transactions. It replaces
+        # transactions_one_open_loan_idx, since a unique index on a partitioned table has to
+        # include the partition key.
+        '''
+        CREATE TABLE IF NOT EXISTS open_loans (
+            book_id INTEGER PRIMARY KEY,
+            transaction_id INTEGER NOT NULL,
+            borrow_date TIMESTAMP NOT NULL
+        )
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION track_open_loans() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.return_date IS NULL
+               AND (TG_OP = 'DELETE' OR NEW.return_date IS NOT NULL) THEN
+                DELETE FROM open_loans WHERE book_id = OLD.book_id AND transaction_id = OLD.id;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.return_date IS NULL
+               AND (TG_OP = 'INSERT' OR OLD.return_date IS NOT NULL) THEN
+                INSERT INTO open_loans (book_id, transaction_id, borrow_date)
+                VALUES (NEW.book_id, NEW.id, NEW.borrow_date);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+        # Closed and archived loans: one row per partition dumped by partitions.py.
+        '''
+        CREATE TABLE IF NOT EXISTS transaction_archives (
+            partition_name TEXT PRIMARY KEY,
+            range_start TIMESTAMP NOT NULL,
+            range_end TIMESTAMP NOT NULL,
+            path TEXT NOT NULL,
+            row_count BIGINT NOT NULL,
+            archived_at TIMESTAMP NOT NULL DEFAULT LOCALTIMESTAMP
+        )
+        ''',
+        "ALTER SEQUENCE transactions_id_seq OWNED BY NONE",
+        "ALTER TABLE transactions RENAME TO transactions_unpartitioned",
+        "ALTER TABLE transactions_unpartitioned RENAME CONSTRAINT transactions_pkey TO transactions_unpartitioned_pkey",
+        '''
+        CREATE TABLE transactions (
+            id INTEGER NOT NULL DEFAULT nextval('transactions_id_seq'),
+            user_id INTEGER NOT NULL REFERENCES users (id),
+            username TEXT NOT NULL,
+            book_id INTEGER NOT NULL REFERENCES books (id),
+            borrow_date TIMESTAMP NOT NULL,
+            due_date TIMESTAMP NOT NULL,
+            return_date TIMESTAMP,
+            PRIMARY KEY (id, borrow_date)
+        ) PARTITION BY RANGE (borrow_date)
+        ''',
+        # Catches rows outside every monthly partition, so an insert never fails for want
+        # of one; ensure_transaction_partitions moves them out when their month is created.
+        "CREATE TABLE transactions_default PARTITION OF transactions DEFAULT",
+        '''
+        CREATE OR REPLACE FUNCTION ensure_transaction_partitions(from_month DATE, months_ahead INTEGER)
+        RETURNS INTEGER AS $$
+        DECLARE
+            month DATE := date_trunc('month', from_month)::date;
+            last_month DATE := date_trunc('month', LOCALTIMESTAMP + make_interval(months => months_ahead))::date;
+            next_month DATE;
+            part TEXT;
+            created INTEGER := 0;
+        BEGIN
+            WHILE month <= last_month LOOP
+                next_month := (month + interval '1 month')::date;
+                part := 'transactions_p' || to_char(month, 'YYYYMM');
+                IF to_regclass(part) IS NULL
+                   AND NOT EXISTS (SELECT 1 FROM transaction_archives WHERE partition_name = part) THEN
+                    EXECUTE format('CREATE TABLE %I (LIKE transactions INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', part);
+                    EXECUTE format('WITH moved AS (DELETE FROM transactions_default
+                                                   WHERE borrow_date >= %L AND borrow_date < %L RETURNING *)
+                                    INSERT INTO %I SELECT * FROM moved', month, next_month, part);
+                    EXECUTE format('ALTER TABLE transactions ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                                   part, month, next_month);
+                    -- Moving rows out of the default partition fired its delete trigger.
+                    EXECUTE format('INSERT INTO open_loans (book_id, transaction_id, borrow_date)
+                                    SELECT book_id, id, borrow_date FROM %I WHERE return_date IS NULL
+                                    ON CONFLICT DO NOTHING', part);
+                    created := created + 1;
+                END IF;
+                month := next_month;
+            END LOOP;
+            RETURN created;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        SELECT ensure_transaction_partitions(
+            COALESCE((SELECT min(borrow_date) FROM transactions_unpartitioned), LOCALTIMESTAMP)::date, 3)
+        ''',
+        '''
+        CREATE TRIGGER transactions_track_open_loans
+            AFTER INSERT OR UPDATE OF return_date OR DELETE ON transactions
+            FOR EACH ROW EXECUTE FUNCTION track_open_loans()
+        ''',
+        '''
+        INSERT INTO transactions (id, user_id, username, book_id, borrow_date, due_date, return_date)
+        SELECT id, user_id, username, book_id, borrow_date, due_date, return_date
+        FROM transactions_unpartitioned
+        ''',
+        "DROP TABLE transactions_unpartitioned",
+        "ALTER SEQUENCE transactions_id_seq OWNED BY transactions.id",
+        # The migration 4 indexes, now partitioned. Open loans get their own partial index.
+        '''CREATE INDEX transactions_user_history_idx
+               ON transactions (user_id, borrow_date DESC, id DESC)''',
+        '''CREATE INDEX transactions_book_return_idx
+               ON transactions (book_id, return_date)''',
+        '''CREATE INDEX transactions_borrow_date_idx
+               ON transactions (borrow_date DESC, id DESC)''',
+        '''CREATE INDEX transactions_open_loans_idx
+               ON transactions (book_id) WHERE return_date IS NULL''',
+        '''
+        CREATE TRIGGER transactions_bump_version
+            AFTER INSERT OR UPDATE OR DELETE ON transactions
+            FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version()
+        ''',
+        "ANALYZE transactions",
+    ]),
+    (10, "circulation statistics", [
+        # Running counts for the admin statistics panel (see stats.py). category is '' except
+        # for the category_* counters. Each counter is split over 16 slots chosen by
+        # backend, so concurrent borrows do not queue on one row; readers sum the slots.
+        '''
+        CREATE TABLE circulation_counters (
+            counter TEXT NOT NULL,
+            category TEXT NOT NULL DEFAULT '',
+            slot SMALLINT NOT NULL,
+            value BIGINT NOT NULL,
+            PRIMARY KEY (counter, category, slot)
+        )
+        ''',
+        # The same counts computed from the live tables: the source for rebuilding the
+        # counters and for verifying them.
+        '''
+        CREATE VIEW circulation_counts_raw AS
+        SELECT 'books' AS counter, '' AS category, count(*) AS value FROM books
+        UNION ALL
+        SELECT 'category_books', COALESCE(category, ''), count(*) FROM books GROUP BY 2
+        UNION ALL
+        SELECT 'books_out', '', count(*) FROM books WHERE status = 'borrowed'
+        UNION ALL
+        SELECT 'category_books_out', COALESCE(category, ''), count(*) FROM books WHERE status = 'borrowed' GROUP BY 2
+        UNION ALL
+        SELECT 'loans', '', count(*) FROM transactions
+        UNION ALL
+        SELECT 'open_loans', '', count(*) FROM transactions WHERE return_date IS NULL
+        ''',
+        *_counter_triggers('books', '''
+            SELECT 'books' AS counter, '' AS category, delta FROM changes
+            UNION ALL SELECT 'category_books', COALESCE(category, ''), delta FROM changes
+            UNION ALL SELECT 'books_out', '', delta FROM changes WHERE status = 'borrowed'
+            UNION ALL SELECT 'category_books_out', COALESCE(category, ''), delta FROM changes WHERE status = 'borrowed'
+        '''),
+        *_counter_triggers('transactions', '''
+            SELECT 'loans' AS counter, '' AS category, delta FROM changes
+            UNION ALL SELECT 'open_loans', '', delta FROM changes WHERE return_date IS NULL
+        '''),
+        '''
+        INSERT INTO circulation_counters (counter, category, slot, value)
+        SELECT counter, category, 0, value FROM circulation_counts_raw WHERE value <> 0
+        ''',
+        # Overdue loans are counted live, from an index holding only open loans.
+        '''CREATE INDEX transactions_open_due_idx
+               ON transactions (due_date) WHERE return_date IS NULL''',
+        # Heavier aggregates, refreshed by stats.refresh_views. The unique indexes allow
+        # REFRESH MATERIALIZED VIEW CONCURRENTLY, so readers are never blocked.
+        '''
+        CREATE MATERIALIZED VIEW circulation_by_category AS
+        SELECT COALESCE(b.category, '') AS category,
+               count(*) AS loans,
+               count(*) FILTER (WHERE t.return_date IS NULL) AS open_loans,
+               count(DISTINCT t.user_id) AS borrowers
+        FROM transactions t
+        JOIN books b ON b.id = t.book_id
+        GROUP BY 1
+        ''',
+        "CREATE UNIQUE INDEX circulation_by_category_idx ON circulation_by_category (category)",
+        '''
+        CREATE MATERIALIZED VIEW circulation_top_titles AS
+        SELECT b.id AS book_id, b.title, b.author, count(*) AS loans, max(t.borrow_date) AS last_borrowed
+        FROM transactions t
+        JOIN books b ON b.id = t.book_id
+        GROUP BY b.id
+        ORDER BY count(*) DESC, b.id
+        LIMIT 100
+        ''',
+        "CREATE UNIQUE INDEX circulation_top_titles_idx ON circulation_top_titles (book_id)",
+        '''
+        CREATE TABLE circulation_view_refreshes (
+            view_name TEXT PRIMARY KEY,
+            refreshed_at TIMESTAMP NOT NULL,
+            duration_ms INTEGER NOT NULL
+        )
+        ''',
+        '''
+        INSERT INTO circulation_view_refreshes (view_name, refreshed_at, duration_ms)
+        VALUES ('circulation_by_category', LOCALTIMESTAMP, 0), ('circulation_top_titles', LOCALTIMESTAMP, 0)
+        ''',
+    ]),
+    (11, "overdue loans", [
+        # Flags, fines and notification state for overdue loans (see overdue.py), kept out
+        # of transactions so scanning never rewrites loan rows.
+        '''
+        CREATE TABLE overdue_loans (
+            transaction_id INTEGER PRIMARY KEY,
+            borrow_date TIMESTAMP NOT NULL,
+            user_id INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            book_id INTEGER NOT NULL,
+            due_date TIMESTAMP NOT NULL,
+            flagged_at TIMESTAMP NOT NULL DEFAULT LOCALTIMESTAMP,
+            fine_cents INTEGER NOT NULL DEFAULT 0,
+            notified_at TIMESTAMP,
+            returned_at TIMESTAMP
+        )
+        ''',
+        '''CREATE INDEX overdue_loans_outstanding_idx
+               ON overdue_loans (transaction_id) WHERE returned_at IS NULL''',
+        '''CREATE INDEX overdue_loans_unnotified_idx
+               ON overdue_loans (flagged_at) WHERE notified_at IS NULL''',
+        "CREATE INDEX overdue_loans_user_idx ON overdue_loans (user_id)",
+        # Due dates up to scanned_until have been checked. It starts empty, so the first
+        # scan picks up every loan that is already overdue.
+        '''
+        CREATE TABLE overdue_watermark (
+            singleton BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (singleton),
+            scanned_until TIMESTAMP
+        )
+        ''',
+        "INSERT INTO overdue_watermark (scanned_until) VALUES (NULL)",
+        # Keyset scans over open loans by (due_date, id) replace the migration 10 index.
+        '''CREATE INDEX transactions_open_due_id_idx
+               ON transactions (due_date, id) WHERE return_date IS NULL''',
+        "DROP INDEX transactions_open_due_idx",
+    ]),
+    (12, "normalized categories", [
+        # Category names with surrounding and repeated whitespace collapsed; NULL when blank.
+        '''
+        CREATE FUNCTION category_name(name TEXT) RETURNS TEXT AS $$
+            SELECT NULLIF(regexp_replace(btrim(name), '\\s+', ' ', 'g'), '')
+        $$ LANGUAGE sql IMMUTABLE
+        ''',
+        # One row per category, unique regardless of case.
+        '''
+        CREATE TABLE categories (
+            id SERIAL PRIMARY KEY,
+            name TEXT NOT NULL
+        )
+        ''',
+        "CREATE UNIQUE INDEX categories_name_idx ON categories (lower(name))",
+        # Backfill: spellings that differ only in case or whitespace become one category,
+        # named after the spelling most books use.
+        '''
+        INSERT INTO categories (name)
+        SELECT DISTINCT ON (lower(name)) name
+        FROM (SELECT category_name(category) AS name, count(*) AS books
+              FROM books
+              WHERE category_name(category) IS NOT NULL
+              GROUP BY 1) spellings
+        ORDER BY lower(name), books DESC, name
+        ''',
+        "ALTER TABLE books ADD COLUMN category_id INTEGER REFERENCES categories (id)",
+        # books.category stays as the category's name, so existing readers and the
+        # category_* circulation counters are unchanged. Writers keep setting category;
+        # this trigger files it under an existing category or creates a new one.
+        '''
+        CREATE FUNCTION set_book_category() RETURNS trigger AS $$
+        DECLARE
+            normalized TEXT := category_name(NEW.category);
+        BEGIN
+            IF normalized IS NULL THEN
+                NEW.category := NULL;
+                NEW.category_id := NULL;
+                RETURN NEW;
+            END IF;
+            LOOP
+                SELECT id, name INTO NEW.category_id, NEW.category
+                FROM categories WHERE lower(name) = lower(normalized);
+                EXIT WHEN FOUND;
+                -- A concurrent writer may create the same category first; look it up again.
+                INSERT INTO categories (name) VALUES (normalized) ON CONFLICT DO NOTHING;
+            END LOOP;
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE TRIGGER books_category
+            BEFORE INSERT OR UPDATE OF category ON books
+            FOR EACH ROW EXECUTE FUNCTION set_book_category()
+        ''',
+        # Runs every existing book through the trigger. The counting triggers move the
+        # category_* counters from the old spellings to the category names.
+        "UPDATE books SET category = category WHERE category IS NOT NULL",
+        # Browsing available books by category (user_operations.search_available_books).
+        """CREATE INDEX books_available_category_idx
+               ON books (category_id, id) WHERE status = 'available'""",
+    ]),
+    (13, "admin status sort index", [
+        # The admin book listing sorted by status (keyset on status, id); migration 4 covered
+        # the other sort orders.
+        "CREATE INDEX IF NOT EXISTS books_status_id_idx ON books (status, id)",
+    ]),
+]
+
+
+def _execute(cursor, statement):
+    if isinstance(statement, tuple):
+        cursor.execute(*statement)
+    else:
+        cursor.execute(statement)
+
+
+def applied_versions(cursor):
+    """Returns the set of migration versions already recorded in schema_migrations."""
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cursor.fetchall()}
+
+
+def run_migrations():
+    """
+    Applies every pending migration in order under a cluster-wide advisory lock.
+    Returns True once the schema is current, or False if another process holds the
+    lock and is migrating right now (the caller should carry on without waiting).
+    """
+    conn = connect()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+            if not cursor.fetchone()[0]:
+                conn.rollback()
+                print("↩️ Another process is applying migrations — skipping")
+                return False
+            conn.commit()
+
+            try:
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version INTEGER PRIMARY KEY,
+                        description TEXT NOT NULL,
+                        applied_at TIMESTAMP NOT NULL DEFAULT now()
+                    )
+                ''')
+                conn.commit()
+
+                done = applied_versions(cursor)
+                for version, description, statements in MIGRATIONS:
+                    if version in done:
+                        continue
+                    print(f"🗃️ Applying migration {version}: {description}")
+                    try:
+                        for statement in statements:
+                            _execute(cursor, statement)
+                        cursor.execute("INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                                       (version, description))
+                        conn.commit()
+                    except psycopg2.Error:
+                        conn.rollback()
+                        print(f"❌ Migration {version} failed and was rolled back")
+                        raise
+            finally:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+                conn.commit()
+    finally:
+        conn.close()
+    return True
+
+
+def print_status():
+    """Prints every known migration and whether it has been applied."""
+    conn = connect()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT to_regclass('schema_migrations') IS NOT NULL")
+            done = applied_versions(cursor) if cursor.fetchone()[0] else set()
+    finally:
+        conn.close()
+    for version, description, _ in MIGRATIONS:
+        state = "applied" if version in done else "pending"
+        print(f"{version:>4}  {state:<8} {description}")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'status':
+        print_status()
+    else:
+        run_migrations()
+        print("Database schema is up to date.")
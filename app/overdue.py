@@ -0,0 +1,252 @@
+# overdue.py
+
+import json
+import os
+import smtplib
+import time
+from email.message import EmailMessage
+from urllib.parse import urlparse
+
+import psycopg2
+import psycopg2.extras
+from database import get_db_connection, PoolTimeoutError
+from config import (OVERDUE_SCAN_INTERVAL, OVERDUE_BATCH_SIZE, OVERDUE_FINE_PER_DAY, OVERDUE_FINE_CAP,
+                    OVERDUE_NOTIFY, OVERDUE_MAIL_FROM, OVERDUE_MAIL_DOMAIN)
+
+# Only one scanner runs at a time across all workers and pods; the others skip the pass.
+OVERDUE_LOCK_ID = 72450002
+# Every scan looks this far behind the watermark, so a loan committed just after the
+# previous scan read the index, with a due date the scan had already passed, is not missed.
+LOOKBACK = '10 minutes'
+
+# Fine for a loan that is (or was, when returned at `end`) overdue: OVERDUE_FINE_PER_DAY per
+# started day past the due date, capped at OVERDUE_FINE_CAP.
+_FINE_SQL = "LEAST(%(cap)s, %(per_day)s * (floor(extract(epoch FROM {end} - o.due_date) / 86400)::int + 1))"
+
+
+class LogSink:
+    """Prints notices to the worker log."""
+
+    def send(self, notices):
+        for notice in notices:
+            print(f"📬 Overdue: {notice['username']} has '{notice['title']}' since "
+                  f"{notice['due_date']:%Y-%m-%d}, fine {notice['fine_cents'] / 100:.2f}")
+
+
+class FileSink:
+    """Appends notices to a JSON Lines file, one object per notice."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, notices):
+        with open(self.path, 'a') as f:
+            for notice in notices:
+                f.write(json.dumps(notice, default=str) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class SmtpSink:
+    """Mails each user one message listing their newly overdue loans."""
+
+    def __init__(self, host, port=25, sender=OVERDUE_MAIL_FROM, domain=OVERDUE_MAIL_DOMAIN):
+        self.host, self.port, self.sender, self.domain = host, port, sender, domain
+
+    def send(self, notices):
+        by_user = {}
+        for notice in notices:
+            by_user.setdefault(notice['username'], []).append(notice)
+        with smtplib.SMTP(self.host, self.port, timeout=10) as smtp:
+            for username, loans in by_user.items():
+                message = EmailMessage()
+                message['From'] = self.sender
+                message['To'] = f"{username}@{self.domain}"
+                message['Subject'] = f"{len(loans)} overdue library book{'s' if len(loans) > 1 else ''}"
+                message.set_content("\n".join(
+                    f"- {loan['title']} (due {loan['due_date']:%Y-%m-%d}, fine so far "
+                    f"{loan['fine_cents'] / 100:.2f})" for loan in loans))
+                smtp.send_message(message)
+
+
+# Notification sinks by OVERDUE_NOTIFY scheme. Register another factory here to add one;
+# it receives the parsed URL and returns an object with send(notices).
+SINKS = {
+    'log': lambda url: LogSink(),
+    'file': lambda url: FileSink(url.path),
+    'smtp': lambda url: SmtpSink(url.hostname, url.port or 25),
+}
+
+
+def make_sink(spec=OVERDUE_NOTIFY):
+    """Builds the sink described by `spec` (see OVERDUE_NOTIFY), or None for "none"."""
+    if not spec or spec == 'none':
+        return None
+    url = urlparse(spec)
+    factory = SINKS.get(url.scheme or spec)
+    if factory is None:
+        raise ValueError(f"Unknown overdue notification sink: {spec}")
+    return factory(url)
+
+
+def _flag_new(cursor, until, batch_size):
+    """Flags open loans that fell due between the watermark and `until`, one keyset batch at a time."""
+    cursor.execute("SELECT scanned_until - %s::interval FROM overdue_watermark", (LOOKBACK,))
+    after = cursor.fetchone()[0]
+    keyset = (after, 0) if after else None  # No watermark yet: start from the oldest open loan.
+    flagged = 0
+    while True:
+        where = "AND (due_date, id) > (%(after_due)s, %(after_id)s)" if keyset else ""
+        # Reads only transactions_open_due_id_idx: open loans, from the watermark onwards.
+        cursor.execute(f"""
+            WITH batch AS (
+                SELECT id, borrow_date, user_id, username, book_id, due_date
+                FROM transactions
+                WHERE return_date IS NULL AND due_date <= %(until)s {where}
+                ORDER BY due_date, id
+                LIMIT %(limit)s
+            ),
+            flagged AS (
+                INSERT INTO overdue_loans (transaction_id, borrow_date, user_id, username, book_id, due_date)
+                SELECT id, borrow_date, user_id, username, book_id, due_date FROM batch
+                ON CONFLICT (transaction_id) DO NOTHING
+                RETURNING transaction_id
+            )
+            SELECT due_date, id, (SELECT count(*) FROM batch), (SELECT count(*) FROM flagged)
+            FROM batch
+            ORDER BY due_date DESC, id DESC
+            LIMIT 1
+        """, {'until': until, 'after_due': keyset and keyset[0], 'after_id': keyset and keyset[1],
+              'limit': batch_size})
+        row = cursor.fetchone()
+        if row is None:
+            return flagged
+        keyset = row[0], row[1]
+        flagged += row[3]
+        if row[2] < batch_size:
+            return flagged
+
+
+def _settle_returned(cursor, fine_params, source='transactions'):
+    """
+    Marks flagged loans that have since been returned, fixing their fine at the return date.
+    `source` is transactions or, when it is about to be archived, one of its partitions.
+    """
+    cursor.execute(f"""
+        UPDATE overdue_loans o
+        SET returned_at = t.return_date,
+            fine_cents = {_FINE_SQL.format(end='t.return_date')}
+        FROM {source} t
+        WHERE o.returned_at IS NULL
+          AND t.id = o.transaction_id AND t.borrow_date = o.borrow_date
+          AND t.return_date IS NOT NULL
+    """, fine_params)
+    return cursor.rowcount
+
+
+def settle_partition(cursor, name):
+    """
+    Settles the returned loans of a partition being archived (see partitions.py), which later
+    scans could no longer find; otherwise their fines would accrue forever. `name` must be
+    a validated partition name.
+    """
+    return _settle_returned(cursor, {'per_day': OVERDUE_FINE_PER_DAY, 'cap': OVERDUE_FINE_CAP}, name)
+
+
+def _accrue_fines(cursor, fine_params):
+    """Brings the fines of loans still out up to date; rows whose fine is unchanged are not rewritten."""
+    fine = _FINE_SQL.format(end='LOCALTIMESTAMP')
+    cursor.execute(f"""
+        UPDATE overdue_loans o SET fine_cents = {fine}
+        WHERE o.returned_at IS NULL AND o.fine_cents <> {fine}
+    """, fine_params)
+    return cursor.rowcount
+
+
+def _notify(conn, sink, batch_size):
+    """Sends notices for flagged loans not yet notified, marking each batch once it is sent."""
+    sent = 0
+    while True:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            cursor.execute("""
+                SELECT o.transaction_id, o.user_id, o.username, o.book_id, b.title, o.due_date, o.fine_cents
+                FROM overdue_loans o
+                LEFT JOIN books b ON b.id = o.book_id
+                WHERE o.notified_at IS NULL AND o.returned_at IS NULL
+                ORDER BY o.flagged_at, o.transaction_id
+                LIMIT %s
+            """, (batch_size,))
+            notices = cursor.fetchall()
+            if not notices:
+                return sent
+            # Marked only after the sink accepted them: a failed send is retried next pass.
+            sink.send(notices)
+            cursor.execute("UPDATE overdue_loans SET notified_at = LOCALTIMESTAMP WHERE transaction_id = ANY(%s)",
+                           ([notice['transaction_id'] for notice in notices],))
+        conn.commit()
+        sent += len(notices)
+
+
+def run_pass(sink=None, batch_size=OVERDUE_BATCH_SIZE, fine_per_day=OVERDUE_FINE_PER_DAY,
+             fine_cap=OVERDUE_FINE_CAP):
+    """
+    Runs one scan: flags newly overdue loans, settles returned ones, accrues fines and sends
+    notices through `sink`. Returns a dict of counts, or None if another scanner holds the lock.
+    """
+    fine_params = {'per_day': fine_per_day, 'cap': fine_cap}
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", (OVERDUE_LOCK_ID,))
+            locked = cursor.fetchone()[0]
+        conn.commit()
+        if not locked:
+            return None
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT LOCALTIMESTAMP")
+                until = cursor.fetchone()[0]
+                result = {'flagged': _flag_new(cursor, until, batch_size),
+                          'returned': _settle_returned(cursor, fine_params),
+                          'fined': _accrue_fines(cursor, fine_params)}
+                cursor.execute("UPDATE overdue_watermark SET scanned_until = %s", (until,))
+            conn.commit()
+            result['notified'] = _notify(conn, sink, batch_size) if sink else 0
+            return result
+        finally:
+            conn.rollback()
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", (OVERDUE_LOCK_ID,))
+            conn.commit()
+
+
+def run_worker(interval=OVERDUE_SCAN_INTERVAL, sink=None, once=False):
+    """Runs scans every `interval` seconds until interrupted (or just one with once=True)."""
+    while True:
+        started = time.monotonic()
+        try:
+            result = run_pass(sink)
+            if result is None:
+                print("↩️ Another overdue scanner is running — skipping this pass")
+            elif any(result.values()):
+                print(f"⏰ Overdue scan: {result['flagged']} flagged, {result['returned']} returned, "
+                      f"{result['fined']} fines updated, {result['notified']} notified "
+                      f"in {time.monotonic() - started:.1f}s")
+        except (psycopg2.Error, PoolTimeoutError, OSError, smtplib.SMTPException) as e:
+            print(f"⚠️ Overdue scan failed: {e}")
+        if once:
+            return
+        time.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+
+def user_fines(user_id):
+    """Returns a user's flagged loans with their fines, newest first."""
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            cursor.execute("""
+                SELECT o.transaction_id, b.title, o.due_date, o.fine_cents, o.returned_at
+                FROM overdue_loans o
+                LEFT JOIN books b ON b.id = o.book_id
+                WHERE o.user_id = %s
+                ORDER BY o.due_date DESC
+            """, (user_id,))
+            return cursor.fetchall()
@@ -0,0 +1,33 @@
+# pagination.py
+
+import base64
+import binascii
+import json
+
+def encode_cursor(*values):
+    """Packs the sort-key values of the last row on a page into an opaque, URL-safe token."""
+    payload = json.dumps([str(v) if v is not None else None for v in values])
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+def decode_cursor(token, size):
+    """Unpacks a token from encode_cursor into a tuple of `size` values, or None if it is invalid."""
+    if not token:
+        return None
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (binascii.Error, ValueError):
+        return None
+    if not isinstance(values, list) or len(values) != size:
+        return None
+    return tuple(values)
+
+def split_page(rows, limit, key):
+    """
+    Trims the look-ahead row fetched past `limit` and returns (rows, next_cursor).
+    `key` maps a row to the values that encode_cursor should pack for it.
+    """
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(*key(rows[-1]))
@@ -0,0 +1,276 @@
+# partitions.py
+
+import csv
+import gzip
+import hashlib
+import json
+import os
+import re
+import tempfile
+from datetime import date, datetime, timedelta
+
+import psycopg2.extras
+import overdue
+import stats
+from database import get_db_connection, get_read_connection
+from pagination import split_page
+from config import TRANSACTIONS_PARTITIONS_AHEAD, TRANSACTIONS_ARCHIVE_AFTER_MONTHS, TRANSACTIONS_ARCHIVE_DIR
+
+# transactions is range-partitioned by borrow_date into one table per month (migration 9),
+# named transactions_pYYYYMM, plus transactions_default for anything outside them.
+# Partition names are only ever interpolated into SQL after matching this pattern.
+PARTITION_NAME = re.compile(r'^transactions_p(\d{4})(\d{2})$')
+COLUMNS = ('id', 'user_id', 'username', 'book_id', 'borrow_date', 'due_date', 'return_date')
+
+
+def _add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def _partition_month(name):
+    match = PARTITION_NAME.match(name)
+    return date(int(match.group(1)), int(match.group(2)), 1) if match else None
+
+
+def ensure_partitions(months_ahead=TRANSACTIONS_PARTITIONS_AHEAD):
+    """Creates the monthly partitions from this month to `months_ahead` months ahead. Returns how many were new."""
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT ensure_transaction_partitions(LOCALTIMESTAMP::date, %s)", (months_ahead,))
+            created = cursor.fetchone()[0]
+        conn.commit()
+    return created
+
+
+def list_partitions():
+    """
+    Returns the monthly transactions partitions, oldest first, as dicts with name, month,
+    attached (False for one detached by an interrupted archive run) and estimated_rows.
+    """
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT relname, relispartition, reltuples::bigint
+                FROM pg_class
+                WHERE relkind = 'r' AND relname LIKE 'transactions_p%'
+            """)
+            rows = cursor.fetchall()
+    partitions = [{'name': name, 'month': _partition_month(name), 'attached': attached,
+                   'estimated_rows': max(estimate, 0)}
+                  for name, attached, estimate in rows if _partition_month(name)]
+    return sorted(partitions, key=lambda partition: partition['month'])
+
+
+def _detach_if_closed(name):
+    """Detaches a partition unless it still holds an open loan. Returns True if it was detached."""
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            # The detach locks transactions, so no loan in the partition can be returned
+            # between the check and the commit.
+            cursor.execute(f"ALTER TABLE transactions DETACH PARTITION {name}")
+            cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {name} WHERE return_date IS NULL)")
+            if cursor.fetchone()[0]:
+                conn.rollback()
+                return False
+            # The overdue scanner only settles loans it can still see in transactions.
+            overdue.settle_partition(cursor, name)
+            # Detaching fires no delete triggers, so the live loan counter is adjusted here.
+            cursor.execute(f"SELECT count(*) FROM {name}")
+            stats.add_to_counter(cursor, 'loans', -cursor.fetchone()[0])
+        conn.commit()
+    return True
+
+
+# --- ARCHIVE STORAGE ---
+# TRANSACTIONS_ARCHIVE_DIR is a local directory or an s3://bucket/prefix URL. Each archive is
+# recorded in transaction_archives by its full path or URL, which is what readers open.
+
+def _is_s3(location):
+    return location.startswith('s3://')
+
+
+def _split_s3(url):
+    bucket, _, key = url[len('s3://'):].partition('/')
+    return bucket, key.strip('/')
+
+
+def _s3_client():
+    import boto3  # Optional dependency, only needed when archives are kept in S3.
+    return boto3.client('s3')
+
+
+def _archive_location(dest, filename):
+    if _is_s3(dest):
+        bucket, prefix = _split_s3(dest)
+        return f"s3://{bucket}/{prefix + '/' if prefix else ''}{filename}"
+    return os.path.join(dest, filename)
+
+
+def _staging_path(dest, filename):
+    """Where a file is written before it is published: beside it locally, else a temp dir."""
+    return os.path.join(tempfile.gettempdir() if _is_s3(dest) else dest, filename + '.part')
+
+
+def _publish(staged, location):
+    """Moves a finished file to `location`, a local path or an S3 URL."""
+    if _is_s3(location):
+        bucket, key = _split_s3(location)
+        _s3_client().upload_file(staged, bucket, key)
+        os.remove(staged)
+    else:
+        os.replace(staged, location)
+
+
+def _open_archive(location):
+    """Opens an archive file, local or in S3, as decompressed text."""
+    if _is_s3(location):
+        bucket, key = _split_s3(location)
+        return gzip.open(_s3_client().get_object(Bucket=bucket, Key=key)['Body'], 'rt', newline='')
+    return gzip.open(location, 'rt', newline='')
+
+
+def _dump(cursor, name, part):
+    """Writes a detached partition to `part` as gzipped CSV. Returns (row_count, sha256)."""
+    cursor.execute(f"SELECT count(*) FROM {name}")
+    row_count = cursor.fetchone()[0]
+    with open(part, 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb', mtime=0) as out:
+            cursor.copy_expert(f"COPY (SELECT {', '.join(COLUMNS)} FROM {name} ORDER BY borrow_date, id) "
+                               "TO STDOUT WITH (FORMAT csv, HEADER)", out)
+        raw.flush()
+        os.fsync(raw.fileno())
+    digest = hashlib.sha256()
+    with open(part, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return row_count, digest.hexdigest()
+
+
+def _archive_detached(name, dest):
+    """Dumps a detached partition, records the archive file, then drops the partition."""
+    month = _partition_month(name)
+    path = _archive_location(dest, f"{name}.csv.gz")
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT path, row_count FROM transaction_archives WHERE partition_name = %s", (name,))
+            archived = cursor.fetchone()
+            if archived:
+                # Crashed after recording the archive but before the drop.
+                path, row_count = archived
+            else:
+                staged = _staging_path(dest, f"{name}.csv.gz")
+                row_count, sha256 = _dump(cursor, name, staged)
+                _publish(staged, path)
+                staged = _staging_path(dest, f"{name}.csv.gz.json")
+                with open(staged, 'w') as f:
+                    json.dump({'partition': name, 'range_start': month.isoformat(),
+                               'range_end': _add_months(month, 1).isoformat(),
+                               'rows': row_count, 'sha256': sha256}, f)
+                _publish(staged, path + '.json')
+                cursor.execute("""
+                    INSERT INTO transaction_archives (partition_name, range_start, range_end, path, row_count)
+                    VALUES (%s, %s, %s, %s, %s)
+                """, (name, month, _add_months(month, 1), path, row_count))
+            cursor.execute(f"DROP TABLE {name}")
+        conn.commit()
+    return {'partition': name, 'path': path, 'rows': row_count}
+
+
+def archive_partitions(older_than_months=TRANSACTIONS_ARCHIVE_AFTER_MONTHS, dest=TRANSACTIONS_ARCHIVE_DIR):
+    """
+    Moves every fully returned partition whose month ended more than `older_than_months`
+    months ago out of the database: it is detached, dumped to `<dest>/<partition>.csv.gz`
+    (`dest` may be an s3://bucket/prefix URL), recorded in transaction_archives and dropped.
+    Partitions with an open loan are kept.
+    Partitions left detached by an interrupted run are finished first.
+    Returns one dict per archived partition.
+    """
+    if not _is_s3(dest):
+        os.makedirs(dest, exist_ok=True)
+    cutoff = _add_months(date.today().replace(day=1), -older_than_months)
+    archived = []
+    for partition in list_partitions():
+        name = partition['name']
+        if partition['attached']:
+            if partition['month'] >= cutoff or not _detach_if_closed(name):
+                continue
+        archived.append(_archive_detached(name, dest))
+    return archived
+
+
+def maintain(months_ahead=TRANSACTIONS_PARTITIONS_AHEAD, archive_after_months=TRANSACTIONS_ARCHIVE_AFTER_MONTHS,
+             dest=TRANSACTIONS_ARCHIVE_DIR):
+    """Creates upcoming partitions and archives old ones. Returns (created, archived)."""
+    created = ensure_partitions(months_ahead)
+    archived = archive_partitions(archive_after_months, dest) if archive_after_months > 0 else []
+    return created, archived
+
+
+def _parse_timestamp(value):
+    if not value:
+        return None
+    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f' if '.' in value else '%Y-%m-%d %H:%M:%S')
+
+
+def iter_archived_transactions(user_id=None, since=None, until=None, newest_first=False):
+    """
+    Yields archived loans as dicts, optionally only `user_id`'s and only those borrowed in
+    [since, until). This is the slow path for old history: every matching archive file is
+    decompressed and scanned in full.
+    """
+    with get_read_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"""
+                SELECT path FROM transaction_archives
+                WHERE (%(since)s::timestamp IS NULL OR range_end > %(since)s)
+                  AND (%(until)s::timestamp IS NULL OR range_start < %(until)s)
+                ORDER BY range_start {'DESC' if newest_first else 'ASC'}
+            """, {'since': since, 'until': until})
+            paths = [row[0] for row in cursor.fetchall()]
+    for path in paths:
+        with _open_archive(path) as f:
+            rows = []
+            for row in csv.DictReader(f):
+                if user_id is not None and int(row['user_id']) != user_id:
+                    continue
+                borrow_date = _parse_timestamp(row['borrow_date'])
+                if (since and borrow_date < since) or (until and borrow_date >= until):
+                    continue
+                rows.append({'id': int(row['id']), 'user_id': int(row['user_id']), 'username': row['username'],
+                             'book_id': int(row['book_id']), 'borrow_date': borrow_date,
+                             'due_date': _parse_timestamp(row['due_date']),
+                             'return_date': _parse_timestamp(row['return_date'])})
+        yield from (reversed(rows) if newest_first else rows)
+
+
+def archived_history(user_id, before=None, limit=20):
+    """
+    Returns up to `limit` of a user's archived loans, newest first on (borrow_date, id), with
+    book titles, and a token for the next page or None. `before` is a (borrow_date, id)
+    keyset from user_ops.decode_history_cursor, as for the live history.
+    """
+    until = None
+    if before:
+        before = (datetime.fromisoformat(before[0]), int(before[1]))
+        # Loans borrowed at the same moment as the keyset may still follow it, so the scan
+        # includes that instant (timestamps have microsecond precision) and the filter below
+        # compares the full keyset.
+        until = before[0] + timedelta(microseconds=1)
+    rows = []
+    for row in iter_archived_transactions(user_id, until=until, newest_first=True):
+        if before and (row['borrow_date'], row['id']) >= before:
+            continue
+        rows.append(row)
+        if len(rows) > limit:
+            break
+    rows, next_token = split_page(rows, limit, key=lambda row: (row['borrow_date'], row['id']))
+    if rows:
+        with get_read_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+                cursor.execute("SELECT id, title FROM books WHERE id = ANY(%s)",
+                               (list({row['book_id'] for row in rows}),))
+                titles = dict(cursor.fetchall())
+        for row in rows:
+            row['title'] = titles.get(row['book_id'])
+    return rows, next_token
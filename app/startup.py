@@ -0,0 +1,132 @@
+# startup.py
+
+import os
+import threading
+import time
+
+import psycopg2
+import database
+import metrics
+from config import DB_INIT_TIMEOUT, READY_CHECK_INTERVAL, READY_CHECK_TIMEOUT
+
+# Timings of this process's start-up, in seconds, exported on /metrics as lms_startup_*.
+# Under gunicorn's preload_app (gunicorn.conf.py) they are measured once in the master
+# and inherited by every worker.
+_started = time.monotonic()
+timings = {}
+
+_ready_lock = threading.Lock()
+_ready = {'checked_at': None, 'ready': False, 'detail': "not checked yet"}
+_schema_current = False
+
+
+def wait_for_database(timeout=DB_INIT_TIMEOUT):
+    """
+    Polls PostgreSQL until it accepts connections, backing off from 0.1 to 2 seconds
+    between attempts. Returns the seconds waited; re-raises the last error after `timeout`.
+    """
+    start = time.monotonic()
+    delay = 0.1
+    while True:
+        try:
+            database.connect().close()
+            return time.monotonic() - start
+        except psycopg2.OperationalError as e:
+            if time.monotonic() - start + delay > timeout:
+                print(f"❌ PostgreSQL still unreachable after {timeout:.0f}s: {e}")
+                raise
+            time.sleep(delay)
+            delay = min(delay * 2, 2.0)
+
+
+def initialize():
+    """
+    Waits for PostgreSQL and applies pending migrations. Called once when app.py is
+    imported: in the gunicorn master before any worker forks, or in the single process
+    of `flask run`. Skipped when SKIP_DB_INIT is set.
+    """
+    if os.getenv('SKIP_DB_INIT'):
+        print("↩️ SKIP_DB_INIT set — skipping DB initialization")
+        return
+    timings['wait_for_database_seconds'] = wait_for_database()
+    start = time.monotonic()
+    if database.create_tables():
+        print("🟢 DB schema is up to date")
+    else:
+        # Another pod is migrating; /readyz reports not ready until it has finished.
+        print("🟢 DB schema is being migrated by another process")
+    timings['migrations_seconds'] = time.monotonic() - start
+    timings['initialize_seconds'] = time.monotonic() - _started
+    print(f"🚀 Initialized in {timings['initialize_seconds']:.2f}s")
+
+
+def after_fork():
+    """
+    Per-worker set-up, run by gunicorn's post_fork hook. The pool, audit writer and
+    notification listener already rebuild themselves after a fork; this opens the worker's
+    pool now, so the first request does not pay for connecting, and starts writing the
+    worker's metrics for /metrics to sum (see metrics.py).
+    """
+    metrics.start_writer()
+    try:
+        database.get_pool()
+    except psycopg2.Error as e:
+        print(f"⚠️ Could not open the connection pool: {e}")
+
+
+def _latest_version():
+    import migrations  # Imported here because migrations depends on database.
+    return max(version for version, _, _ in migrations.MIGRATIONS)
+
+
+def _check():
+    """Runs the readiness query: the database answers and every migration is applied."""
+    global _schema_current
+    try:
+        with database.get_db_connection(timeout=READY_CHECK_TIMEOUT) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT COALESCE(max(version), 0) FROM schema_migrations")
+                version = cursor.fetchone()[0]
+    except database.PoolTimeoutError:
+        # Every connection is busy serving requests, so the database is reachable.
+        return True, "busy"
+    except psycopg2.Error as e:
+        return False, f"database unavailable: {' '.join(str(e).split())}"
+    if not _schema_current:
+        latest = _latest_version()
+        if version < latest:
+            return False, f"schema at version {version}, waiting for {latest}"
+        _schema_current = True
+    return True, "ok"
+
+
+def readiness():
+    """
+    Returns (ready, detail). The database is queried at most once every
+    READY_CHECK_INTERVAL seconds per process; probes in between reuse the last answer.
+    """
+    with _ready_lock:
+        checked_at = _ready['checked_at']
+        if checked_at is None or time.monotonic() - checked_at >= READY_CHECK_INTERVAL:
+            ready, detail = _check()
+            _ready.update(checked_at=time.monotonic(), ready=ready, detail=detail)
+        return _ready['ready'], _ready['detail']
+
+
+def health():
+    """
+    Liveness: the process is up and serving. It reports the last readiness result but
+    never queries the database, so a database outage does not get every pod restarted.
+    """
+    return {'status': 'ok', 'pid': os.getpid(), 'uptime_seconds': round(time.monotonic() - _started, 3),
+            'database': _ready['detail']}
+
+
+def _reset_after_fork():
+    global _ready_lock
+    _ready_lock = threading.Lock()
+    _ready.update(checked_at=None, ready=False, detail="not checked yet")
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,201 @@
+# statements.py
+"""
+Registry of the hot SQL statements: the ones run on nearly every request (login, the user
+lookup behind every session, the dashboard, borrow and return).
+
+Each is declared once with register(), in psycopg2's paramstyle, and run with execute().
+On its first use on a pooled connection a statement is sent as PREPARE, and from then on
+only EXECUTE with the parameters, so PostgreSQL parses it once per connection and can
+reuse the plan. The async entry point runs the same statements through asyncpg, which
+prepares and caches them per connection by itself (see async_database.py).
+
+Calls and timings per statement are exported on /metrics, and `flask explain-statements`
+prints the plan of every registered statement, for CI against a seeded database.
+"""
+
+import functools
+import importlib
+import json
+import re
+import threading
+import time
+
+import metrics
+from config import DB_PREPARED_STATEMENTS
+
+_PLACEHOLDER = re.compile(r"%\((\w+)\)s|%s|%%")
+
+STATEMENTS = {}   # name -> Statement, in registration order
+# The modules that register statements when imported.
+REGISTERING_MODULES = ('auth', 'user_operations')
+_stats = {}       # name -> {'calls', 'prepares', 'seconds'}
+_stats_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=512)
+def numbered(query):
+    """
+    Rewrites a psycopg2-style statement (%(name)s or %s placeholders, %% for a literal %)
+    into PostgreSQL's numbered $n form. Returns (sql, parameter names or positions).
+    """
+    names = []
+
+    def replace(match):
+        if match.group(0) == '%%':
+            return '%'
+        name = match.group(1)
+        if name is None:
+            names.append(len(names))
+            return f"${len(names)}"
+        if name not in names:
+            names.append(name)
+        return f"${names.index(name) + 1}"
+
+    return _PLACEHOLDER.sub(replace, query), tuple(names)
+
+
+def arguments(names, params):
+    """Orders `params` (a dict, or a sequence for %s placeholders) to match numbered()'s names."""
+    if params is None:
+        return ()
+    if isinstance(params, dict):
+        return tuple(params[name] for name in names)
+    return tuple(params)
+
+
+class Statement:
+    """A named SQL statement, with example parameters used to EXPLAIN it."""
+
+    def __init__(self, name, sql, example=None):
+        self.name = name
+        self.sql = sql
+        self.example = example
+        self.numbered_sql, self.names = numbered(sql)
+        placeholders = ', '.join(['%s'] * len(self.names))
+        self.prepare_sql = f"PREPARE {name} AS {self.numbered_sql}"
+        self.execute_sql = f"EXECUTE {name} ({placeholders})" if self.names else f"EXECUTE {name}"
+
+    def __repr__(self):
+        return f"Statement({self.name!r})"
+
+
+def register(name, sql, example=None):
+    """
+    Declares a hot statement under `name` (an SQL identifier) and returns it. `example`
+    holds parameters for EXPLAIN. Registering the same name twice with other SQL is an error.
+    """
+    statement = STATEMENTS.get(name)
+    if statement is not None:
+        if statement.sql != sql:
+            raise ValueError(f"Statement {name} is already registered with different SQL")
+        return statement
+    statement = STATEMENTS[name] = Statement(name, sql, example)
+    with _stats_lock:
+        _stats[name] = {'calls': 0, 'prepares': 0, 'seconds': 0.0}
+    return statement
+
+
+def load_all():
+    """Imports every module that registers statements, so STATEMENTS is complete, and returns it."""
+    for module in REGISTERING_MODULES:
+        importlib.import_module(module)
+    return STATEMENTS
+
+
+def _record(name, seconds, prepared):
+    with _stats_lock:
+        entry = _stats[name]
+        entry['calls'] += 1
+        entry['seconds'] += seconds
+        entry['prepares'] += prepared
+    metrics.observe_statement(name, seconds, prepared)
+
+
+def _prepared_on(conn):
+    # Names prepared on this connection. A reconnect yields a new connection object, so a
+    # replaced connection starts with an empty set and statements are prepared again.
+    prepared = getattr(conn, 'prepared_statements', None)
+    if prepared is None:
+        prepared = conn.prepared_statements = set()
+    return prepared
+
+
+def execute(cursor, statement, params=None):
+    """
+    Runs a registered statement on `cursor`: prepared on the cursor's connection the first
+    time, executed by name after that. With DB_PREPARED_STATEMENTS=0 (e.g. behind a
+    transaction-pooling PgBouncer, where sessions are not kept) the SQL is sent as is.
+    """
+    start = time.perf_counter()
+    prepared = False
+    try:
+        if not DB_PREPARED_STATEMENTS:
+            cursor.execute(statement.sql, params)
+            return
+        names = _prepared_on(cursor.connection)
+        if statement.name not in names:
+            # PREPARE is not transactional: it outlives a rollback of the surrounding transaction.
+            cursor.execute(statement.prepare_sql)
+            names.add(statement.name)
+            prepared = True
+        cursor.execute(statement.execute_sql, arguments(statement.names, params))
+    finally:
+        _record(statement.name, time.perf_counter() - start, prepared)
+
+
+def observe(statement, seconds):
+    """Records one run of a statement executed elsewhere (the async layer)."""
+    _record(statement.name, seconds, False)
+
+
+def stats():
+    """Returns calls, prepares and total and mean milliseconds per statement in this process."""
+    with _stats_lock:
+        return {name: {'calls': entry['calls'], 'prepares': entry['prepares'],
+                       'total_ms': round(entry['seconds'] * 1000, 3),
+                       'mean_ms': round(entry['seconds'] * 1000 / entry['calls'], 3) if entry['calls'] else None}
+                for name, entry in _stats.items()}
+
+
+# --- EXPLAIN ---
+
+# Below this many pages a sequential scan is the cheapest plan whatever the indexes, so it
+# says nothing about a missing one: a transactions partition for a month still to come, the
+# current month's early on, or a small lookup table.
+SEQ_SCAN_MIN_PAGES = 8
+
+
+def _plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', ()):
+        yield from _plan_nodes(child)
+
+
+def explain(cursor, statement, generic=False):
+    """
+    Returns the plan PostgreSQL would use for `statement` with its example parameters, as
+    (text plan, [tables of SEQ_SCAN_MIN_PAGES or more read by a sequential scan]). Nothing
+    is executed: EXPLAIN without ANALYZE only plans, even for INSERT and UPDATE. With
+    generic=True the plan is the parameter-independent one a prepared statement settles on
+    after repeated use.
+    """
+    cursor.execute(f"SET LOCAL plan_cache_mode = {'force_generic_plan' if generic else 'auto'}")
+    name = f"explain_{statement.name}"
+    cursor.execute(f"PREPARE {name} AS {statement.numbered_sql}")
+    args = arguments(statement.names, statement.example)
+    execute_sql = statement.execute_sql.replace(f"EXECUTE {statement.name}", f"EXECUTE {name}")
+    cursor.execute(f"EXPLAIN (FORMAT JSON) {execute_sql}", args)
+    plan = cursor.fetchone()[0]
+    plan = json.loads(plan) if isinstance(plan, str) else plan
+    cursor.execute(f"EXPLAIN {execute_sql}", args)
+    text = '\n'.join(row[0] for row in cursor.fetchall())
+    cursor.execute(f"DEALLOCATE {name}")
+    seq_scans = sorted({node['Relation Name'] for node in _plan_nodes(plan[0]['Plan'])
+                        if node['Node Type'] == 'Seq Scan'})
+    if seq_scans:
+        cursor.execute("""
+            SELECT name FROM unnest(%s::text[]) AS name
+            WHERE pg_relation_size(to_regclass(name)) >= %s * current_setting('block_size')::int
+        """, (seq_scans, SEQ_SCAN_MIN_PAGES))
+        seq_scans = [row[0] for row in cursor.fetchall()]
+    return text, seq_scans
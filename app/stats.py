@@ -0,0 +1,128 @@
+# stats.py
+
+import time
+
+import psycopg2.extras
+from database import get_db_connection, get_read_connection
+
+# Aggregates too heavy to keep as running counters, refreshed by refresh_views.
+MATERIALIZED_VIEWS = ('circulation_by_category', 'circulation_top_titles')
+TOP_TITLES = 10
+
+
+def add_to_counter(cursor, counter, delta, category=''):
+    """
+    Adds `delta` to a circulation counter inside the caller's transaction. Only needed for
+    changes the counting triggers (migration 10) cannot see, such as detaching a partition.
+    """
+    cursor.execute("""
+        INSERT INTO circulation_counters (counter, category, slot, value)
+        VALUES (%s, %s, 0, %s)
+        ON CONFLICT (counter, category, slot)
+        DO UPDATE SET value = circulation_counters.value + EXCLUDED.value
+    """, (counter, category, delta))
+
+
+def circulation_summary(top_titles=TOP_TITLES):
+    """
+    Returns the admin statistics panel: running totals, per-category figures and the most
+    borrowed titles. Every figure is read from a counter, a materialized view or an index
+    holding only open loans, so the cost does not grow with the loan history.
+    """
+    with get_read_connection() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            cursor.execute("""
+                SELECT counter, category, sum(value)::bigint AS value
+                FROM circulation_counters
+                GROUP BY counter, category
+            """)
+            counters = {(row['counter'], row['category']): row['value'] for row in cursor.fetchall()}
+            cursor.execute("SELECT count(*) FROM transactions "
+                           "WHERE return_date IS NULL AND due_date < LOCALTIMESTAMP")
+            overdue = cursor.fetchone()[0]
+            cursor.execute("SELECT COALESCE(sum(row_count), 0)::bigint FROM transaction_archives")
+            archived = cursor.fetchone()[0]
+            cursor.execute("SELECT category, loans, open_loans, borrowers FROM circulation_by_category")
+            by_category = {row['category']: dict(row) for row in cursor.fetchall()}
+            cursor.execute("""
+                SELECT book_id, title, author, loans, last_borrowed FROM circulation_top_titles
+                ORDER BY loans DESC, book_id
+                LIMIT %s
+            """, (top_titles,))
+            titles = [dict(row) for row in cursor.fetchall()]
+            cursor.execute("SELECT min(refreshed_at) FROM circulation_view_refreshes")
+            refreshed_at = cursor.fetchone()[0]
+
+    categories = []
+    names = {category for counter, category in counters if counter.startswith('category_')} | set(by_category)
+    for name in sorted(names):
+        aggregate = by_category.get(name, {})
+        categories.append({'category': name,
+                           'books': counters.get(('category_books', name), 0),
+                           'books_out': counters.get(('category_books_out', name), 0),
+                           'loans': aggregate.get('loans', 0),
+                           'borrowers': aggregate.get('borrowers', 0)})
+    books = counters.get(('books', ''), 0)
+    books_out = counters.get(('books_out', ''), 0)
+    return {'books': books,
+            'books_out': books_out,
+            'books_available': books - books_out,
+            'open_loans': counters.get(('open_loans', ''), 0),
+            'overdue_loans': overdue,
+            'loans': counters.get(('loans', ''), 0),
+            'archived_loans': archived,
+            'categories': categories,
+            'top_titles': titles,
+            'views_refreshed_at': refreshed_at}
+
+
+def refresh_views():
+    """Refreshes the statistics materialized views without blocking readers. Returns {view: seconds}."""
+    timings = {}
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            for view in MATERIALIZED_VIEWS:
+                start = time.perf_counter()
+                cursor.execute(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {view}")
+                timings[view] = time.perf_counter() - start
+                cursor.execute("""
+                    INSERT INTO circulation_view_refreshes (view_name, refreshed_at, duration_ms)
+                    VALUES (%s, LOCALTIMESTAMP, %s)
+                    ON CONFLICT (view_name)
+                    DO UPDATE SET refreshed_at = EXCLUDED.refreshed_at, duration_ms = EXCLUDED.duration_ms
+                """, (view, int(timings[view] * 1000)))
+                conn.commit()
+    return timings
+
+
+def rebuild_counters():
+    """
+    Recomputes every circulation counter from the books and transactions tables.
+    Writers to both tables wait while this runs, so no change is counted twice or missed.
+    """
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("LOCK TABLE books, transactions IN SHARE MODE")
+            cursor.execute("DELETE FROM circulation_counters")
+            cursor.execute("""
+                INSERT INTO circulation_counters (counter, category, slot, value)
+                SELECT counter, category, 0, value FROM circulation_counts_raw WHERE value <> 0
+            """)
+        conn.commit()
+
+
+def verify_counters():
+    """Compares the counters with counts taken from the raw tables. Returns the mismatches (empty if none)."""
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            # One statement, so the counters and the raw counts come from the same snapshot.
+            cursor.execute("""
+                SELECT counter, category, COALESCE(r.value, 0) AS expected, COALESCE(c.value, 0) AS actual
+                FROM circulation_counts_raw r
+                FULL JOIN (SELECT counter, category, sum(value) AS value
+                           FROM circulation_counters
+                           GROUP BY counter, category) c USING (counter, category)
+                WHERE COALESCE(r.value, 0) <> COALESCE(c.value, 0)
+                ORDER BY counter, category
+            """)
+            return [dict(row) for row in cursor.fetchall()]
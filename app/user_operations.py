@@ -1,94 +1,465 @@
 # user_operations.py
 
-from database import get_db_connection
-from datetime import datetime, timedelta
+from database import get_db_connection, get_read_connection, execute_atomic, note_write
+from cache import cached_catalogue_read, lookup_catalogue, store_catalogue, bump_catalogue_version
+from pagination import decode_cursor, split_page
+from datetime import datetime
+import statements
+import psycopg2.errors
 import psycopg2.extras
 
-def search_available_books(query=None):
+# Number of borrowing-history rows and search results shown per dashboard page.
+HISTORY_PAGE_SIZE = 20
+SEARCH_PAGE_SIZE = 25
+
+# Largest number of books accepted by one batch borrow, return or admin edit.
+BATCH_LIMIT = 500
+
+# Timestamps are rendered with a fixed format inside JSON results so they parse back
+# into datetimes without depending on PostgreSQL's JSON timestamp formatting.
+_JSON_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+# Claims an available book and records the loan in one statement (see borrow_book).
+BORROW_SQL = """
+    WITH claimed AS (
+        UPDATE books SET status = 'borrowed'
+        WHERE id = %(book_id)s AND status = 'available'
+        RETURNING id
+    )
+    INSERT INTO transactions (user_id, username, book_id, borrow_date, due_date)
+    SELECT %(user_id)s, %(username)s, id,
+           LOCALTIMESTAMP, LOCALTIMESTAMP + make_interval(days => %(days)s)
+    FROM claimed
+    RETURNING id
+"""
+
+# Closes a user's open loan of a book and frees the book in one statement (see return_book).
+RETURN_SQL = """
+    WITH closed AS (
+        UPDATE transactions SET return_date = LOCALTIMESTAMP
+        WHERE user_id = %(user_id)s AND book_id = %(book_id)s AND return_date IS NULL
+        RETURNING book_id
+    )
+    UPDATE books SET status = 'available'
+    WHERE id IN (SELECT book_id FROM closed)
+    RETURNING id
+"""
+
+# Claims every available book of a batch and records the loans in one statement (see borrow_books).
+BORROW_BATCH_SQL = """
+    WITH requested AS (SELECT unnest(%(ids)s::int[]) AS id),
+    claimed AS (
+        UPDATE books SET status = 'borrowed'
+        WHERE id IN (SELECT id FROM requested) AND status = 'available'
+          AND NOT EXISTS (SELECT 1 FROM open_loans o WHERE o.book_id = books.id)
+        RETURNING id
+    ),
+    loans AS (
+        INSERT INTO transactions (user_id, username, book_id, borrow_date, due_date)
+        SELECT %(user_id)s, %(username)s, id,
+               LOCALTIMESTAMP, LOCALTIMESTAMP + make_interval(days => %(days)s)
+        FROM claimed
+        RETURNING book_id
+    )
+    SELECT r.id, CASE WHEN l.book_id IS NOT NULL THEN 'borrowed'
+                      WHEN b.id IS NULL THEN 'not_found'
+                      ELSE 'unavailable' END
+    FROM requested r
+    LEFT JOIN loans l ON l.book_id = r.id
+    LEFT JOIN books b ON b.id = r.id
+"""
+
+# Closes the open loans of a batch of books and frees them in one statement (see return_books).
+RETURN_BATCH_SQL = """
+    WITH requested AS (SELECT unnest(%(ids)s::int[]) AS id),
+    closed AS (
+        UPDATE transactions SET return_date = LOCALTIMESTAMP
+        WHERE book_id IN (SELECT id FROM requested) AND return_date IS NULL
+          AND (%(user_id)s::int IS NULL OR user_id = %(user_id)s)
+        RETURNING book_id
+    ),
+    freed AS (
+        UPDATE books SET status = 'available'
+        WHERE id IN (SELECT book_id FROM closed)
+        RETURNING id
+    )
+    SELECT r.id, CASE WHEN f.id IS NOT NULL THEN 'returned' ELSE 'not_borrowed' END
+    FROM requested r
+    LEFT JOIN freed f ON f.id = r.id
+"""
+
+# The write statements above, registered as hot statements (see statements.py).
+BORROW = statements.register('borrow_book', BORROW_SQL,
+                             example={'book_id': 1, 'user_id': 1, 'username': 'load-user-0', 'days': 14})
+RETURN = statements.register('return_book', RETURN_SQL, example={'book_id': 1, 'user_id': 1})
+BORROW_BATCH = statements.register('borrow_books', BORROW_BATCH_SQL,
+                                   example={'ids': [1, 2, 3], 'user_id': 1, 'username': 'load-user-0', 'days': 14})
+RETURN_BATCH = statements.register('return_books', RETURN_BATCH_SQL, example={'ids': [1, 2, 3], 'user_id': 1})
+
+def _escape_like(text):
+    """Escapes LIKE wildcards so user input is matched literally."""
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def _available_books_sql(query, filtered=False):
+    """
+    Returns the ranked search query over available books, with named parameters
+    filled in by _available_books_params. With `filtered`, only books in the given
+    category ids match (served by books_available_category_idx).
+
+    A row matches if the query is a substring of its title or author, or if it is a
+    close trigram match for a word in either (which tolerates typos). Prefix matches rank
+    highest, then matches are ordered by trigram similarity. Both predicates are served by
+    the partial pg_trgm GIN indexes on available books created in migrations.py.
     """
-    Searches for available books by title or author.
-    If no query is provided, it returns all available books.
+    categories = "AND category_id = ANY(%(category_ids)s)" if filtered else ""
+    if not query:
+        return f"""
+            SELECT id, title, author, category, 0 AS rank FROM books
+            WHERE status = 'available' {categories}
+            ORDER BY id
+            LIMIT %(limit)s OFFSET %(offset)s
+        """
+    return f"""
+        SELECT id, title, author, category,
+               GREATEST(
+                   CASE WHEN title ILIKE %(prefix)s OR author ILIKE %(prefix)s THEN 1 ELSE 0 END,
+                   word_similarity(%(query)s, title),
+                   word_similarity(%(query)s, author)
+               ) AS rank
+        FROM books
+        WHERE status = 'available' {categories}
+          AND (title ILIKE %(term)s OR author ILIKE %(term)s
+               OR %(query)s <%% title OR %(query)s <%% author)
+        ORDER BY rank DESC, id
+        LIMIT %(limit)s OFFSET %(offset)s
     """
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    
+
+def _available_books_params(query, limit, offset, category_ids=()):
+    params = {'limit': limit, 'offset': offset}
     if query:
-        search_term = f"%{query}%"
-        cursor.execute("""
-            SELECT id, title, author, category FROM books 
-            WHERE status = 'available' AND (title ILIKE %s OR author ILIKE %s)
-        """, (search_term, search_term)) # Using ILIKE for case-insensitive search in PostgreSQL
-    else:
-        cursor.execute("SELECT id, title, author, category FROM books WHERE status = 'available'")
-        
-    books = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return books
+        escaped = _escape_like(query)
+        params.update(query=query, term=f"%{escaped}%", prefix=f"{escaped}%")
+    if category_ids:
+        params['category_ids'] = list(category_ids)
+    return params
+
+def category_ids(values):
+    """Validates category filters, returning them as a sorted tuple of unique ints (empty for none)."""
+    ids = set()
+    for value in values or ():
+        try:
+            ids.add(int(value))
+        except (TypeError, ValueError):
+            continue
+    return tuple(sorted(ids))
+
+def _available_cache_key(limit, offset, categories):
+    key = f"available:{limit}:{offset}"
+    return f"{key}:{','.join(map(str, categories))}" if categories else key
+
+# Example keyset for EXPLAIN of the paged history statements.
+_EXAMPLE_BEFORE = ('2024-01-01 00:00:00', 1000)
+
+# Example category filter for EXPLAIN of the filtered statements.
+_EXAMPLE_CATEGORIES = (1, 2)
+
+# The catalogue listing and the search, keyed by (searching, filtered by category).
+AVAILABLE_BOOKS = {
+    (search, filtered): statements.register(
+        ('search_books' if search else 'available_books') + ('_filtered' if filtered else ''),
+        _available_books_sql(search, filtered),
+        example=_available_books_params('tolkien' if search else None, SEARCH_PAGE_SIZE + 1, 0,
+                                        _EXAMPLE_CATEGORIES if filtered else ()))
+    for search in (False, True) for filtered in (False, True)
+}
+
+# Available books per category, from the category_books and category_books_out circulation
+# counters (migration 10) rather than a GROUP BY over books. The counters are summed per
+# category first, then matched to categories by name through categories_name_idx. Categories
+# with no available books are left out.
+CATEGORY_FACETS_SQL = """
+    SELECT c.id, c.name, n.available
+    FROM (
+        SELECT category,
+               (COALESCE(sum(value) FILTER (WHERE counter = 'category_books'), 0)
+                - COALESCE(sum(value) FILTER (WHERE counter = 'category_books_out'), 0))::bigint AS available
+        FROM circulation_counters
+        WHERE counter IN ('category_books', 'category_books_out') AND category <> ''
+        GROUP BY category
+    ) n
+    JOIN categories c ON lower(c.name) = lower(n.category)
+    WHERE n.available > 0
+"""
+CATEGORY_FACETS = statements.register('category_facets', CATEGORY_FACETS_SQL + " ORDER BY c.name")
+
+def category_facets():
+    """
+    Returns [{'id', 'name', 'available'}] for every category with available books, by name.
+    Served from the catalogue cache, which every write to books invalidates.
+    """
+    def load():
+        with get_db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+                statements.execute(cursor, CATEGORY_FACETS)
+                return cursor.fetchall()
+    return cached_catalogue_read("category_facets", load)
+
+def search_available_books(query=None, limit=SEARCH_PAGE_SIZE, offset=0, categories=None):
+    """
+    Searches for available books by title or author, best matches first.
+    If no query is provided, it returns available books in ID order.
+    `categories` limits the results to those category ids; category_facets() gives the
+    number of available books in each. Returns at most `limit` books, skipping the first `offset`.
+    """
+    categories = category_ids(categories)
+
+    def load(connection):
+        with connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+                statements.execute(cursor, AVAILABLE_BOOKS[bool(query), bool(categories)],
+                                   _available_books_params(query, limit, offset, categories))
+                return cursor.fetchall()
+
+    if query:
+        return load(get_read_connection)
+    # The unfiltered listing only changes when books are written, so it is served from cache.
+    # Misses load from the primary, so a lagging replica never caches a stale page.
+    return cached_catalogue_read(_available_cache_key(limit, offset, categories), lambda: load(get_db_connection))
 
 def borrow_book(user_id, username, book_id, days_to_borrow):
-    """Borrows a book for a user for a specified number of days."""
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cursor.execute("SELECT status FROM books WHERE id = %s", (book_id,))
-    book_status = cursor.fetchone()
-
-    if book_status and book_status['status'] == 'available':
-        borrow_date = datetime.now()
-        due_date = borrow_date + timedelta(days=days_to_borrow)
-        
-        borrow_date_str = borrow_date.strftime('%Y-%m-%d %H:%M:%S')
-        due_date_str = due_date.strftime('%Y-%m-%d %H:%M:%S')
-
-        cursor.execute("UPDATE books SET status = 'borrowed' WHERE id = %s", (book_id,))
-        cursor.execute("""
-            INSERT INTO transactions (user_id, username, book_id, borrow_date, due_date) 
-            VALUES (%s, %s, %s, %s, %s)
-            """, (user_id, username, book_id, borrow_date_str, due_date_str))
-        conn.commit()
-        cursor.close()
-        conn.close()
-        return True
-    
-    cursor.close()
-    conn.close()
-    return False
+    """
+    Borrows a book for a user for a specified number of days.
+    Claiming the book and recording the loan happen in one atomic statement, so two
+    concurrent borrows of the same book can never both succeed.
+    """
+    try:
+        loan = execute_atomic(BORROW, {'user_id': user_id, 'username': username, 'book_id': book_id,
+                                       'days': days_to_borrow})
+    except psycopg2.errors.UniqueViolation:
+        # The book is marked available but still has an open loan; open_loans keeps it single.
+        return False
+    if loan:
+        bump_catalogue_version()
+        note_write()
+    return bool(loan)
 
 def return_book(user_id, book_id):
-    """Returns a borrowed book."""
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cursor.execute("""
-        SELECT id FROM transactions
-        WHERE user_id = %s AND book_id = %s AND return_date IS NULL
-    """, (user_id, book_id))
-    transaction = cursor.fetchone()
-
-    if transaction:
-        return_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        cursor.execute("UPDATE books SET status = 'available' WHERE id = %s", (book_id,))
-        cursor.execute("UPDATE transactions SET return_date = %s WHERE id = %s", (return_date, transaction['id']))
-        conn.commit()
-        cursor.close()
-        conn.close()
-        return True
-    
-    cursor.close()
-    conn.close()
-    return False
-
-def view_borrowing_history(user_id):
-    """Displays the borrowing history for a user, including the due date."""
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cursor.execute("""
-        SELECT b.title, t.borrow_date, t.due_date, t.return_date, t.book_id
+    """Returns a borrowed book, closing the loan and freeing the book in one atomic statement."""
+    returned = execute_atomic(RETURN, {'user_id': user_id, 'book_id': book_id})
+    if returned:
+        bump_catalogue_version()
+        note_write()
+    return bool(returned)
+
+def batch_book_ids(book_ids):
+    """Validates a batch of book IDs, returning them as a de-duplicated list of ints."""
+    ids = list(dict.fromkeys(int(book_id) for book_id in book_ids))
+    if len(ids) > BATCH_LIMIT:
+        raise ValueError(f"At most {BATCH_LIMIT} books can be processed at once")
+    return ids
+
+def borrow_books(user_id, username, book_ids, days_to_borrow):
+    """
+    Borrows several books for a user in one atomic statement.
+    Returns {book_id: 'borrowed' | 'unavailable' | 'not_found'} for every requested ID.
+    """
+    ids = batch_book_ids(book_ids)
+    if not ids:
+        return {}
+    try:
+        rows = execute_atomic(BORROW_BATCH, {'ids': ids, 'user_id': user_id, 'username': username,
+                                             'days': days_to_borrow})
+    except psycopg2.errors.UniqueViolation:
+        # A concurrent borrow opened a loan in between; nothing in this batch was applied.
+        return dict.fromkeys(ids, 'unavailable')
+    results = dict(rows)
+    if 'borrowed' in results.values():
+        bump_catalogue_version()
+        note_write()
+    return results
+
+def return_books(user_id, book_ids):
+    """
+    Returns several books in one atomic statement. With user_id=None, closes the open loan
+    of each book whoever borrowed it (a librarian checking in a returns cart).
+    Returns {book_id: 'returned' | 'not_borrowed'} for every requested ID.
+    """
+    ids = batch_book_ids(book_ids)
+    if not ids:
+        return {}
+    rows = execute_atomic(RETURN_BATCH, {'ids': ids, 'user_id': user_id})
+    results = dict(rows)
+    if 'returned' in results.values():
+        bump_catalogue_version()
+        note_write()
+    return results
+
+def decode_history_cursor(token):
+    """Parses a history keyset token into (borrow_date, id), or None if it is invalid."""
+    keyset = decode_cursor(token, 2)
+    if not keyset:
+        return None
+    borrow_date, transaction_id = keyset
+    try:
+        datetime.fromisoformat(borrow_date)
+        return borrow_date, int(transaction_id)
+    except (TypeError, ValueError):
+        return None
+
+def _history_page_sql(before):
+    """Returns the keyset-paginated history query, newest first on (borrow_date, id)."""
+    keyset = "AND (t.borrow_date, t.id) < (%(before_date)s, %(before_id)s)" if before else ""
+    return f"""
+        SELECT t.id, b.title, t.borrow_date, t.due_date, t.return_date, t.book_id
         FROM transactions t
         JOIN books b ON t.book_id = b.id
-        WHERE t.user_id = %s
-        ORDER BY t.borrow_date DESC
-    """, (user_id,))
-    history = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return history
\ No newline at end of file
+        WHERE t.user_id = %(user_id)s {keyset}
+        ORDER BY t.borrow_date DESC, t.id DESC
+        LIMIT %(history_limit)s
+    """
+
+def _history_params(user_id, before, limit):
+    # Named apart from the books page's limit, as the dashboard statement binds both.
+    params = {'user_id': user_id, 'history_limit': limit + 1}
+    if before:
+        params['before_date'], params['before_id'] = before
+    return params
+
+# The history page, keyed by whether it continues from a keyset.
+HISTORY_PAGE = {
+    False: statements.register('history_page', _history_page_sql(None),
+                               example=_history_params(1, None, HISTORY_PAGE_SIZE)),
+    True: statements.register('history_page_keyset', _history_page_sql(_EXAMPLE_BEFORE),
+                              example=_history_params(1, _EXAMPLE_BEFORE, HISTORY_PAGE_SIZE)),
+}
+
+def _split_history_page(rows, limit):
+    """Trims the look-ahead row and returns (rows, token for the next page or None)."""
+    return split_page(rows, limit, key=lambda row: (row['borrow_date'], row['id']))
+
+def view_borrowing_history(user_id, before=None, limit=HISTORY_PAGE_SIZE):
+    """
+    Displays one page of the borrowing history for a user, including the due date.
+    `before` is a (borrow_date, id) keyset from decode_history_cursor; returns (rows, next_cursor).
+    """
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            statements.execute(cursor, HISTORY_PAGE[bool(before)], _history_params(user_id, before, limit))
+            history = cursor.fetchall()
+    return _split_history_page(history, limit)
+
+def _parse_json_timestamp(value):
+    return datetime.strptime(value, _JSON_TIMESTAMP_FORMAT) if value else None
+
+def _dashboard_sql(search, filtered, keyset):
+    """
+    Returns the dashboard statement: a page of available books (searched and filtered by
+    category or not), the category facets and a page of history (first or after a keyset)
+    in one query. The result sets are aggregated to JSON so a single statement returns them together.
+    """
+    return f"""
+        SELECT
+            (SELECT COALESCE(json_agg(b ORDER BY b.rank DESC, b.id), '[]'::json)
+             FROM ({_available_books_sql(search, filtered)}) b
+             WHERE %(want_books)s) AS books,
+            (SELECT COALESCE(json_agg(f ORDER BY f.name), '[]'::json)
+             FROM ({CATEGORY_FACETS_SQL}) f
+             WHERE %(want_facets)s) AS facets,
+            (SELECT COALESCE(json_agg(h ORDER BY h.sort_date DESC, h.id DESC), '[]'::json)
+             FROM (SELECT p.id, p.title, p.book_id, p.borrow_date AS sort_date,
+                          to_char(p.borrow_date, 'YYYY-MM-DD HH24:MI:SS.US') AS borrow_date,
+                          to_char(p.due_date, 'YYYY-MM-DD HH24:MI:SS.US') AS due_date,
+                          to_char(p.return_date, 'YYYY-MM-DD HH24:MI:SS.US') AS return_date
+                   FROM ({_history_page_sql(keyset)}) p) h) AS history
+    """
+
+def _dashboard_example(search, filtered, keyset):
+    params = _history_params(1, keyset, HISTORY_PAGE_SIZE)
+    params.update(_available_books_params(search, SEARCH_PAGE_SIZE + 1, 0, _EXAMPLE_CATEGORIES if filtered else ()))
+    params.update(want_books=True, want_facets=True)
+    return params
+
+# The dashboard statement, keyed by (searching, filtered by category, paging back through history).
+DASHBOARD = {
+    (search, filtered, paged): statements.register(
+        'dashboard' + ('_search' if search else '') + ('_filtered' if filtered else '')
+        + ('_keyset' if paged else ''),
+        _dashboard_sql(search, filtered, _EXAMPLE_BEFORE if paged else None),
+        example=_dashboard_example('tolkien' if search else None, filtered, _EXAMPLE_BEFORE if paged else None))
+    for search in (False, True) for filtered in (False, True) for paged in (False, True)
+}
+
+def load_dashboard(user_id, query=None, show_all=False, books_page=1, history_before=None,
+                   history_limit=HISTORY_PAGE_SIZE, books_limit=SEARCH_PAGE_SIZE, categories=None):
+    """
+    Loads everything the user dashboard needs over one connection in one round trip:
+    one page of available books matching `query` and `categories` (all of them if `show_all`,
+    none if none of these is set), the category facets and one keyset page of the user's
+    borrowing history.
+    Returns a dict with 'available_books', 'has_more_books', 'category_facets', 'history'
+    and 'history_next' (the next history page token).
+    """
+    plan = _plan_dashboard(user_id, query, show_all, books_page, history_before, history_limit, books_limit,
+                           categories)
+    # A catalogue page that is about to be cached is read from the primary; otherwise the
+    # dashboard can be served by a replica.
+    connection = get_db_connection if plan['reads_primary'] else get_read_connection
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            statements.execute(cursor, plan['statement'], plan['params'])
+            fetched_books, fetched_facets, history = cursor.fetchone()
+    return _finish_dashboard(plan, fetched_books, fetched_facets, history)
+
+def _plan_dashboard(user_id, query, show_all, books_page, history_before, history_limit, books_limit,
+                    categories=None):
+    """
+    Works out the dashboard statement for load_dashboard (and its async counterpart):
+    returns a dict with the 'statement' and 'params' to run, whether it must read the primary,
+    and the catalogue page and facets if the cache already had them.
+    """
+    categories = category_ids(categories)
+    books_offset = (max(books_page, 1) - 1) * books_limit
+    books, cache_slot = None, None
+    if (show_all or categories) and not query:
+        # The unfiltered listing comes from the catalogue cache when it can; on a miss it is
+        # still fetched in the same round trip below and then cached.
+        books, cache_slot = lookup_catalogue(_available_cache_key(books_limit + 1, books_offset, categories))
+    want_books = (bool(query) or show_all or bool(categories)) and books is None
+    # The facets are cached like a catalogue page (see category_facets).
+    facets, facets_slot = lookup_catalogue("category_facets")
+    want_facets = facets is None
+
+    params = _history_params(user_id, history_before, history_limit)
+    # One extra book is fetched to tell whether another page follows.
+    params.update(_available_books_params(query, books_limit + 1, books_offset, categories))
+    params.update(want_books=want_books, want_facets=want_facets)
+
+    return {'statement': DASHBOARD[bool(query), bool(categories), bool(history_before)], 'params': params,
+            'books': books, 'cache_slot': cache_slot, 'want_books': want_books,
+            'facets': facets, 'facets_slot': facets_slot, 'want_facets': want_facets,
+            'reads_primary': (want_books and cache_slot is not None) or (want_facets and facets_slot is not None),
+            'books_limit': books_limit, 'history_limit': history_limit}
+
+def _finish_dashboard(plan, fetched_books, fetched_facets, history):
+    """Caches a freshly read catalogue page and facets and shapes the dashboard result (see load_dashboard)."""
+    books = plan['books']
+    if plan['want_books']:
+        books = fetched_books
+        store_catalogue(plan['cache_slot'], books)
+    facets = plan['facets']
+    if plan['want_facets']:
+        facets = fetched_facets
+        store_catalogue(plan['facets_slot'], facets)
+    books = books or []
+    books_limit = plan['books_limit']
+
+    for item in history:
+        del item['sort_date']
+        for field in ('borrow_date', 'due_date', 'return_date'):
+            item[field] = _parse_json_timestamp(item[field])
+    history, history_next = _split_history_page(history, plan['history_limit'])
+    return {'available_books': books[:books_limit],
+            'has_more_books': len(books) > books_limit,
+            'category_facets': facets or [],
+            'history': history,
+            'history_next': history_next}
@@ -0,0 +1,113 @@
+############################################################
+# TRANSACTIONS ARCHIVE BUCKET
+# Old transactions partitions are dumped here by the
+# maintain-partitions CronJob (k8s/08) and read back by the
+# app for /api/v1/me/history/archived. EBS volumes cannot be
+# shared between pods, so the archive lives in S3.
+############################################################
+
+resource "aws_s3_bucket" "transactions_archive" {
+  bucket = "${var.cluster_name}-transactions-archive"
+}
+
+resource "aws_s3_bucket_public_access_block" "transactions_archive" {
+  bucket = aws_s3_bucket.transactions_archive.id
+
+  block_public_acls       = true
+  block_public_policy     = true
+  ignore_public_acls      = true
+  restrict_public_buckets = true
+}
+
+resource "aws_s3_bucket_server_side_encryption_configuration" "transactions_archive" {
+  bucket = aws_s3_bucket.transactions_archive.id
+
+  rule {
+    apply_server_side_encryption_by_default {
+      sse_algorithm = "AES256"
+    }
+  }
+}
+
+
+############################################################
+# POD ROLES FOR THE ARCHIVE (EKS Pod Identity)
+# - transactions-archiver (CronJob): read + write
+# - flask-app (web Deployment):      read only
+############################################################
+
+locals {
+  pod_identity_trust = jsonencode({
+    Version = "2012-10-17",
+    Statement = [{
+      Effect = "Allow",
+      Action = [
+        "sts:AssumeRole",
+        "sts:TagSession"
+      ],
+      Principal = {
+        Service = "pods.eks.amazonaws.com"
+      }
+    }]
+  })
+}
+
+resource "aws_iam_role" "archive_writer_role" {
+  name               = "${var.cluster_name}-archive-writer-role"
+  assume_role_policy = local.pod_identity_trust
+}
+
+resource "aws_iam_role_policy" "archive_writer_policy" {
+  name = "transactions-archive-write"
+  role = aws_iam_role.archive_writer_role.id
+
+  policy = jsonencode({
+    Version = "2012-10-17",
+    Statement = [{
+      Effect   = "Allow",
+      Action   = ["s3:PutObject", "s3:GetObject"],
+      Resource = "${aws_s3_bucket.transactions_archive.arn}/*"
+    }]
+  })
+}
+
+resource "aws_iam_role" "archive_reader_role" {
+  name               = "${var.cluster_name}-archive-reader-role"
+  assume_role_policy = local.pod_identity_trust
+}
+
+resource "aws_iam_role_policy" "archive_reader_policy" {
+  name = "transactions-archive-read"
+  role = aws_iam_role.archive_reader_role.id
+
+  policy = jsonencode({
+    Version = "2012-10-17",
+    Statement = [{
+      Effect   = "Allow",
+      Action   = ["s3:GetObject"],
+      Resource = "${aws_s3_bucket.transactions_archive.arn}/*"
+    }]
+  })
+}
+
+resource "aws_eks_pod_identity_association" "archive_writer_assoc" {
+  cluster_name    = aws_eks_cluster.this.name
+  namespace       = "library-app"
+  service_account = "transactions-archiver"
+  role_arn        = aws_iam_role.archive_writer_role.arn
+
+  depends_on = [
+    aws_eks_addon.pod_identity
+  ]
+}
+
+resource "aws_eks_pod_identity_association" "archive_reader_assoc" {
+  cluster_name    = aws_eks_cluster.this.name
+  namespace       = "library-app"
+  service_account = "flask-app"
+  role_arn        = aws_iam_role.archive_reader_role.arn
+
+  depends_on = [
+    aws_eks_addon.pod_identity
+  ]
+}
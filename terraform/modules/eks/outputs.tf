@@ -9,3 +9,7 @@ output "cluster_endpoint" {
 output "cluster_certificate_authority_data" {
   value = aws_eks_cluster.this.certificate_authority[0].data
 }
+
+output "transactions_archive_bucket" {
+  value = aws_s3_bucket.transactions_archive.bucket
+}
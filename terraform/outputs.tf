@@ -21,3 +21,7 @@ output "eks_cluster_endpoint" {
 output "eks_cluster_name" {
   value = module.eks.cluster_name
 }
+
+output "transactions_archive_bucket" {
+  value = module.eks.transactions_archive_bucket
+}